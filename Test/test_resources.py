@@ -3,15 +3,43 @@ This module is used to prepare test resources.
 """
 
 import base64
+import hashlib
+import io
+import json
 import random
+import re
+import shutil
 import tempfile
+import threading
 import os
 import sys
+import time
 from datetime import datetime
 from urllib.parse import quote
 import pytest
-from geodata import db, create_app
-from geodata.models import User, Insight, Feedback
+from PIL import Image
+from sqlalchemy import event, text
+from geodata import cache, db, create_app, metrics, tiles
+from geodata.auth import api_key_cache
+from geodata.blobs import blob_path, schedule_thumbnail, wait_for_thumbnails
+from geodata.feedback_queue import FeedbackQueue, get_feedback_queue, status_key
+from geodata import hashing
+from geodata.hashing import hash_stats
+from geodata.schemas import get_schema
+from geodata.synthetic import SyntheticData
+from geodata.sqlite import (
+    PRODUCTION_ENGINE_OPTIONS,
+    PRODUCTION_PRAGMAS,
+    _fork_engines,
+)
+from geodata.utils import ENCODERS, encode
+from geodata.models import (
+    ApiKey,
+    User,
+    Insight,
+    Feedback,
+    recompute_rating_aggregates,
+)
 
 
 @pytest.fixture
@@ -20,9 +48,12 @@ def client():
     Create test client
     """
     db_fd, db_fname = tempfile.mkstemp()
+    blob_dir = tempfile.mkdtemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
         "TESTING": True,
+        "CACHE_TYPE": "SimpleCache",
+        "BLOB_DIR": blob_dir,
     }
     app = create_app(config)
 
@@ -36,6 +67,7 @@ def client():
         db.drop_all()
 
     os.close(db_fd)
+    shutil.rmtree(blob_dir, ignore_errors=True)
     try:
         os.unlink(db_fname)
     except:
@@ -140,6 +172,7 @@ def _populate_db():
 
     db.session.add_all(test_feedback)
     db.session.commit()
+    recompute_rating_aggregates()
 
 
 def get_user_json(number=1):
@@ -169,6 +202,20 @@ def get_api_key_header(client, number=99):
     }
 
 
+def get_with_statements(client, url, **kwargs):
+    """
+    GET url and return the response and the SQL statements it ran
+    """
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+        response = client.get(url, **kwargs)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listener)
+    return response, statements
+
+
 class TestUsersCollection:
     """
     Test user collection
@@ -187,6 +234,36 @@ class TestUsersCollection:
         usernames = [item["username"] for item in body["items"]]
         assert set(usernames) == {"testuser1", "testuser2", "admin"}
 
+    def test_get_paginated(self, client):
+        """
+        Test paging through users with limit and cursor
+        """
+        response = client.get(self.RESOURCE_URL + "?limit=2")
+        assert response.status_code == 200
+        body = response.get_json()
+        assert [item["username"] for item in body["items"]] == [
+            "testuser1",
+            "testuser2",
+        ]
+        assert "prev" not in body["@controls"]
+
+        response = client.get(body["@controls"]["next"]["href"])
+        body = response.get_json()
+        assert [item["username"] for item in body["items"]] == ["admin"]
+        assert "next" not in body["@controls"]
+
+        response = client.get(body["@controls"]["prev"]["href"])
+        body = response.get_json()
+        assert [item["username"] for item in body["items"]] == [
+            "testuser1",
+            "testuser2",
+        ]
+
+        response = client.get(self.RESOURCE_URL + "?limit=0")
+        assert response.status_code == 400
+        response = client.get(self.RESOURCE_URL + "?cursor=notacursor")
+        assert response.status_code == 400
+
     def test_post(self, client):
         """
         Test create user
@@ -211,6 +288,78 @@ class TestUsersCollection:
         response = client.post(self.RESOURCE_URL, json=valid_user)
         assert response.status_code == 400
 
+    def test_post_hashes_in_pool(self, client):
+        """
+        Test that passwords are hashed in the pool with the configured method
+        """
+        client.application.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+        assert client.application.config["PASSWORD_HASH_WORKERS"] > 0
+        hashed = hash_stats["hashed"]
+
+        response = client.post(self.RESOURCE_URL, json=get_user_json(8))
+        assert response.status_code == 201
+        assert hashing._executor is not None
+        assert hash_stats["hashed"] == hashed + 1
+        assert hash_stats["pending"] == 0
+        assert hash_stats["max_seconds"] > 0
+
+        user = User.query.filter_by(username="extrauser8").first()
+        assert user.password.startswith("pbkdf2:sha256:1000$")
+        assert user.verify_password("password123")
+
+    def test_post_hash_queue_full(self, client):
+        """
+        Test that signups and password changes get 503 while the hashing
+        queue is full, and that the queue depth counts pending hashes
+        """
+        client.application.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+        api_key_info = get_api_key_header(client)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        client.application.config["PASSWORD_HASH_QUEUE_SIZE"] = 1
+
+        with hashing._lock:
+            hash_stats["pending"] += 1
+        try:
+            response = client.post(self.RESOURCE_URL, json=get_user_json(8))
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+            assert not User.query.filter_by(username="extrauser8").first()
+
+            user_json = get_user_json(99)
+            user_json["password"] = "newpassword123"
+            response = client.put(
+                f"/api/users/{api_key_info['user']}/", headers=headers, json=user_json
+            )
+            assert response.status_code == 503
+        finally:
+            with hashing._lock:
+                hash_stats["pending"] -= 1
+
+        assert hash_stats["pending"] == 0
+        response = client.post(self.RESOURCE_URL, json=get_user_json(8))
+        assert response.status_code == 201
+        assert hash_stats["pending"] == 0
+
+    def test_schema_controls(self, client):
+        """
+        Test that schema controls use the frozen schemas of the validators
+        """
+        body = client.get(self.RESOURCE_URL).get_json()
+        schema = body["@controls"]["geometa:add-user"]["schema"]
+        assert schema == User.get_schema()
+        assert schema == get_schema(User)
+
+        with pytest.raises(TypeError):
+            get_schema(User)["required"].append("phone")
+        with pytest.raises(TypeError):
+            get_schema(User)["properties"]["phone"] = {"type": "string"}
+
+        invalid_user = get_user_json(5)
+        invalid_user["status"] = "UNKNOWN"
+        response = client.post(self.RESOURCE_URL, json=invalid_user)
+        assert response.status_code == 400
+        assert "UNKNOWN" in response.get_data(as_text=True)
+
 
 class TestUserItem:
     """
@@ -427,6 +576,128 @@ class TestUserItem:
         response = client.delete(resource_url, headers=headers)
         assert response.status_code == 404
 
+    def test_put_profile_picture(self, client):
+        """
+        Test storing a profile picture in the blob store and serving it and
+        its thumbnail
+        """
+        api_key_info = get_api_key_header(client, 60)
+        username = api_key_info["user"]
+        headers = {"Authorization": api_key_info["Authorization"]}
+        buffer = io.BytesIO()
+        Image.new("RGB", (200, 100), "red").save(buffer, format="PNG")
+        picture = base64.b64encode(buffer.getvalue()).decode()
+
+        update = get_user_json(60)
+        update["profile_picture"] = "bm90IGFuIGltYWdl"
+        response = client.put(f"/api/users/{username}/", headers=headers, json=update)
+        assert response.status_code == 400
+
+        update["profile_picture"] = picture
+        response = client.put(f"/api/users/{username}/", headers=headers, json=update)
+        assert response.status_code == 204
+        wait_for_thumbnails(timeout=10)
+        # the test requests share one session, which has not seen the thumbnail
+        db.session.expire_all()
+
+        body = client.get(f"/api/users/{username}/", headers=headers).get_json()
+        response = client.get(body["profile_picture"])
+        assert response.status_code == 200
+        assert response.data == buffer.getvalue()
+        assert response.mimetype == "image/png"
+        assert "immutable" in response.headers["Cache-Control"]
+        response.close()
+        response = client.get(
+            body["profile_picture"],
+            headers={"If-None-Match": response.headers["ETag"]},
+        )
+        assert response.status_code == 304
+
+        response = client.get(body["profile_picture_thumb"])
+        assert response.mimetype == "image/webp"
+        assert Image.open(io.BytesIO(response.data)).size == (64, 32)
+        response.close()
+
+        # identical pictures are stored once
+        other_info = get_api_key_header(client, 61)
+        other_headers = {"Authorization": other_info["Authorization"]}
+        update = get_user_json(61)
+        update["profile_picture"] = picture
+        client.put(
+            f"/api/users/{other_info['user']}/", headers=other_headers, json=update
+        )
+        other = client.get(f"/api/users/{other_info['user']}/").get_json()
+        assert other["profile_picture_thumb"] in (None, body["profile_picture_thumb"])
+        user = User.query.filter_by(username=other_info["user"]).first()
+        assert body["profile_picture"].endswith(user.profile_picture)
+
+        assert client.get("/api/pictures/../secret").status_code == 404
+        assert client.get("/api/pictures/" + "0" * 64 + ".png").status_code == 404
+
+    def test_put_profile_picture_failures(self, client, caplog):
+        """
+        Test that a failed commit stores no picture and that failed
+        thumbnails are logged
+        """
+        api_key_info = get_api_key_header(client, 62)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        buffer = io.BytesIO()
+        Image.new("RGB", (20, 10), "blue").save(buffer, format="PNG")
+        data = buffer.getvalue()
+        path = blob_path(f"{hashlib.sha256(data).hexdigest()}.png")
+
+        update = get_user_json(62)
+        update["username"] = "testuser1"
+        update["profile_picture"] = base64.b64encode(data).decode()
+        response = client.put(
+            f"/api/users/{api_key_info['user']}/", headers=headers, json=update
+        )
+        assert response.status_code == 409
+        assert not os.path.exists(path)
+
+        user = User.query.filter_by(username=api_key_info["user"]).first()
+        schedule_thumbnail(user.id, "0" * 64 + ".png")
+        wait_for_thumbnails(timeout=10)
+        # the done callback may still be running
+        for _ in range(100):
+            if "Thumbnail of " in caplog.text:
+                break
+            time.sleep(0.01)
+        assert "Thumbnail of " + "0" * 64 + ".png" in caplog.text
+
+    def test_api_key_cache(self, client):
+        """
+        Test that resolved API keys are cached and dropped when the user changes
+        """
+        api_key_info = get_api_key_header(client, 77)
+        username = api_key_info["user"]
+        headers = {"Authorization": api_key_info["Authorization"]}
+        key_hash = ApiKey.key_hash(api_key_info["Authorization"].split(" ", 1)[1])
+
+        response = client.get(f"/api/users/{username}/", headers=headers)
+        assert response.status_code == 200
+        assert api_key_cache.get(key_hash) is not None
+
+        # the cached user is used without touching the api_key table
+        response, statements = get_with_statements(
+            client, f"/api/users/{username}/", headers=headers
+        )
+        assert response.status_code == 200
+        assert response.get_json()["email"]
+        assert not [sql for sql in statements if "api_key" in sql]
+
+        update = get_user_json(77)
+        update["first_name"] = "Cached"
+        response = client.put(f"/api/users/{username}/", headers=headers, json=update)
+        assert response.status_code == 204
+        assert api_key_cache.get(key_hash) is None
+
+        response = client.delete(f"/api/users/{username}/", headers=headers)
+        assert response.status_code == 204
+        assert api_key_cache.get(key_hash) is None
+        response = client.put("/api/insights/1/", headers=headers, json={})
+        assert response.status_code == 401
+
 
 class TestFeedbackCollection:
     """
@@ -478,6 +749,57 @@ class TestFeedbackCollection:
         response = client.get(self.INVALID_INSIGHT_URL)
         assert response.status_code == 404
 
+    def test_get_query_count(self, client):
+        """
+        Test that a feedback page costs the same number of queries however
+        many authors and insights its items have
+        """
+        counts = {}
+        for size in (3, 30):
+            db.session.add_all(
+                User(
+                    username=f"rater{size}x{index}",
+                    email=f"rater{size}x{index}@example.com",
+                    password="-",
+                    first_name="Rater",
+                    feedback=[
+                        Feedback(insight_id=1, rating=4),
+                        Feedback(
+                            insight_id=db.session.get(User, 2).insight[0].id,
+                            rating=3,
+                        ),
+                    ],
+                )
+                for index in range(size)
+            )
+            db.session.commit()
+            db.session.expunge_all()
+
+            response, by_insight = get_with_statements(
+                client, f"{self.INSIGHT_FB_URL}?limit=100"
+            )
+            assert response.status_code == 200
+            assert all(item["user"] for item in response.get_json()["items"][2:])
+            response, by_user = get_with_statements(
+                client, f"/api/users/rater{size}x0/feedbacks/"
+            )
+            assert response.status_code == 200
+            counts[size] = (len(by_insight), len(by_user))
+        assert counts[3] == counts[30]
+        # users, insight and the page
+        assert counts[30][0] <= 3
+
+        feedback = Feedback.query.filter_by(insight_id=1).first()
+        for url in (
+            f"{self.INSIGHT_FB_URL}{feedback.id}/",
+            f"/api/users/testuser1/feedbacks/{feedback.id}/",
+        ):
+            db.session.expunge_all()
+            response, statements = get_with_statements(client, url)
+            assert response.status_code == 200
+            # users, (insight), feedback with its author and insight
+            assert len(statements) <= 3
+
     def test_post(self, client):
         """
         Test creating feedback through insight path
@@ -534,6 +856,201 @@ class TestFeedbackCollection:
         assert "user" in body
         assert body["user"] == username
 
+    def test_rating_aggregates(self, client):
+        """
+        Test that insight rating aggregates follow feedback writes and can be
+        recomputed from scratch
+        """
+        insight = db.session.get(Insight, 1)
+        assert (insight.rating_count, insight.rating_sum) == (2, 8)
+        assert insight.serialize()["average_rating"] == 4.0
+
+        api_key_info = get_api_key_header(client)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        response = client.post(
+            self.INSIGHT_FB_URL, headers=headers, json={"rating": 1, "comment": "Bad"}
+        )
+        assert response.status_code == 201
+        location = response.headers["Location"]
+
+        db.session.refresh(insight)
+        assert (insight.rating_count, insight.rating_sum) == (3, 9)
+        assert insight.serialize()["rating_histogram"] == {
+            "1": 1,
+            "2": 0,
+            "3": 1,
+            "4": 0,
+            "5": 1,
+        }
+
+        response = client.put(
+            location, headers=headers, json={"rating": 2, "comment": "Better"}
+        )
+        assert response.status_code == 200
+        db.session.refresh(insight)
+        assert (insight.rating_count, insight.rating_sum) == (3, 10)
+        assert (insight.rating_1, insight.rating_2) == (0, 1)
+
+        response = client.delete(location, headers=headers)
+        assert response.status_code == 204
+        db.session.refresh(insight)
+        assert (insight.rating_count, insight.rating_sum, insight.rating_2) == (2, 8, 0)
+
+        response = client.post(self.INSIGHT_FB_URL, json={"rating": 6})
+        assert response.status_code == 400
+
+        insight.rating_count = 0
+        db.session.commit()
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["recompute-ratings"])
+        assert "recomputed" in result.output
+        db.session.refresh(insight)
+        assert (insight.rating_count, insight.rating_sum, insight.rating_5) == (2, 8, 1)
+
+        # A database from before the aggregates gets their columns first
+        db.session.execute(text("ALTER TABLE insight DROP COLUMN rating_sum"))
+        db.session.execute(text("ALTER TABLE insight DROP COLUMN rating_5"))
+        db.session.commit()
+        result = runner.invoke(args=["recompute-ratings"])
+        assert "Added column insight.rating_sum." in result.output
+        assert "Added column insight.rating_5." in result.output
+        assert "recomputed" in result.output
+        db.session.expire_all()
+        insight = db.session.get(Insight, 1)
+        assert (insight.rating_count, insight.rating_sum, insight.rating_5) == (2, 8, 1)
+
+    def test_migrate_db(self, client):
+        """
+        Test that migrate-db brings a database from before row versions and
+        the search index up to date
+        """
+        for trigger in ("insert", "update", "delete"):
+            db.session.execute(text(f"DROP TRIGGER insight_fts_{trigger}"))
+        db.session.execute(text("DROP TABLE insight_fts"))
+        for table in ("user", "insight", "feedback"):
+            db.session.execute(text(f'ALTER TABLE "{table}" DROP COLUMN version'))
+        db.session.commit()
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["migrate-db"])
+        for table in ("user", "insight", "feedback"):
+            assert f"Added column {table}.version." in result.output
+        assert "migrated successfully" in result.output
+        assert "Added column" not in runner.invoke(args=["migrate-db"]).output
+
+        db.session.expire_all()
+        response = client.get("/api/insights/1/")
+        assert response.status_code == 200
+        assert "ETag" in response.headers
+        response = client.get("/api/insights/?q=park")
+        assert response.status_code == 200
+        assert response.get_json()["items"]
+
+    def test_post_write_behind(self, client):
+        """
+        Test that queued feedback is committed in groups and that its status
+        leads to the committed feedback
+        """
+        client.application.config["FEEDBACK_WRITE_BEHIND"] = True
+        client.application.config["FEEDBACK_GROUP_DELAY"] = 0.5
+        feedback_queue = get_feedback_queue(client.application)
+
+        locations = []
+        for rating in (1, 2, 3, 4, 5):
+            response = client.post(
+                self.INSIGHT_FB_URL, json={"rating": rating, "comment": "Queued"}
+            )
+            assert response.status_code == 202
+            locations.append(response.headers["Location"])
+        response = client.post(self.INSIGHT_FB_URL, json={"rating": 6})
+        assert response.status_code == 400
+
+        feedback_queue.join()
+        assert feedback_queue.depth == 0
+        assert feedback_queue.stats["committed"] == 5
+        assert feedback_queue.stats["groups"] < 5
+
+        for location in locations:
+            response = client.get(location)
+            assert response.status_code == 200
+            body = response.get_json()
+            assert body["state"] == "committed"
+            response = client.get(body["@controls"]["geometa:feedback"]["href"])
+            assert response.status_code == 200
+            assert response.get_json()["comment"] == "Queued"
+
+        db.session.expire_all()
+        insight = db.session.get(Insight, 1)
+        assert (insight.rating_count, insight.rating_sum) == (7, 23)
+
+        response = client.get("/api/feedback-status/unknown/")
+        assert response.status_code == 404
+
+    def test_post_write_behind_failures(self, client, monkeypatch):
+        """
+        Test that errors fail the queued feedback without stopping the writer
+        and that a full queue turns posts away
+        """
+        app = client.application
+        app.config["FEEDBACK_WRITE_BEHIND"] = True
+        feedback_queue = get_feedback_queue(app)
+
+        def fail(group):
+            raise RuntimeError("Writer bug")
+
+        monkeypatch.setattr(feedback_queue, "_commit", fail)
+        response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+        assert response.status_code == 202
+        location = response.headers["Location"]
+        feedback_queue.join()
+        body = client.get(location).get_json()
+        assert body["state"] == "failed"
+        assert body["error"] == "Writer bug"
+
+        monkeypatch.setattr(feedback_queue, "_flush", fail)
+        response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+        assert response.status_code == 202
+        location = response.headers["Location"]
+        feedback_queue.join()
+        assert client.get(location).get_json()["state"] == "failed"
+        monkeypatch.undo()
+
+        response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+        assert response.status_code == 202
+        feedback_queue.join()
+        assert client.get(response.headers["Location"]).get_json()["state"] == (
+            "committed"
+        )
+
+        # A writer stuck on its first group and a queue of one
+        feedback_queue.stop()
+        app.extensions.pop("feedback_queue")
+        flushing = threading.Event()
+        release = threading.Event()
+
+        def stuck(self, group):
+            flushing.set()
+            release.wait()
+
+        monkeypatch.setitem(app.config, "FEEDBACK_QUEUE_SIZE", 1)
+        monkeypatch.setitem(app.config, "FEEDBACK_GROUP_SIZE", 1)
+        monkeypatch.setattr(FeedbackQueue, "_flush", stuck)
+        feedback_queue = get_feedback_queue(app)
+        try:
+            response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+            assert response.status_code == 202
+            assert flushing.wait(5)
+            response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+            assert response.status_code == 202
+            response = client.post(self.INSIGHT_FB_URL, json={"rating": 4})
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "1"
+        finally:
+            release.set()
+            feedback_queue.stop()
+            app.extensions.pop("feedback_queue")
+            app.config["FEEDBACK_WRITE_BEHIND"] = False
+
 
 class TestFeedbackItem:
     """
@@ -872,6 +1389,134 @@ class TestInsightItem:
         response = client.get(insight_url)
         assert response.status_code == 404
 
+    def test_get_conditional(self, client):
+        """
+        Test ETag validation of insight items and collections
+        """
+        response = client.get(self.RESOURCE_URL)
+        etag = response.headers["ETag"]
+        # ratings change the body but not modified_date
+        assert "Last-Modified" not in response.headers
+        assert response.headers["Vary"] == "Authorization"
+        response = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert not response.data
+
+        # the controls depend on the caller, so does the ETag
+        api_key_info = get_api_key_header(client)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        response = client.get(
+            self.RESOURCE_URL, headers=dict(headers, **{"If-None-Match": etag})
+        )
+        assert response.status_code == 200
+
+        collection_url = "/api/insights/?bbox=-180,-90,180,90&limit=2"
+        collection_etag = client.get(collection_url).headers["ETag"]
+        response = client.get(
+            collection_url, headers={"If-None-Match": collection_etag}
+        )
+        assert response.status_code == 304
+
+        # the version is read off the page rows, without further queries
+        response, statements = get_with_statements(client, "/api/users/?limit=2")
+        assert len(statements) == 1
+        response, statements = get_with_statements(
+            client, "/api/insights/?bbox=25.46,65.0,25.48,65.02"
+        )
+        cached_etag = response.headers["ETag"]
+        response, statements = get_with_statements(
+            client, "/api/insights/?bbox=25.46,65.0,25.48,65.02"
+        )
+        assert response.headers["ETag"] == cached_etag
+        assert not statements
+
+        # a new rating changes the insight and the collection
+        response = client.post(
+            "/api/users/testuser1/insights/1/feedbacks/", json={"rating": 5}
+        )
+        assert response.status_code == 201
+        response = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        response = client.get(
+            collection_url, headers={"If-None-Match": collection_etag}
+        )
+        assert response.status_code == 200
+
+        response = client.get("/api/users/testuser1/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        user_etag = response.headers["ETag"]
+        response = client.get(
+            "/api/users/testuser1/", headers={"If-None-Match": user_etag}
+        )
+        assert response.status_code == 304
+
+    def test_get_cached_per_caller_and_alias(self, client):
+        """
+        Test that cached insights keep caller specific controls apart and are
+        invalidated on every route
+        """
+
+        owner = {
+            "username": "cacheowner",
+            "email": "cacheowner@example.com",
+            "password": "password123",
+            "first_name": "Cache",
+            "last_name": "Owner",
+        }
+        response = client.post("/api/users/", json=owner)
+        assert response.status_code == 201
+        headers = {"Authorization": f"Bearer {response.get_json()['api_key']}"}
+        new_insight = {
+            "title": "Cached Insight",
+            "description": "Cached",
+            "longitude": 25.5,
+            "latitude": 65.0,
+            "category": "Test",
+            "subcategory": "Testing",
+        }
+        response = client.post(
+            "/api/users/cacheowner/insights/", headers=headers, json=new_insight
+        )
+        insight_url = response.headers["Location"]
+        insight_id = insight_url.rstrip("/").rsplit("/", 1)[1]
+        public_url = f"/api/insights/{insight_id}/"
+
+        # the owner's edit controls are not served to anonymous callers
+        body = client.get(insight_url, headers=headers).get_json()
+        assert "edit" in body["@controls"]
+        body = client.get(insight_url).get_json()
+        assert "edit" not in body["@controls"]
+        body = client.get(public_url).get_json()
+        assert "geometa:insights-all" in body["@controls"]
+        assert "geometa:insights-by" not in body["@controls"]
+
+        # updating through one route is seen on the other
+        new_insight["title"] = "Updated Cached Insight"
+        response = client.put(insight_url, headers=headers, json=new_insight)
+        assert response.status_code == 200
+        assert client.get(public_url).get_json()["title"] == "Updated Cached Insight"
+
+        # feedback changes the cached rating
+        client.post(f"{insight_url}feedbacks/", json={"rating": 4})
+        assert client.get(public_url).get_json()["average_rating"] == 4
+
+        # renaming the author is seen on the cached insight
+        response = client.put(
+            "/api/users/cacheowner/",
+            headers=headers,
+            json=dict(owner, username="renamed"),
+        )
+        assert response.status_code == 204
+        assert client.get(public_url).get_json()["user"] == "renamed"
+
+        response = client.delete(public_url, headers=headers)
+        assert response.status_code == 204
+        assert (
+            client.get(insight_url.replace("cacheowner", "renamed")).status_code == 404
+        )
+
     def test_delete_unauthorized(self, client):
         """Test unauthorized delete scenarios"""
 
@@ -930,6 +1575,348 @@ class TestInsightCollection:
         body = response.get_json()
         assert len(body["items"]) == 0
 
+    def test_get_paginated(self, client):
+        """
+        Test walking an insight collection with next and prev controls
+        while keeping the query filters
+        """
+        url = "/api/insights/?bbox=25.4,65.0,25.5,65.1&limit=1"
+        seen = []
+        while url:
+            response = client.get(url)
+            assert response.status_code == 200
+            body = response.get_json()
+            seen.extend(item["id"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+            if url:
+                assert "bbox=25.4%2C65.0%2C25.5%2C65.1" in url
+        assert seen == [1, 2, 3]
+
+        response = client.get(body["@controls"]["prev"]["href"])
+        body = response.get_json()
+        assert [item["id"] for item in body["items"]] == [2]
+
+        response = client.get("/api/users/testuser2/insights/1/feedbacks/?limit=1")
+        body = response.get_json()
+        assert len(body["items"]) == 1
+        assert "next" in body["@controls"]
+
+    def test_get_near(self, client):
+        """
+        Test nearest-neighbour and radius searches around a point
+        """
+        response = client.get("/api/insights/?near=25.469,65.009&k=2")
+        assert response.status_code == 200
+        items = response.get_json()["items"]
+        assert [item["id"] for item in items] == [2, 1]
+        assert items[0]["distance"] == 0
+        assert 300 < items[1]["distance"] < 450
+
+        response = client.get("/api/insights/?near=25.469,65.009&radius=1000")
+        items = response.get_json()["items"]
+        assert [item["id"] for item in items] == [2, 1, 3]
+        distances = [item["distance"] for item in items]
+        assert distances == sorted(distances)
+
+        response = client.get("/api/insights/?near=25.469,65.009&radius=400")
+        assert [item["id"] for item in response.get_json()["items"]] == [2, 1]
+
+        response = client.get("/api/insights/?near=25.469,65.009&k=5&ic=Outdoor")
+        assert [item["id"] for item in response.get_json()["items"]] == [2]
+
+        response = client.get("/api/insights/?near=0,0&k=1")
+        assert response.get_json()["items"][0]["distance"] > 3000000
+
+        response = client.post(
+            "/api/insights/",
+            json={"title": "Date line", "longitude": 179.999, "latitude": 0.0},
+        )
+        assert response.status_code == 201
+        response = client.get("/api/insights/?near=-179.999,0&radius=1000")
+        assert [item["title"] for item in response.get_json()["items"]] == ["Date line"]
+
+        for query in [
+            "near=25.4",
+            "near=200,0&k=1",
+            "near=0,0&radius=-1",
+            "near=25.47,65.01&k=1&cursor=WyJuZXh0IiwgMV0",
+        ]:
+            response = client.get("/api/insights/?" + query)
+            assert response.status_code == 400
+
+    def test_get_streamed(self, client):
+        """
+        Test that streamed collections carry the same items and controls as
+        buffered ones
+        """
+        urls = [
+            "/api/insights/?bbox=25.4,65.0,25.5,65.1&limit=2",
+            "/api/insights/?near=25.469,65.009&k=2",
+            "/api/users/?limit=2",
+            "/api/users/testuser2/insights/1/feedbacks/",
+            "/api/users/admin/insights/",
+        ]
+        buffered = [client.get(url).get_json() for url in urls]
+
+        client.application.config["STREAM_COLLECTIONS"] = True
+        for url, expected in zip(urls, buffered):
+            response = client.get(url)
+            assert response.status_code == 200
+            assert response.is_streamed
+            assert response.get_json() == expected
+
+        next_url = buffered[0]["@controls"]["next"]["href"]
+        body = client.get(next_url).get_json()
+        assert [item["id"] for item in body["items"]] == [3]
+        assert "next" not in body["@controls"]
+        assert "prev" in body["@controls"]
+
+    def test_get_projected(self, client):
+        """
+        Test that the collections select only the short-form columns and
+        still serialize the same short forms as the models
+        """
+        heavy = ("description", "external_link", "password", "profile_picture")
+        for url, model in [
+            ("/api/insights/?bbox=25.4,65.0,25.5,65.1", Insight),
+            ("/api/insights/?near=25.469,65.009&k=2", Insight),
+            ("/api/users/admin/insights/", Insight),
+            ("/api/users/", User),
+        ]:
+            cache.clear()
+            response, statements = get_with_statements(client, url)
+            assert response.status_code == 200
+            for sql in statements:
+                assert not [c for c in heavy if re.search(rf"\.{c}\b", sql)]
+
+            for item in response.get_json()["items"]:
+                if model is Insight:
+                    instance = db.session.get(Insight, item["id"])
+                else:
+                    instance = User.query.filter_by(username=item["username"]).one()
+                expected = json.loads(encode(instance.serialize(short_form=True)))
+                assert {key: item[key] for key in expected} == expected
+
+    def test_get_fieldset(self, client):
+        """
+        Test that fields and controls trim the items, the collection controls
+        and the selected columns
+        """
+        url = "/api/insights/?usr=testuser1&limit=1&fields=longitude,latitude"
+        response, statements = get_with_statements(client, url + "&controls=none")
+        assert response.status_code == 200
+        body = response.get_json()
+        assert list(body["@controls"]) == ["next"]
+        item = body["items"][0]
+        assert set(item) == {"@type", "id", "longitude", "latitude"}
+        page_sql = statements[-1]
+        assert "insight.title" not in page_sql
+        assert "user.username AS user" not in page_sql
+
+        body = client.get(url + "&controls=minimal").get_json()
+        assert list(body["@controls"]) == ["self", "next"]
+        assert list(body["items"][0]["@controls"]) == ["self"]
+        next_body = client.get(body["@controls"]["next"]["href"]).get_json()
+        assert set(next_body["items"][0]) == {"@controls", *item}
+
+        body = client.get(
+            "/api/insights/?near=25.469,65.009&k=2&fields=distance&controls=none"
+        ).get_json()
+        assert [set(item) for item in body["items"]] == [
+            {"@type", "id", "distance"}
+        ] * 2
+
+        body = client.get(
+            "/api/insights/?bbox=25.4,65.0,25.5,65.1&fields=category,id"
+        ).get_json()
+        for item in body["items"]:
+            assert set(item) == {"@type", "@controls", "id", "category"}
+            assert list(item["@controls"]) == ["self", "profile"]
+
+        for query in [
+            "fields=title,password",
+            "fields=",
+            "fields=distance",
+            "controls=some",
+        ]:
+            response = client.get("/api/insights/?usr=testuser1&" + query)
+            assert response.status_code == 400
+
+    def test_item_template_matches_builder(self, client):
+        """
+        Test that precompiled item templates render exactly what the
+        GeodataBuilder calls they replace produce
+        """
+        from flask import url_for
+        from geodata.utils import GeodataBuilder, encode
+        from geodata.resources.insight import insight_item_template
+        from geodata.resources.feedback import insight_feedback_item_template
+
+        insight = db.session.get(Insight, 1)
+        feedback = db.session.get(Feedback, 1)
+        with client.application.test_request_context("/"):
+            expected = GeodataBuilder(insight.serialize(short_form=True))
+            expected["@type"] = "insight"
+            expected.add_control("self", url_for("api.insight", insight=insight))
+            expected.add_control("profile", href="/profiles/insight/")
+            rendered = insight_item_template().render(
+                insight.serialize(short_form=True), id=insight.id
+            )
+            assert encode(rendered) == encode(expected)
+
+            expected = GeodataBuilder(feedback.serialize())
+            expected["@type"] = "feedback"
+            expected.add_control(
+                "self",
+                url_for(
+                    "api.feedback_by_insight",
+                    user=feedback.user,
+                    insight=insight,
+                    feedback=feedback,
+                ),
+            )
+            expected.add_control("profile", href="/profiles/feedback/")
+            rendered = insight_feedback_item_template().render(
+                feedback.serialize(),
+                username=feedback.user.username,
+                insight_id=insight.id,
+                id=feedback.id,
+            )
+            assert encode(rendered) == encode(expected)
+
+    def test_encoders_agree(self, client):
+        """
+        Test that the JSON encoders produce the same documents, with
+        ISO 8601 dates
+        """
+        bodies = []
+        for name in ENCODERS:
+            client.application.config["JSON_ENCODER"] = name
+            response = client.get("/api/insights/1/")
+            assert response.status_code == 200
+            bodies.append(response.get_json())
+            for stream in (False, True):
+                client.application.config["STREAM_COLLECTIONS"] = stream
+                response = client.get("/api/insights/?limit=2")
+                bodies.append(response.get_json())
+        assert all(body == bodies[index % 3] for index, body in enumerate(bodies))
+        assert bodies[1] == bodies[2]
+        created = bodies[0]["created_date"]
+        assert datetime.fromisoformat(created).isoformat() == created
+
+    def test_get_tile_cache(self, client):
+        """
+        Test that bbox queries are served from the tile cache and that
+        insight writes invalidate the tiles they touch
+        """
+        url = "/api/insights/?bbox=25.46,65.0,25.48,65.02"
+        response = client.get(url)
+        assert response.headers["X-Tile-Cache"] == "hits=0, misses=9"
+        first = response.get_json()
+        assert [item["id"] for item in first["items"]] == [1, 2, 3]
+
+        response = client.get(url)
+        assert response.headers["X-Tile-Cache"] == "hits=9, misses=0"
+        assert response.get_json() == first
+
+        response = client.get(url + "&ic=Outdoor")
+        assert "hits=0" in response.headers["X-Tile-Cache"]
+        assert [item["id"] for item in response.get_json()["items"]] == [2]
+
+        api_key_info = get_api_key_header(client, number=10)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        cached_insight = {
+            "title": "Cached",
+            "description": "Moves out of the cached tiles",
+            "longitude": 25.47,
+            "latitude": 65.01,
+            "category": "Testing",
+            "subcategory": "Cache",
+        }
+        response = client.post(
+            f"/api/users/{api_key_info['user']}/insights/",
+            headers=headers,
+            json=cached_insight,
+        )
+        insight_url = response.headers["Location"]
+        response = client.get(url)
+        assert response.headers["X-Tile-Cache"] == "hits=8, misses=1"
+        assert len(response.get_json()["items"]) == 4
+
+        response = client.get(url + "&limit=2")
+        body = response.get_json()
+        assert [item["id"] for item in body["items"]] == [1, 2]
+        body = client.get(body["@controls"]["next"]["href"]).get_json()
+        assert [item["id"] for item in body["items"]] == [3, 4]
+        body = client.get(body["@controls"]["prev"]["href"]).get_json()
+        assert [item["id"] for item in body["items"]] == [1, 2]
+
+        cached_insight["longitude"] = 25.0
+        response = client.put(insight_url, headers=headers, json=cached_insight)
+        assert response.status_code == 200
+        response = client.get(url)
+        assert response.headers["X-Tile-Cache"] == "hits=8, misses=1"
+        assert len(response.get_json()["items"]) == 3
+
+        response = client.get("/api/insights/?bbox=24.99,65.0,25.01,65.02")
+        assert [item["title"] for item in response.get_json()["items"]] == ["Cached"]
+        response = client.delete(insight_url, headers=headers)
+        assert response.status_code == 204
+        response = client.get("/api/insights/?bbox=24.99,65.0,25.01,65.02")
+        assert response.get_json()["items"] == []
+
+        response = client.get("/api/insights/?bbox=-180,-90,180,90")
+        assert "X-Tile-Cache" not in response.headers
+
+    def test_tile_cache_skips_dense_tiles(self, client, monkeypatch):
+        """
+        Test that bboxes with more insights than a tile may cache are served
+        by the paginated query instead of the tile cache
+        """
+        url = "/api/insights/?bbox=25.46,65.0,25.48,65.02&limit=2"
+        cached = client.get(url)
+        assert "X-Tile-Cache" in cached.headers
+        cache.clear()
+
+        monkeypatch.setattr(tiles, "MAX_TILE_ITEMS", 0)
+        for _ in range(2):
+            response, statements = get_with_statements(client, url)
+            assert "X-Tile-Cache" not in response.headers
+            assert response.get_json() == cached.get_json()
+        # the tiles are cached as dense, only the page is queried
+        assert len(statements) == 1
+
+    def test_tile_cache_follows_users(self, client):
+        """
+        Test that renaming or deleting a user invalidates the cached tiles
+        showing their username
+        """
+        api_key_info = get_api_key_header(client, number=11)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        response = client.post(
+            f"/api/users/{api_key_info['user']}/insights/",
+            headers=headers,
+            json={"title": "Authored", "longitude": 24.0, "latitude": 65.01},
+        )
+        assert response.status_code == 201
+
+        url = "/api/insights/?bbox=23.99,65.0,24.01,65.02"
+
+        def authors():
+            return [item["user"] for item in client.get(url).get_json()["items"]]
+
+        assert authors() == ["extrauser11"]
+        assert authors() == ["extrauser11"]
+
+        renamed = dict(get_user_json(11), username="renamed11")
+        response = client.put("/api/users/extrauser11/", headers=headers, json=renamed)
+        assert response.status_code == 204
+        assert authors() == ["renamed11"]
+
+        response = client.delete("/api/users/renamed11/", headers=headers)
+        assert response.status_code == 204
+        assert authors() == [None]
+
     def test_get_by_user_path(self, client):
         """
         Test getting insights via the user path
@@ -1026,3 +2013,508 @@ class TestInsightCollection:
             f"/api/users/{username}/insights/", headers=headers, data="not json"
         )
         assert response.status_code in [400, 415]
+
+    def test_bbox_follows_spatial_index(self, client):
+        """
+        Test that bbox queries see insight inserts, moves and deletes
+        through the R-tree, and that the index can be rebuilt
+        """
+        api_key_info = get_api_key_header(client, number=8)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        username = api_key_info["user"]
+        new_insight = {
+            "title": "Spatial Insight",
+            "description": "Moves around the map",
+            "longitude": 10.5,
+            "latitude": 50.5,
+            "category": "Testing",
+            "subcategory": "Spatial",
+        }
+
+        response = client.post(
+            f"/api/users/{username}/insights/", headers=headers, json=new_insight
+        )
+        assert response.status_code == 201
+        insight_url = response.headers["Location"]
+
+        response = client.get("/api/insights/?bbox=10,50,11,51")
+        assert [item["title"] for item in response.get_json()["items"]] == [
+            "Spatial Insight"
+        ]
+
+        moved_insight = new_insight.copy()
+        moved_insight["longitude"] = 12.5
+        response = client.put(insight_url, headers=headers, json=moved_insight)
+        assert response.status_code == 200
+
+        response = client.get("/api/insights/?bbox=10,50,11,51")
+        assert len(response.get_json()["items"]) == 0
+        response = client.get("/api/insights/?bbox=12,50,13,51")
+        assert len(response.get_json()["items"]) == 1
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["rebuild-spatial-index"])
+        assert "rebuilt with 4 insights" in result.output
+        response = client.get("/api/insights/?bbox=12,50,13,51")
+        assert len(response.get_json()["items"]) == 1
+
+        response = client.delete(insight_url, headers=headers)
+        assert response.status_code == 204
+        response = client.get("/api/insights/?bbox=12,50,13,51")
+        assert len(response.get_json()["items"]) == 0
+
+    def test_search_follows_writes(self, client):
+        """
+        Test that searches rank matches, combine with the other filters and
+        see insight inserts, edits and deletes through the full-text index
+        """
+
+        def search(query):
+            response = client.get("/api/insights/?" + query)
+            assert response.status_code == 200
+            return [item["title"] for item in response.get_json()["items"]]
+
+        # Title matches rank above description matches, the last word is a
+        # prefix and accents are ignored
+        assert search("q=park") == ["Beautiful Park", "Free Parking Area"]
+        assert search("q=coffee+wi") == ["Coffee Shop Recommendation"]
+        assert search("q=OULU&ic=Outdoor") == ["Beautiful Park"]
+        assert search("q=p%C3%A4rk&bbox=25.4,65.0,25.5,65.1") == search("q=park")
+        assert search("q=park&bbox=0,0,1,1") == []
+        assert search("q=park&usr=testuser1&fields=title&controls=none") == [
+            "Free Parking Area"
+        ]
+        for query in ["q=", "q=%22*%22", "q=(-)", "q=park&cursor=WyJuZXh0IiwgMV0"]:
+            response = client.get("/api/insights/?" + query)
+            assert response.status_code == 400
+
+        api_key_info = get_api_key_header(client, number=8)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        new_insight = {
+            "title": "Rooftop Sauna",
+            "description": "Public sauna with a view",
+            "longitude": 25.47,
+            "latitude": 65.01,
+            "category": "Outdoor",
+            "subcategory": "Sauna",
+        }
+        response = client.post(
+            f"/api/users/{api_key_info['user']}/insights/",
+            headers=headers,
+            json=new_insight,
+        )
+        assert response.status_code == 201
+        insight_url = response.headers["Location"]
+        assert search("q=sauna") == ["Rooftop Sauna"]
+
+        response = client.put(
+            insight_url, headers=headers, json=dict(new_insight, title="Harbour Pool")
+        )
+        assert response.status_code == 200
+        assert search("q=harbour") == ["Harbour Pool"]
+        assert search("q=rooftop") == []
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["rebuild-search-index"])
+        assert "rebuilt with 4 insights" in result.output
+        assert search("q=harbour") == ["Harbour Pool"]
+
+        response = client.delete(insight_url, headers=headers)
+        assert response.status_code == 204
+        assert search("q=harbour") == []
+
+
+class TestInsightClusters:
+    """
+    Test for precomputed insight clusters
+    """
+
+    RESOURCE_URL = "/api/insights/clusters/"
+
+    def test_get(self, client):
+        """
+        Test that clusters are counted per zoom level and follow insight
+        writes
+        """
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=0")
+        assert response.status_code == 200
+        body = response.get_json()
+        assert body["@type"] == "clusters"
+        template = body["@controls"]["geometa:insights-all"]["href"]
+        assert template.endswith(
+            "{?bbox,usr,ic,isc,near,radius,k,q,limit,cursor,fields,controls}"
+        )
+        assert len(body["items"]) == 1
+        cluster = body["items"][0]
+        assert cluster["count"] == 3
+        assert cluster["longitude"] == 25.469
+        assert {c["category"] for c in cluster["categories"]} == {
+            "Food & Drink",
+            "Outdoor",
+            "Infrastructure",
+        }
+        response = client.get(cluster["@controls"]["collection"]["href"])
+        assert len(response.get_json()["items"]) == 3
+
+        response = client.get(self.RESOURCE_URL + "?bbox=25.4,65.0,25.5,65.1&zoom=16")
+        assert sum(c["count"] for c in response.get_json()["items"]) == 3
+        assert len(response.get_json()["items"]) > 1
+
+        api_key_info = get_api_key_header(client, number=9)
+        headers = {"Authorization": api_key_info["Authorization"]}
+        username = api_key_info["user"]
+        new_insight = {
+            "title": "Far away",
+            "description": "Moves between clusters",
+            "longitude": -70.0,
+            "latitude": -30.0,
+            "category": "Outdoor",
+            "subcategory": "Mountain",
+        }
+        response = client.post(
+            f"/api/users/{username}/insights/", headers=headers, json=new_insight
+        )
+        insight_url = response.headers["Location"]
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=1")
+        counts = sorted(c["count"] for c in response.get_json()["items"])
+        assert counts == [1, 3]
+
+        new_insight["longitude"] = 25.0
+        new_insight["latitude"] = 65.0
+        response = client.put(insight_url, headers=headers, json=new_insight)
+        assert response.status_code == 200
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=1")
+        items = response.get_json()["items"]
+        assert [c["count"] for c in items] == [4]
+        outdoor = [c for c in items[0]["categories"] if c["category"] == "Outdoor"]
+        assert outdoor[0]["count"] == 2
+
+        response = client.delete(insight_url, headers=headers)
+        assert response.status_code == 204
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=12")
+        assert sum(c["count"] for c in response.get_json()["items"]) == 3
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["rebuild-spatial-index"])
+        assert "Cluster grid rebuilt" in result.output
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=0")
+        assert response.get_json()["items"][0]["count"] == 3
+
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90")
+        assert response.status_code == 400
+        response = client.get(self.RESOURCE_URL + "?bbox=-180,-90,180,90&zoom=17")
+        assert response.status_code == 400
+        response = client.get(self.RESOURCE_URL + "?zoom=3")
+        assert response.status_code == 400
+
+
+class TestInsightImport:
+    """
+    Tests for the bulk NDJSON insight import endpoint and CLI command
+    """
+
+    LINES = [
+        {"title": "Import 1", "longitude": 25.41, "latitude": 65.01},
+        "not json",
+        {"title": "Import 2", "longitude": 25.42, "latitude": 65.02},
+        {"longitude": 25.43, "latitude": 65.03},
+        {"title": "Far", "longitude": 250.0, "latitude": 65.0},
+        {"title": "Cat", "longitude": 25.44, "latitude": 65.04, "category": "Food"},
+        {
+            "title": "Import 3",
+            "longitude": 25.45,
+            "latitude": 65.05,
+            "category": "Food",
+            "subcategory": "Cafe",
+        },
+    ]
+
+    @classmethod
+    def ndjson(cls):
+        return "\n".join(
+            line if isinstance(line, str) else json.dumps(line) for line in cls.LINES
+        )
+
+    def test_post(self, client):
+        """
+        Test importing insights with valid and invalid lines
+        """
+        api_key_info = get_api_key_header(client, 30)
+        username = api_key_info["user"]
+        headers = {
+            "Authorization": api_key_info["Authorization"],
+            "Content-Type": "application/x-ndjson",
+        }
+        url = f"/api/users/{username}/insights/import/"
+
+        body = client.get(
+            f"/api/users/{username}/insights/", headers=headers
+        ).get_json()
+        assert body["@controls"]["geometa:import-insights"]["href"] == url
+
+        response = client.post(url, data=self.ndjson(), content_type="text/plain")
+        assert response.status_code == 415
+        response = client.post(
+            url, data=self.ndjson(), content_type="application/x-ndjson"
+        )
+        assert response.status_code == 401
+        response = client.post(
+            "/api/users/testuser1/insights/import/",
+            data=self.ndjson(),
+            headers=headers,
+        )
+        assert response.status_code == 403
+
+        response = client.post(url, data=self.ndjson(), headers=headers)
+        assert response.status_code == 200
+        report = response.get_json()
+        assert report["imported"] == 3
+        assert [error["line"] for error in report["errors"]] == [2, 4, 5, 6]
+
+        body = client.get(f"/api/users/{username}/insights/").get_json()
+        titles = {item["title"] for item in body["items"]}
+        assert titles == {"Import 1", "Import 2", "Import 3"}
+
+        # the triggers index the imported insights for bbox queries
+        response = client.get("/api/insights/?bbox=25.4,65.0,25.5,65.1&ic=Food")
+        assert [item["title"] for item in response.get_json()["items"]] == ["Import 3"]
+
+    def test_cli(self, client):
+        """
+        Test the import-insights command
+        """
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(
+            args=["import-insights", "-", "--user", "testuser1", "--batch-size", "2"],
+            input=self.ndjson(),
+        )
+        assert result.exit_code == 0
+        assert "Imported 3 insights, rejected 4 lines." in result.output
+        assert "line 5:" in result.output
+
+        body = client.get("/api/users/testuser1/insights/").get_json()
+        titles = {item["title"] for item in body["items"]}
+        assert {"Import 1", "Import 2", "Import 3"} <= titles
+
+        result = runner.invoke(args=["import-insights", "-", "--user", "nobody"])
+        assert result.exit_code != 0
+
+
+class TestSyntheticData:
+    """
+    Tests for the synthetic data generator
+    """
+
+    def test_deterministic(self):
+        """
+        Test that a seed always generates the same rows and that feedback
+        counts add up
+        """
+        data = SyntheticData(1, 20, 300, 2000)
+        batches = list(data.insight_batches(100))
+        assert batches == list(SyntheticData(1, 20, 300, 2000).insight_batches(100))
+        assert batches != list(SyntheticData(2, 20, 300, 2000).insight_batches(100))
+
+        insights = [row for rows, _ in batches for row in rows]
+        feedback = [row for _, rows in batches for row in rows]
+        assert len(insights) == 300 and len(feedback) == 2000
+        # Popularity is skewed: the top tenth of insights gets most feedback
+        counts = sorted(
+            (sum(f["insight_id"] == i["id"] for f in feedback) for i in insights),
+            reverse=True,
+        )
+        assert sum(counts[:30]) > 1000
+
+    def test_cli(self, client):
+        """
+        Test that generate-data inserts consistent data and keeps the spatial
+        index in sync
+        """
+        # Warm the tiles of the bbox and queue a feedback status, which
+        # must outlive the generation
+        response = client.get("/api/insights/?bbox=24.5,59.9,25.4,60.4&limit=1")
+        assert response.headers["X-Tile-Cache"]
+        assert not response.get_json()["items"]
+        cache.set(status_key("ticket"), {"state": "queued"})
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(
+            args=[
+                "generate-data",
+                *("--users", "20", "--insights", "300", "--feedback", "2000"),
+                *("--seed", "1", "--batch-size", "100"),
+            ]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Generated 20 users, 300 insights and 2000 feedback" in result.output
+
+        assert User.query.count() == 23
+        assert Insight.query.count() == 303
+        assert Feedback.query.filter_by(comment=None).count() < 2000
+        rated = db.session.query(
+            db.func.sum(Insight.rating_count), db.func.sum(Insight.rating_sum)
+        ).one()
+        recompute_rating_aggregates()
+        assert (
+            rated
+            == db.session.query(
+                db.func.sum(Insight.rating_count), db.func.sum(Insight.rating_sum)
+            ).one()
+        )
+
+        # Bbox queries see the generated insights, and the triggers are back
+        response = client.get("/api/insights/?bbox=24.5,59.9,25.4,60.4&limit=1")
+        assert response.get_json()["items"]
+        assert cache.get(status_key("ticket")) == {"state": "queued"}
+        response = client.get("/api/insights/clusters/?bbox=-180,-90,180,90&zoom=0")
+        clusters = response.get_json()["items"]
+        assert sum(cluster["count"] for cluster in clusters) == 303
+        response = client.post(
+            "/api/insights/",
+            json={"title": "After", "longitude": 100.5, "latitude": 13.7},
+        )
+        assert response.status_code == 201
+        response = client.get("/api/insights/?bbox=100,13,101,14")
+        assert [item["title"] for item in response.get_json()["items"]] == ["After"]
+
+
+class TestMetrics:
+    """
+    Tests for the request metrics and their Prometheus endpoint
+    """
+
+    def test_rows_counted_on_every_connection(self):
+        """
+        Test that connections pooled before the metrics were set up count
+        their rows too
+        """
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                "TESTING": True,
+                "METRICS_ENABLED": False,
+            }
+        )
+        with app.app_context():
+            with db.engine.connect():
+                pass
+            app.config["METRICS_ENABLED"] = True
+            metrics.init_app(app, db)
+            with db.engine.connect() as connection:
+                dbapi_connection = connection.connection.dbapi_connection
+                assert dbapi_connection.row_factory is metrics._count_row
+            db.engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    def test_get(self, client):
+        """
+        Test that requests are measured per endpoint and that the metrics of
+        every process writing to METRICS_DIR are summed
+        """
+        metrics_dir = tempfile.mkdtemp()
+        app = client.application
+        other = None
+        try:
+            app.extensions["metrics"].directory = metrics_dir
+            for _ in range(3):
+                assert client.get("/api/insights/?usr=testuser1").status_code == 200
+            assert client.get("/api/insights/100/").status_code == 404
+
+            # Another worker process on the same database and directory
+            other = create_app(
+                {
+                    "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+                    "TESTING": True,
+                    "CACHE_TYPE": "SimpleCache",
+                    "METRICS_DIR": metrics_dir,
+                }
+            )
+            other_client = other.test_client()
+            assert other_client.get("/api/insights/?usr=testuser1").status_code == 200
+            other.extensions["metrics"].flush(force=True)
+            # A worker that has exited, whose pid is beyond any pid in use
+            with open(os.path.join(metrics_dir, "metrics-4194305-x.json"), "w") as f:
+                json.dump(
+                    {
+                        "counters": [
+                            ["geodata_password_hashes_total", [], 100],
+                            ["geodata_feedback_queue_depth", [], 100],
+                        ],
+                        "histograms": [],
+                    },
+                    f,
+                )
+
+            response = client.get("/metrics")
+            assert response.status_code == 200
+            assert response.content_type.startswith("text/plain; version=0.0.4")
+            text = response.get_data(as_text=True)
+            labels = 'endpoint="api.insights",method="GET"'
+            assert f'geodata_http_requests_total{{{labels},status="200"}} 4' in text
+            # Unknown ids are rejected while the URL is matched
+            assert (
+                'geodata_http_requests_total{endpoint="unmatched",'
+                'method="GET",status="404"} 1'
+            ) in text
+            assert f"geodata_http_request_duration_seconds_count{{{labels}}} 4" in text
+            assert (
+                f'geodata_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 4'
+                in text
+            )
+
+            samples = {}
+            for line in text.splitlines():
+                if line.startswith("geodata_") and labels in line:
+                    name, value = line.rsplit(" ", 1)
+                    samples[name] = float(value)
+            assert samples[f"geodata_db_queries_per_request_sum{{{labels}}}"] >= 4
+            assert samples[f"geodata_db_rows_fetched_total{{{labels}}}"] >= 8
+            assert samples[f"geodata_serialization_seconds_total{{{labels}}}"] > 0
+            assert "# TYPE geodata_tile_cache_requests_total counter" in text
+            hashes = re.search(r"^geodata_password_hashes_total (\S+)$", text, re.M)
+            assert float(hashes.group(1)) >= 100
+            assert "geodata_feedback_queue_depth 100" not in text
+            assert 'geodata_tile_cache_requests_total{result="hit"}' in text
+        finally:
+            # Keep the exit flush from writing to the removed directory
+            for instance in (app, other):
+                if instance is not None:
+                    instance.extensions["metrics"].directory = None
+            shutil.rmtree(metrics_dir)
+
+
+class TestSqliteProfile:
+    """
+    Tests for the production SQLite engine profile
+    """
+
+    def test_pragmas(self):
+        """
+        Test that the pragmas are applied to every connection
+        """
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                "TESTING": True,
+                "SQLITE_PRAGMAS": PRODUCTION_PRAGMAS,
+                "SQLALCHEMY_ENGINE_OPTIONS": PRODUCTION_ENGINE_OPTIONS,
+            }
+        )
+        with app.app_context():
+            with db.engine.connect() as connection:
+                pragma = lambda name: connection.exec_driver_sql(
+                    f"PRAGMA {name}"
+                ).scalar()
+                assert pragma("journal_mode") == "wal"
+                assert pragma("busy_timeout") == 5000
+                assert pragma("synchronous") == 1
+                assert pragma("temp_store") == 2
+            assert db.engine.pool.size() == PRODUCTION_ENGINE_OPTIONS["pool_size"]
+            # Dropped in forked children by the one module level callback
+            assert db.engine in _fork_engines
+            db.engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
@@ -0,0 +1,92 @@
+"""
+Benchmark the JSON encoders of Mason responses on an insight collection.
+
+Usage: python bench/bench_encoders.py [--items 10000] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from geodata import create_app
+from geodata.models import Insight
+from geodata.resources.insight import insight_item_template
+from geodata.utils import ENCODERS, GeodataBuilder
+
+
+def build_collection(count):
+    """
+    Return an insight collection body with count short-form items, rendered
+    the same way InsightCollection renders them.
+    """
+    template = insight_item_template()
+    start = datetime(2025, 1, 1, 12, 0, 0)
+    body = GeodataBuilder()
+    body["@type"] = "insights"
+    body["items"] = []
+    for index in range(count):
+        insight = Insight(
+            id=index + 1,
+            title=f"Insight {index}",
+            longitude=25.0 + index * 1e-4,
+            latitude=65.0 + index * 1e-4,
+            category="Food & Drink",
+            created_date=start + timedelta(seconds=index, microseconds=index),
+            rating_count=index % 7,
+            rating_sum=(index % 7) * 3,
+        )
+        body["items"].append(
+            template.render(insight.serialize(short_form=True), id=insight.id)
+        )
+    return body
+
+
+def isoformat_dates(body):
+    """
+    Return a copy of body with the dates already formatted, as serialize()
+    used to produce them for the standard library encoder.
+    """
+    items = []
+    for item in body["items"]:
+        item = dict(item)
+        item["created_date"] = item["created_date"].isoformat()
+        items.append(item)
+    return dict(body, items=items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app(
+        {"SQLALCHEMY_DATABASE_URI": "sqlite://", "CACHE_TYPE": "SimpleCache"}
+    )
+    with app.test_request_context("/api/insights/"):
+        body = build_collection(args.items)
+
+    cases = [("json, isoformat in serialize", ENCODERS["json"], isoformat_dates)]
+    cases += [(name, encoder, lambda body: body) for name, encoder in ENCODERS.items()]
+
+    print(f"{args.items} items, best of {args.repeat} runs")
+    baseline = None
+    for name, encoder, prepare in cases:
+        best = min(
+            timeit.repeat(lambda: encoder(prepare(body)), number=1, repeat=args.repeat)
+        )
+        baseline = baseline or best
+        size = len(encoder(prepare(body)))
+        print(
+            f"{name:30} {best * 1000:8.1f} ms {baseline / best:6.1f}x {size:10} bytes"
+        )
+    if "orjson" not in ENCODERS:
+        print("orjson is not installed, install it with pip install geodata[fast]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,580 @@
+"""
+Benchmark every API route through the Flask test client against a large
+synthetic database, and compare the results with a baseline.
+
+Every route and method of geodata/api.py has a scenario below, and routes
+without one are reported so that new routes do not go unmeasured. Each
+scenario is warmed up and then timed for --requests requests, counting the
+SQL statements of every request. A second, shorter pass under tracemalloc
+measures the peak memory allocated while serving a request, so that tracing
+does not slow down the timed pass. Scenarios that need a fresh target, such
+as deletes, create it before the request, outside the measurement.
+
+Results are printed and can be written to JSON with --output. With
+--baseline, every scenario whose latency percentile (--metric), query count
+or allocations grew by more than --tolerance over the baseline is reported
+as a regression and the script exits with status 1.
+
+The database is generated with geodata.synthetic. Pass --db to keep it and
+reuse it in later runs, as generating a large one takes a while.
+
+Usage: python bench/bench_endpoints.py [--insights 50000] [--requests 50]
+           [--output results.json] [--baseline baseline.json] [--tolerance 0.2]
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PIL import Image
+from sqlalchemy import event, func, select
+from geodata import cache, create_app, db
+from geodata.blobs import store_blob
+from geodata.feedback_queue import STATUS_TIMEOUT, status_key
+from geodata.models import ApiKey, Feedback, Insight, User
+from geodata.sqlite import PRODUCTION_ENGINE_OPTIONS, PRODUCTION_PRAGMAS
+from geodata.synthetic import generate_data
+
+# Route methods that cannot be benchmarked, with the reason
+SKIPPED = {
+    ("api.feedbacks_by_user", "POST"): "feedback is posted under an insight",
+}
+
+METRICS = ("p50_ms", "p95_ms", "p99_ms")
+
+ADMIN_KEY = "bench-admin-key"
+USER_KEY = "bench-user-key"
+
+
+class Context:
+    """
+    Ids of the rows the scenarios request, picked from the generated data,
+    and helpers to create throwaway rows.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.counter = itertools.count()
+        with app.app_context():
+            # The busiest user and their most rated insight
+            self.user_id, self.username = db.session.execute(
+                select(User.id, User.username)
+                .join(Insight, Insight.creator == User.id)
+                .group_by(User.id)
+                .order_by(func.count(Insight.id).desc())
+                .limit(1)
+            ).one()
+            insight = db.session.execute(
+                select(Insight)
+                .where(Insight.creator == self.user_id)
+                .order_by(Insight.rating_count.desc())
+                .limit(1)
+            ).scalar_one()
+            self.insight_id = insight.id
+            self.point = (insight.longitude, insight.latitude)
+            self.feedback_id = db.session.execute(
+                select(Feedback.id)
+                .where(Feedback.insight_id == self.insight_id)
+                .order_by(Feedback.id)
+                .limit(1)
+            ).scalar_one()
+            self.rater = db.session.execute(
+                select(User.username)
+                .join(Feedback, Feedback.user_id == User.id)
+                .group_by(User.id)
+                .order_by(func.count(Feedback.id).desc())
+                .limit(1)
+            ).scalar_one()
+
+            admin = User.query.filter_by(username="bench_admin").first()
+            if admin is None:
+                admin = User(
+                    username="bench_admin",
+                    email="bench_admin@example.com",
+                    password="-",
+                    first_name="Bench",
+                    role="ADMIN",
+                )
+                db.session.add(admin)
+                db.session.flush()
+            for key, user_id, is_admin in (
+                (ADMIN_KEY, admin.id, True),
+                (USER_KEY, self.user_id, False),
+            ):
+                if db.session.get(ApiKey, ApiKey.key_hash(key)) is None:
+                    db.session.add(
+                        ApiKey(
+                            key=ApiKey.key_hash(key), user_id=user_id, admin=is_admin
+                        )
+                    )
+            db.session.commit()
+
+            buffer = io.BytesIO()
+            Image.new("RGB", (256, 256), "teal").save(buffer, format="PNG")
+            self.picture = store_blob(buffer.getvalue(), "png")
+
+            self.ticket = "bench"
+            cache.set(
+                status_key(self.ticket),
+                {
+                    "state": "committed",
+                    "feedback": self.feedback_id,
+                    "insight": self.insight_id,
+                    "username": self.username,
+                },
+                timeout=STATUS_TIMEOUT,
+            )
+
+    def auth(self, key=USER_KEY):
+        return {"Authorization": f"Bearer {key}"}
+
+    def bbox(self, size):
+        lon, lat = self.point
+        return f"{lon - size},{lat - size},{lon + size},{lat + size}"
+
+    def unique(self, prefix):
+        return f"{prefix}{os.getpid()}x{next(self.counter)}"
+
+    def create(self, model, **columns):
+        with self.app.app_context():
+            row = model(**columns)
+            db.session.add(row)
+            db.session.commit()
+            return row.id
+
+    def create_user(self):
+        name = self.unique("bench")
+        return name, self.create(
+            User,
+            username=name,
+            email=f"{name}@example.com",
+            password="-",
+            first_name="Bench",
+        )
+
+    def create_insight(self):
+        lon, lat = self.point
+        return self.create(
+            Insight, title="Bench", longitude=lon, latitude=lat, creator=self.user_id
+        )
+
+
+def insight_body(ctx):
+    lon, lat = ctx.point
+    return {
+        "title": "Benchmark insight",
+        "description": "Posted by the benchmark",
+        "longitude": lon,
+        "latitude": lat,
+        "category": "Food & Drink",
+        "subcategory": "Cafe",
+    }
+
+
+def import_body(ctx, lines=100):
+    return "\n".join(json.dumps(insight_body(ctx)) for _ in range(lines))
+
+
+def _user_put(ctx):
+    return {
+        "username": ctx.username,
+        "email": f"{ctx.username}@example.com",
+        "password": "password",
+        "first_name": "Bench",
+    }
+
+
+def _new_user(ctx):
+    name = ctx.unique("new")
+    return {
+        "username": name,
+        "email": f"{name}@example.com",
+        "password": "password",
+        "first_name": "New",
+    }
+
+
+def _delete_user(ctx):
+    name, _ = ctx.create_user()
+    return {"path": f"/api/users/{name}/", "headers": ctx.auth(ADMIN_KEY)}
+
+
+def _delete_insight(ctx, by_user):
+    insight_id = ctx.create_insight()
+    prefix = f"/api/users/{ctx.username}" if by_user else "/api"
+    return {"path": f"{prefix}/insights/{insight_id}/", "headers": ctx.auth()}
+
+
+def _delete_feedback(ctx, by_insight):
+    feedback_id = ctx.create(
+        Feedback, insight_id=ctx.insight_id, user_id=ctx.user_id, comment="Bench"
+    )
+    if by_insight:
+        path = (
+            f"/api/users/{ctx.username}/insights/{ctx.insight_id}"
+            f"/feedbacks/{feedback_id}/"
+        )
+    else:
+        path = f"/api/users/{ctx.username}/feedbacks/{feedback_id}/"
+    return {"path": path, "headers": ctx.auth()}
+
+
+# (endpoint, method, scenario name) -> function returning the request's
+# test client arguments. Reads come first, as writes change the data.
+SCENARIOS = {
+    ("api.users", "GET", "users"): lambda ctx: {"path": "/api/users/?limit=100"},
+    ("api.user", "GET", "user"): lambda ctx: {"path": f"/api/users/{ctx.username}/"},
+    ("api.user", "GET", "user as owner"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/",
+        "headers": ctx.auth(),
+    },
+    ("api.insights", "GET", "insights bbox"): lambda ctx: {
+        "path": f"/api/insights/?bbox={ctx.bbox(0.02)}"
+    },
+    ("api.insights", "GET", "insights bbox category"): lambda ctx: {
+        "path": f"/api/insights/?bbox={ctx.bbox(0.1)}&ic=Food%20%26%20Drink"
+    },
+    ("api.insights", "GET", "insights near k"): lambda ctx: {
+        "path": "/api/insights/?near={},{}&k=20".format(*ctx.point)
+    },
+    ("api.insights", "GET", "insights by usr"): lambda ctx: {
+        "path": f"/api/insights/?usr={ctx.username}"
+    },
+    ("api.insights", "GET", "insights search"): lambda ctx: {
+        "path": "/api/insights/?q=cafe"
+    },
+    ("api.insights", "GET", "insights search words"): lambda ctx: {
+        "path": "/api/insights/?q=bakery+hel"
+    },
+    ("api.insights", "GET", "insights search bbox"): lambda ctx: {
+        "path": f"/api/insights/?q=cafe&bbox={ctx.bbox(0.1)}"
+    },
+    ("api.insights_by", "GET", "user insights"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/"
+    },
+    ("api.insight_clusters", "GET", "clusters"): lambda ctx: {
+        "path": f"/api/insights/clusters/?bbox={ctx.bbox(1.0)}&zoom=8"
+    },
+    ("api.insight", "GET", "insight"): lambda ctx: {
+        "path": f"/api/insights/{ctx.insight_id}/"
+    },
+    ("api.insight_by", "GET", "user insight"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/{ctx.insight_id}/"
+    },
+    ("api.feedbacks_by_insight", "GET", "insight feedbacks"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/{ctx.insight_id}/feedbacks/"
+    },
+    ("api.feedbacks_by_user", "GET", "user feedbacks"): lambda ctx: {
+        "path": f"/api/users/{ctx.rater}/feedbacks/"
+    },
+    ("api.feedback_by_insight", "GET", "insight feedback"): lambda ctx: {
+        "path": (
+            f"/api/users/{ctx.username}/insights/{ctx.insight_id}"
+            f"/feedbacks/{ctx.feedback_id}/"
+        )
+    },
+    ("api.feedback_by_user", "GET", "user feedback"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/feedbacks/{ctx.feedback_id}/",
+        "headers": ctx.auth(ADMIN_KEY),
+    },
+    ("api.feedback_status", "GET", "feedback status"): lambda ctx: {
+        "path": f"/api/feedback-status/{ctx.ticket}/"
+    },
+    ("api.picture", "GET", "picture"): lambda ctx: {
+        "path": f"/api/pictures/{ctx.picture}"
+    },
+    ("api.insights", "POST", "post insight"): lambda ctx: {
+        "path": "/api/insights/",
+        "json": insight_body(ctx),
+    },
+    ("api.insights_by", "POST", "post user insight"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/",
+        "json": insight_body(ctx),
+        "headers": ctx.auth(),
+    },
+    ("api.insight_import", "POST", "import 100 insights"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/import/",
+        "data": import_body(ctx),
+        "content_type": "application/x-ndjson",
+        "headers": ctx.auth(),
+    },
+    ("api.insight", "PUT", "put insight"): lambda ctx: {
+        "path": f"/api/insights/{ctx.insight_id}/",
+        "json": insight_body(ctx),
+        "headers": ctx.auth(),
+    },
+    ("api.insight_by", "PUT", "put user insight"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/{ctx.insight_id}/",
+        "json": insight_body(ctx),
+        "headers": ctx.auth(),
+    },
+    ("api.feedbacks_by_insight", "POST", "post feedback"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/insights/{ctx.insight_id}/feedbacks/",
+        "json": {"rating": 4, "comment": "Benchmark"},
+        "headers": ctx.auth(),
+    },
+    ("api.feedback_by_insight", "PUT", "put insight feedback"): lambda ctx: {
+        "path": (
+            f"/api/users/{ctx.username}/insights/{ctx.insight_id}"
+            f"/feedbacks/{ctx.feedback_id}/"
+        ),
+        "json": {"rating": 3, "comment": "Benchmark"},
+        "headers": ctx.auth(ADMIN_KEY),
+    },
+    ("api.feedback_by_user", "PUT", "put user feedback"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/feedbacks/{ctx.feedback_id}/",
+        "json": {"rating": 2, "comment": "Benchmark"},
+        "headers": ctx.auth(ADMIN_KEY),
+    },
+    ("api.users", "POST", "post user"): lambda ctx: {
+        "path": "/api/users/",
+        "json": _new_user(ctx),
+    },
+    ("api.user", "PUT", "put user"): lambda ctx: {
+        "path": f"/api/users/{ctx.username}/",
+        "json": _user_put(ctx),
+        "headers": ctx.auth(),
+    },
+    ("api.insight", "DELETE", "delete insight"): lambda ctx: _delete_insight(
+        ctx, False
+    ),
+    ("api.insight_by", "DELETE", "delete user insight"): lambda ctx: (
+        _delete_insight(ctx, True)
+    ),
+    ("api.feedback_by_insight", "DELETE", "delete insight feedback"): lambda ctx: (
+        _delete_feedback(ctx, True)
+    ),
+    ("api.feedback_by_user", "DELETE", "delete user feedback"): lambda ctx: (
+        _delete_feedback(ctx, False)
+    ),
+    ("api.user", "DELETE", "delete user"): _delete_user,
+}
+
+
+def unbenchmarked_routes(app):
+    """
+    Return the (endpoint, method) pairs of API routes without a scenario.
+    """
+    covered = {(endpoint, method) for endpoint, method, _ in SCENARIOS}
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if not rule.endpoint.startswith("api."):
+            continue
+        for method in sorted(rule.methods - {"HEAD", "OPTIONS"}):
+            key = (rule.endpoint, method)
+            if key not in covered and key not in SKIPPED:
+                missing.append(key)
+    return missing
+
+
+def percentile(cuts, point):
+    return round(cuts[point - 1] * 1000, 3)
+
+
+def run_scenario(client, ctx, method, make_request, queries, requests, warmup, alloc):
+    """
+    Time a scenario and return its result.
+    """
+    statuses = set()
+
+    def send():
+        kwargs = make_request(ctx)
+        queries[0] = 0
+        start = time.perf_counter()
+        response = client.open(method=method, **kwargs)
+        elapsed = time.perf_counter() - start
+        statuses.add(response.status_code)
+        response.close()
+        return elapsed, queries[0]
+
+    for _ in range(warmup):
+        send()
+    latencies, counts = zip(*(send() for _ in range(requests)))
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc):
+            kwargs = make_request(ctx)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            client.open(method=method, **kwargs).close()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "method": method,
+        "requests": requests,
+        "statuses": sorted(statuses),
+        "p50_ms": percentile(cuts, 50),
+        "p95_ms": percentile(cuts, 95),
+        "p99_ms": percentile(cuts, 99),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "queries": round(statistics.fmean(counts), 2),
+        "max_queries": max(counts),
+        "alloc_peak_kib": round(statistics.median(peaks) / 1024, 1) if peaks else None,
+    }
+
+
+def compare(results, baseline, metric, tolerance):
+    """
+    Return the regressions of results against a baseline as messages.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in (metric, "queries", "alloc_peak_kib"):
+            old, new = base.get(key), result.get(key)
+            if old is None or new is None:
+                continue
+            # Allow a small absolute slack so tiny numbers don't flap
+            if new > old * (1 + tolerance) + (0.05 if key == metric else 0):
+                regressions.append(f"{name}: {key} {old} -> {new}")
+    return regressions
+
+
+def prepare_database(path, args):
+    app = make_app(path, args.blob_dir)
+    with app.app_context():
+        db.create_all()
+        if User.query.first() is None:
+            print(
+                f"Generating {args.users} users, {args.insights} insights and "
+                f"{args.feedback} feedback..."
+            )
+            generate_data(args.seed, args.users, args.insights, args.feedback)
+        db.engine.dispose()
+
+
+def make_app(path, blob_dir):
+    return create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path,
+            "SQLITE_PRAGMAS": PRODUCTION_PRAGMAS,
+            "SQLALCHEMY_ENGINE_OPTIONS": PRODUCTION_ENGINE_OPTIONS,
+            "CACHE_TYPE": "SimpleCache",
+            "BLOB_DIR": blob_dir,
+            "THUMBNAIL_WORKERS": 0,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--insights", type=int, default=50000)
+    parser.add_argument("--feedback", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database file to reuse or create and keep")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--alloc-requests", type=int, default=5)
+    parser.add_argument("--only", help="run the scenarios whose name contains this")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--metric", choices=METRICS, default="p95_ms")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    args.blob_dir = os.path.join(directory, "blobs")
+    path = args.db or os.path.join(directory, "bench.db")
+    try:
+        prepare_database(path, args)
+        app = make_app(path, args.blob_dir)
+        app.logger.disabled = True
+
+        missing = unbenchmarked_routes(app)
+        for endpoint, method in missing:
+            print(f"warning: no scenario for {method} {endpoint}", file=sys.stderr)
+
+        with app.app_context():
+            engine = db.engine
+        queries = [0]
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def count_query(*args):
+            queries[0] += 1
+
+        ctx = Context(app)
+        client = app.test_client()
+        results = {}
+        print(
+            f"{'scenario':28} {'status':>8} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'queries':>8} {'alloc KiB':>10}"
+        )
+        for (endpoint, method, name), make_request in SCENARIOS.items():
+            if args.only and args.only not in name:
+                continue
+            result = run_scenario(
+                client,
+                ctx,
+                method,
+                make_request,
+                queries,
+                args.requests,
+                args.warmup,
+                args.alloc_requests,
+            )
+            result["endpoint"] = endpoint
+            results[name] = result
+            print(
+                f"{name:28} {','.join(map(str, result['statuses'])):>8} "
+                f"{result['p50_ms']:8.2f} {result['p95_ms']:8.2f} "
+                f"{result['p99_ms']:8.2f} {result['queries']:8.1f} "
+                f"{result['alloc_peak_kib'] or 0:10.1f}"
+            )
+
+        report = {
+            "meta": {
+                "date": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "users": args.users,
+                "insights": args.insights,
+                "feedback": args.feedback,
+                "seed": args.seed,
+                "requests": args.requests,
+                "unbenchmarked": [" ".join(key) for key in missing],
+            },
+            "results": results,
+        }
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output:
+                json.dump(report, output, indent=2)
+
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as baseline:
+                regressions = compare(
+                    results,
+                    json.load(baseline)["results"],
+                    args.metric,
+                    args.tolerance,
+                )
+            for regression in regressions:
+                print(f"regression: {regression}")
+            if regressions:
+                sys.exit(1)
+            print(f"No regressions over {args.tolerance:.0%} against the baseline.")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark concurrent feedback writes to SQLite from several processes, with
+and without the production engine profile.
+
+Every process stands in for a gunicorn worker: it creates the app and,
+through a test client, posts feedback and reads the feedback collection
+back as fast as it can. Failed requests, mostly "database is locked", are
+counted as errors. The database starts from a
+copy of the same populated file for both profiles.
+
+Usage: python bench/bench_sqlite_writes.py [--workers 3] [--requests 300]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from geodata import create_app, db
+from geodata.models import Insight, User
+from geodata.sqlite import PRODUCTION_ENGINE_OPTIONS, PRODUCTION_PRAGMAS
+
+PROFILES = {
+    "default": {},
+    "production": {
+        "SQLITE_PRAGMAS": PRODUCTION_PRAGMAS,
+        "SQLALCHEMY_ENGINE_OPTIONS": PRODUCTION_ENGINE_OPTIONS,
+    },
+}
+
+
+def make_app(path, profile):
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path,
+        "CACHE_TYPE": "SimpleCache",
+        "PROPAGATE_EXCEPTIONS": False,
+    }
+    config.update(PROFILES[profile])
+    return create_app(config)
+
+
+def worker(path, profile, requests, start, results):
+    app = make_app(path, profile)
+    app.logger.disabled = True
+    client = app.test_client()
+    errors = 0
+    start.wait()
+    begin = time.perf_counter()
+    for index in range(requests):
+        response = client.post(
+            "/api/users/bench/insights/1/feedbacks/",
+            json={"rating": index % 5 + 1, "comment": "Benchmark"},
+        )
+        if response.status_code != 201:
+            errors += 1
+        # Readers poll the insight and its feedback between the writes
+        response = client.get("/api/users/bench/insights/1/feedbacks/?limit=50")
+        if response.status_code != 200:
+            errors += 1
+    results.put((errors, time.perf_counter() - begin))
+
+
+def run(path, profile, workers, requests):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=worker, args=(path, profile, requests, start, results)
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(1)
+    begin = time.perf_counter()
+    start.set()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - begin
+    for process in processes:
+        process.join()
+    errors = sum(outcome[0] for outcome in outcomes)
+    return workers * requests, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, "template.db")
+        app = make_app(template, "default")
+        with app.app_context():
+            db.create_all()
+            user = User(
+                username="bench",
+                email="bench@example.com",
+                password="-",
+                first_name="Bench",
+            )
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(
+                Insight(
+                    title="Benchmark", longitude=25.0, latitude=65.0, creator=user.id
+                )
+            )
+            db.session.commit()
+            db.engine.dispose()
+
+        print(f"{args.workers} processes x {args.requests} feedback posts")
+        for profile in PROFILES:
+            path = os.path.join(directory, f"{profile}.db")
+            shutil.copy(template, path)
+            posted, errors, elapsed = run(path, profile, args.workers, args.requests)
+            print(
+                f"{profile:12} {posted / elapsed:8.0f} posts/s "
+                f"{errors:6} errors {elapsed:8.2f} s"
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ from flasgger import Swagger
 from flask import Flask, send_from_directory
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
+from . import metrics, sqlite
 
 
 db = SQLAlchemy()
@@ -22,6 +23,9 @@ def create_app(test_config=None):
     if test_config is None:
         filepath = os.path.abspath(os.getcwd()) + "/db/geodata.db"
         app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + filepath
+        # Production SQLite profile for several gunicorn workers
+        app.config["SQLITE_PRAGMAS"] = sqlite.PRODUCTION_PRAGMAS
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = sqlite.PRODUCTION_ENGINE_OPTIONS
 
         app.config["SWAGGER"] = {
             "title": "Crowdsourced local insights API",
@@ -30,27 +34,72 @@ def create_app(test_config=None):
             "doc_dir": "./geodata/doc",
         }
         Swagger(app, template_file="doc/swagger_base.yml")
-    else:
-        app.config["SQLALCHEMY_DATABASE_URI"] = test_config["SQLALCHEMY_DATABASE_URI"]
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["CACHE_TYPE"] = "FileSystemCache"
     app.config["CACHE_DIR"] = os.path.join(app.instance_path, "cache")
+    app.config["CACHE_THRESHOLD"] = 10000
+    app.config["TILE_CACHE_TIMEOUT"] = 300
+    # Stream collection responses item by item instead of building them whole
+    app.config["STREAM_COLLECTIONS"] = False
+    # API keys resolved in the last AUTH_CACHE_TTL seconds skip the database
+    app.config["AUTH_CACHE_SIZE"] = 1024
+    app.config["AUTH_CACHE_TTL"] = 60
+    # Werkzeug hash method and cost of passwords and the hashing pool, see
+    # geodata.hashing
+    app.config["PASSWORD_HASH_METHOD"] = "scrypt:32768:8:1"
+    app.config["PASSWORD_HASH_WORKERS"] = 2
+    app.config["PASSWORD_HASH_QUEUE_SIZE"] = 64
+    # Profile picture blob store, see geodata.blobs
+    app.config["BLOB_DIR"] = os.path.join(app.instance_path, "blobs")
+    app.config["THUMBNAIL_WORKERS"] = 2
+    app.config["PICTURE_MAX_AGE"] = 31536000
+    # Encoder of Mason responses, see geodata.utils.ENCODERS
+    app.config["JSON_ENCODER"] = "orjson"
+    # Commit posted feedback in groups behind the request, see
+    # geodata.feedback_queue
+    app.config["FEEDBACK_WRITE_BEHIND"] = False
+    app.config["FEEDBACK_GROUP_SIZE"] = 50
+    app.config["FEEDBACK_GROUP_DELAY"] = 0.05
+    app.config["FEEDBACK_QUEUE_SIZE"] = 10000
+    # Request and SQL metrics at /metrics, summed over the processes writing
+    # to METRICS_DIR, see geodata.metrics
+    app.config["METRICS_ENABLED"] = True
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+    app.config["METRICS_FLUSH_INTERVAL"] = 1.0
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     db.init_app(app)
+    sqlite.configure_engine(app, db)
+    metrics.init_app(app, db)
     cache.init_app(app)
 
     from .utils import UserConverter, InsightConverter, FeedbackConverter
     from geodata.api_init import api_bp
     from . import api
+    from . import auth
+    from . import blobs
+    from . import importer
     from . import models
+    from . import search
+    from . import spatial
+    from . import synthetic
 
     app.url_map.converters["user"] = UserConverter
     app.url_map.converters["insight"] = InsightConverter
     app.url_map.converters["feedback"] = FeedbackConverter
     app.register_blueprint(api_bp)
+    app.before_request(auth.reset_authentication)
 
     app.cli.add_command(models.create_admin)
     app.cli.add_command(models.init_db_command)
     app.cli.add_command(models.populate_db_command)
+    app.cli.add_command(models.recompute_ratings_command)
+    app.cli.add_command(models.migrate_db_command)
+    app.cli.add_command(spatial.rebuild_spatial_index_command)
+    app.cli.add_command(search.rebuild_search_index_command)
+    app.cli.add_command(importer.import_insights_command)
+    app.cli.add_command(blobs.migrate_pictures_command)
+    app.cli.add_command(synthetic.generate_data_command)
 
     @app.route("/profiles/<resource>/")
     def send_profile_html(resource):
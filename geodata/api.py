@@ -4,13 +4,25 @@ This module set api resource route.
 
 from .api_init import api
 from .resources.user import UserCollection, UserItem
-from .resources.insight import InsightCollection, InsightItem
-from .resources.feedback import FeedbackCollection, FeedbackItem
+from .resources.insight import (
+    InsightCollection,
+    InsightClusterCollection,
+    InsightImport,
+    InsightItem,
+)
+from .resources.feedback import FeedbackCollection, FeedbackItem, FeedbackStatus
+from .resources.picture import Picture
 
 api.add_resource(InsightCollection, "/insights/", endpoint="insights")
 api.add_resource(
     InsightCollection, "/users/<user:user>/insights/", endpoint="insights_by"
 )
+api.add_resource(
+    InsightClusterCollection, "/insights/clusters/", endpoint="insight_clusters"
+)
+api.add_resource(
+    InsightImport, "/users/<user:user>/insights/import/", endpoint="insight_import"
+)
 api.add_resource(InsightItem, "/insights/<insight:insight>/", endpoint="insight")
 api.add_resource(
     InsightItem, "/users/<user:user>/insights/<insight:insight>/", endpoint="insight_by"
@@ -33,5 +45,9 @@ api.add_resource(
     "/users/<user:user>/insights/<insight:insight>/feedbacks/<feedback:feedback>/",
     endpoint="feedback_by_insight",
 )
+api.add_resource(
+    FeedbackStatus, "/feedback-status/<ticket>/", endpoint="feedback_status"
+)
 api.add_resource(UserCollection, "/users/", endpoint="users")
 api.add_resource(UserItem, "/users/<user:user>/", endpoint="user")
+api.add_resource(Picture, "/pictures/<name>", endpoint="picture")
@@ -2,18 +2,99 @@
 Authentication module for the API.
 """
 
-import secrets
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
-from flask import request
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
 from werkzeug.exceptions import Forbidden
-from .models import ApiKey
+from . import db
+from .models import ApiKey, User
 
 
-def get_authenticated_user():
+class ApiKeyCache:
     """
-    Tries to extract the API key from the Authorization header (Bearer scheme)
-    and returns the corresponding User object if the key is valid.
+    Bounded LRU cache of API key hash -> (detached user snapshot, admin flag)
+    shared by the requests of a process. Entries expire after a TTL so that
+    changes made by other processes are picked up, and are dropped right away
+    when this process changes the key or its user.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key_hash):
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key_hash]
+                return None
+            self._entries.move_to_end(key_hash)
+            return entry[1:]
+
+    def set(self, key_hash, user, admin, ttl, size):
+        with self._lock:
+            self._entries[key_hash] = (time.monotonic() + ttl, user, admin)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key_hashes=(), user_ids=()):
+        with self._lock:
+            for key_hash in key_hashes:
+                self._entries.pop(key_hash, None)
+            if user_ids:
+                for key_hash, entry in list(self._entries.items()):
+                    if entry[1] is not None and entry[1].id in user_ids:
+                        del self._entries[key_hash]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+api_key_cache = ApiKeyCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_api_key_cache(session, flush_context):
+    """
+    Drop cached keys whose ApiKey or User row was changed or deleted.
+    """
+    key_hashes = set()
+    user_ids = set()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, ApiKey):
+            key_hashes.add(obj.key)
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, User):
+            user_ids.add(obj.id)
+    if key_hashes or user_ids:
+        api_key_cache.invalidate(key_hashes, user_ids)
+
+
+def _snapshot(user):
+    """
+    Return a detached copy of the user's columns that can be shared between
+    requests and merged into a session without loading it again.
+    """
+    columns = {
+        attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs
+    }
+    snapshot = User(**columns)
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+def _bearer_token():
+    """
+    Return the API key of the Authorization header (Bearer scheme), or None.
     """
     header = request.headers.get("Authorization")
     if not header:
@@ -27,13 +108,70 @@ def get_authenticated_user():
     except ValueError:
         return None
 
+    return token.strip() or None
+
+
+def _resolve(token):
     key_hash = ApiKey.key_hash(token)
+    ttl = current_app.config.get("AUTH_CACHE_TTL", 0)
+    cached = api_key_cache.get(key_hash) if ttl else None
+    if cached is not None:
+        snapshot, admin = cached
+        if snapshot is None:
+            return None, admin
+        # A user the request has already loaded is more recent than the copy
+        user = db.session.identity_map.get(db.inspect(snapshot).key)
+        if user is None:
+            user = db.session.merge(snapshot, load=False)
+        return user, admin
+
     api_key = ApiKey.query.filter_by(key=key_hash).first()
+    if api_key is None:
+        return None, False
+
+    user = api_key.user
+    if ttl:
+        api_key_cache.set(
+            key_hash,
+            _snapshot(user) if user else None,
+            bool(api_key.admin),
+            ttl,
+            current_app.config.get("AUTH_CACHE_SIZE", 1024),
+        )
+    return user, bool(api_key.admin)
+
+
+def authenticate():
+    """
+    Resolve the request's API key once and return (user, admin), where admin
+    tells whether the key is an admin key. Both are falsy for anonymous
+    requests and unknown keys.
+    """
+    if "authentication" not in g:
+        token = _bearer_token()
+        g.authentication = _resolve(token) if token else (None, False)
+    return g.authentication
 
-    if api_key and api_key.user:
-        return api_key.user
 
-    return None
+def reset_authentication():
+    """
+    Forget the previous request's authentication, registered as a
+    before_request hook.
+    """
+    g.pop("authentication", None)
+
+
+def get_authenticated_user():
+    """
+    Tries to extract the API key from the Authorization header (Bearer scheme)
+    and returns the corresponding User object if the key is valid.
+    """
+    return authenticate()[0]
+
+
+def _require_token():
+    if _bearer_token() is None:
+        raise Forbidden("Missing or invalid Authorization header")
 
 
 def require_admin(func):
@@ -41,17 +179,10 @@ def require_admin(func):
     Decorator to require an admin API key.
     """
 
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            raise Forbidden("Missing or invalid Authorization header")
-        token = auth_header.split(" ", 1)[1]
-        if not token:
-            raise Forbidden("API key required")
-
-        key_hash = ApiKey.key_hash(token.strip())
-        db_key = ApiKey.query.filter_by(admin=True).first()
-        if db_key and secrets.compare_digest(key_hash, db_key.key):
+        _require_token()
+        if authenticate()[1]:
             return func(*args, **kwargs)
         raise Forbidden("Invalid API key")
 
@@ -68,16 +199,9 @@ def require_user_auth(func):
     def wrapper(*args, **kwargs):
         user = kwargs.get("user")  # Get the user from kwargs
 
-        auth_header = request.headers.get("Authorization")
-        if not auth_header or not auth_header.startswith("Bearer "):
-            raise Forbidden("Missing or invalid Authorization header")
-        token = auth_header.split(" ", 1)[1]
-        if not token:
-            raise Forbidden("API key required")
-
-        key_hash = ApiKey.key_hash(token.strip())
-        db_key = ApiKey.query.filter_by(user_id=user.id).first()
-        if db_key and secrets.compare_digest(key_hash, db_key.key):
+        _require_token()
+        current_user = authenticate()[0]
+        if current_user and user and current_user.id == user.id:
             return func(*args, **kwargs)
         raise Forbidden("Invalid API key")
 
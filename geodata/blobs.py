@@ -0,0 +1,207 @@
+"""
+This module stores profile pictures in a content-addressed blob store.
+
+Image bytes live on disk under BLOB_DIR, named by the SHA-256 of their
+content and their image format, e.g. 3f/3fa1...e2.png, so identical uploads
+are stored once. User rows only keep the blob names. Blobs are staged on
+the database session and written once it commits, so a failed commit leaves
+no orphaned files behind. Thumbnails are made by a pool of THUMBNAIL_WORKERS
+threads after the upload's request has finished, and stored the same way.
+"""
+
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
+from geodata import db
+from geodata.auth import api_key_cache
+from geodata.models import User
+
+THUMBNAIL_SIZE = (64, 64)
+THUMBNAIL_FORMAT = "WEBP"
+
+IMAGE_FORMATS = {"PNG": "png", "JPEG": "jpeg", "GIF": "gif", "WEBP": "webp"}
+BLOB_NAME = re.compile(r"^[0-9a-f]{64}\.(png|jpeg|gif|webp)$")
+
+_lock = threading.Lock()
+_executor = None
+_pending = set()
+
+
+def blob_path(name):
+    """
+    Return the path of a blob, or None if name is not a valid blob name.
+    """
+    if not BLOB_NAME.match(name):
+        return None
+    return os.path.join(current_app.config["BLOB_DIR"], name[:2], name)
+
+
+def _write_blob(path, data):
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that readers never see a
+        # partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, path)
+
+
+def store_blob(data, extension):
+    """
+    Stage bytes to be stored under their content hash once the session
+    commits, and return the blob name. Content that is already stored is not
+    written again.
+    """
+    name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+    db.session.info.setdefault("staged_blobs", {})[blob_path(name)] = data
+    return name
+
+
+@event.listens_for(Session, "after_commit")
+def _write_staged_blobs(session):
+    """
+    Write the blobs staged on the session, now that its rows naming them are
+    committed.
+    """
+    staged = session.info.pop("staged_blobs", None)
+    for path, data in (staged or {}).items():
+        _write_blob(path, data)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_staged_blobs(session, transaction):
+    """
+    Drop the blobs still staged when the session's transaction ends without
+    a commit, e.g. on a rollback, as no row names them.
+    """
+    if transaction.parent is None:
+        session.info.pop("staged_blobs", None)
+
+
+def store_image(image_data_base64):
+    """
+    Decode a base64 image, check that it is an image in a supported format
+    and stage it. Returns the blob name, or raises ValueError.
+    """
+    try:
+        data = base64.b64decode(image_data_base64, validate=True)
+        image = Image.open(io.BytesIO(data))
+        image.verify()
+    except (binascii.Error, UnidentifiedImageError, OSError) as e:
+        raise ValueError("profile_picture must be a base64 encoded image") from e
+    if image.format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format {image.format}")
+    return store_blob(data, IMAGE_FORMATS[image.format])
+
+
+def make_thumbnail(name):
+    """
+    Make and stage the thumbnail of a stored image, returning its blob name.
+    """
+    with Image.open(blob_path(name)) as image:
+        image.thumbnail(THUMBNAIL_SIZE)
+        buffer = io.BytesIO()
+        image.save(buffer, format=THUMBNAIL_FORMAT)
+    return store_blob(buffer.getvalue(), IMAGE_FORMATS[THUMBNAIL_FORMAT])
+
+
+def _thumbnail_task(app, user_id, name):
+    with app.app_context():
+        thumb = make_thumbnail(name)
+        # Skip users whose picture has changed in the meantime
+        db.session.execute(
+            update(User)
+            .where(User.id == user_id, User.profile_picture == name)
+            .values(profile_picture_thumb=thumb)
+        )
+        db.session.commit()
+        api_key_cache.invalidate(user_ids={user_id})
+
+
+def schedule_thumbnail(user_id, name):
+    """
+    Make the thumbnail of a user's picture in the background and store it on
+    the user. Thumbnails are made inline if THUMBNAIL_WORKERS is 0.
+    """
+    global _executor
+    app = current_app._get_current_object()
+    workers = app.config.get("THUMBNAIL_WORKERS", 0)
+    if not workers:
+        _thumbnail_task(app, user_id, name)
+        return
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="thumbnail"
+            )
+        future = _executor.submit(_thumbnail_task, app, user_id, name)
+        _pending.add(future)
+
+    def done(future):
+        _pending.discard(future)
+        error = future.exception()
+        if error is not None:
+            app.logger.error(
+                "Thumbnail of %s for user %s failed", name, user_id, exc_info=error
+            )
+
+    future.add_done_callback(done)
+
+
+def wait_for_thumbnails(timeout=None):
+    """
+    Wait until the scheduled thumbnails are done.
+    """
+    wait(list(_pending), timeout=timeout)
+
+
+def set_profile_picture(user, image_data_base64):
+    """
+    Stage a base64 picture as the user's profile picture, written when the
+    session commits. The thumbnail is reset until schedule_thumbnail has made
+    a new one. Raises ValueError if the data is not a supported image.
+    """
+    if image_data_base64 is None:
+        user.profile_picture = user.profile_picture_thumb = None
+        return
+    name = store_image(image_data_base64)
+    if name != user.profile_picture:
+        user.profile_picture = name
+        user.profile_picture_thumb = None
+
+
+@click.command("migrate-pictures")
+@with_appcontext
+def migrate_pictures_command():
+    """Move base64 profile pictures from the user table to the blob store."""
+    moved = []
+    for user in User.query.filter(User.profile_picture.is_not(None)):
+        if BLOB_NAME.match(user.profile_picture):
+            continue
+        try:
+            set_profile_picture(user, user.profile_picture)
+        except ValueError:
+            click.echo(f"{user.username}: not an image, removed.")
+            set_profile_picture(user, None)
+            continue
+        moved.append(user)
+    db.session.commit()
+    # Thumbnails are made from the pictures written by the commit
+    for user in moved:
+        user.profile_picture_thumb = make_thumbnail(user.profile_picture)
+    db.session.commit()
+    click.echo(f"Moved {len(moved)} profile pictures to the blob store.")
@@ -3,6 +3,7 @@ This module includes app constants.
 """
 
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 
 USER_PROFILE_URL = "/profiles/user/"
 INSIGHT_PROFILE_URL = "/profiles/insight/"
@@ -10,3 +11,10 @@ FEEDBACK_PROFILE_URL = "/profiles/feedback/"
 ERROR_PROFILE = "/profiles/error-profile/"
 
 LINK_RELATIONS_URL = "/geometa/link-relations#"
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+# Values of the controls= parameter, from no controls to all of them
+CONTROL_LEVELS = ("none", "minimal", "full")
@@ -0,0 +1,232 @@
+"""
+This module commits feedback in groups, behind the requests that post it.
+
+On SQLite every commit is an fsync, so committing each rating on its own
+caps the feedback rate. With FEEDBACK_WRITE_BEHIND enabled the feedback
+resource validates a rating, queues it and answers 202 at once. A writer
+thread per server process commits the queue in groups of at most
+FEEDBACK_GROUP_SIZE ratings, waiting at most FEEDBACK_GROUP_DELAY seconds
+for a group to fill. The state of every queued rating is kept in the shared
+cache under its ticket, so any worker can answer status requests. The queue
+holds at most FEEDBACK_QUEUE_SIZE ratings, beyond which posts are turned
+away, and is flushed before the process exits. Errors are logged and fail
+the ratings they hit, never the writer thread.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+from geodata import cache, db
+from geodata.models import Feedback, Insight
+from geodata.utils import invalidate_items
+
+# Seconds the state of a queued rating is kept
+STATUS_TIMEOUT = 3600
+
+_STOP = object()
+_lock = threading.Lock()
+
+
+def status_key(ticket):
+    return f"feedback-status/{ticket}"
+
+
+def get_status(ticket):
+    """
+    Return the state of a queued rating, or None for unknown tickets.
+    """
+    return cache.get(status_key(ticket))
+
+
+class FeedbackQueue:
+    """
+    Queue of validated feedback of one app, committed in groups by a
+    writer thread.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.pid = os.getpid()
+        self.group_size = app.config["FEEDBACK_GROUP_SIZE"]
+        self.group_delay = app.config["FEEDBACK_GROUP_DELAY"]
+        self.stats = {
+            "groups": 0,
+            "committed": 0,
+            "failed": 0,
+            "total_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+        }
+        self._queue = queue.Queue(maxsize=app.config["FEEDBACK_QUEUE_SIZE"])
+        self._thread = threading.Thread(
+            target=self._run, name="feedback-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.stop)
+
+    @property
+    def depth(self):
+        """
+        Number of ratings waiting to be committed.
+        """
+        return self._queue.qsize()
+
+    def put(self, entry):
+        """
+        Queue a rating and return its ticket. entry holds the Feedback
+        columns and the username of the route the rating was posted to.
+        Raises queue.Full if the queue is full.
+        """
+        ticket = uuid.uuid4().hex
+        # Set before queueing, so that it never overwrites the outcome
+        cache.set(status_key(ticket), {"state": "queued"}, timeout=STATUS_TIMEOUT)
+        try:
+            self._queue.put_nowait((ticket, entry))
+        except queue.Full:
+            cache.delete(status_key(ticket))
+            raise
+        return ticket
+
+    def join(self):
+        """
+        Wait until every queued rating has been committed or has failed.
+        """
+        self._queue.join()
+
+    def stop(self):
+        """
+        Commit what is queued and stop the writer thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            group = []
+            if item is _STOP:
+                stopping = True
+            else:
+                group.append(item)
+            deadline = time.monotonic() + self.group_delay
+            while not stopping and len(group) < self.group_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                else:
+                    group.append(item)
+            if group:
+                try:
+                    with self.app.app_context():
+                        self._flush(group)
+                except Exception:
+                    # A dead writer would leave every later rating queued
+                    self.app.logger.exception(
+                        "Committing a group of %d feedback failed", len(group)
+                    )
+                    self._fail(group, "Internal error")
+            for _ in range(len(group) + stopping):
+                self._queue.task_done()
+
+    def _fail(self, group, error):
+        """
+        Mark the ratings of a group failed, as far as the cache allows.
+        """
+        self.stats["failed"] += len(group)
+        try:
+            cache.set_many(
+                {
+                    status_key(ticket): {"state": "failed", "error": error}
+                    for ticket, _ in group
+                },
+                timeout=STATUS_TIMEOUT,
+            )
+        except Exception:
+            self.app.logger.exception("Marking feedback failed failed")
+
+    def _flush(self, group):
+        start = time.perf_counter()
+        try:
+            results = self._commit(group)
+        except Exception:
+            db.session.rollback()
+            # Commit one by one so that only the bad ratings fail
+            results = []
+            for item in group:
+                try:
+                    results += self._commit([item])
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("Committing feedback %s failed", item[0])
+                    results.append((item, None, str(getattr(e, "orig", None) or e)))
+        finally:
+            db.session.remove()
+        elapsed = time.perf_counter() - start
+
+        statuses = {}
+        for (ticket, entry), feedback_id, error in results:
+            if error is None:
+                status = {
+                    "state": "committed",
+                    "feedback": feedback_id,
+                    "insight": entry["insight_id"],
+                    "username": entry["username"],
+                }
+                self.stats["committed"] += 1
+            else:
+                status = {"state": "failed", "error": error}
+                self.stats["failed"] += 1
+            statuses[status_key(ticket)] = status
+        cache.set_many(statuses, timeout=STATUS_TIMEOUT)
+        invalidate_items("insight", *{entry["insight_id"] for _, entry in group})
+
+        self.stats["groups"] += 1
+        self.stats["total_flush_seconds"] += elapsed
+        self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+
+    def _commit(self, group):
+        """
+        Insert a group of ratings and update their insights' aggregates in
+        one transaction.
+        """
+        feedbacks = []
+        for _, entry in group:
+            insight = db.session.get(Insight, entry["insight_id"])
+            if insight is None:
+                # Deleted after the rating was queued
+                feedbacks.append(None)
+                continue
+            feedback = Feedback(
+                insight_id=insight.id,
+                user_id=entry["user_id"],
+                rating=entry["rating"],
+                comment=entry["comment"],
+            )
+            db.session.add(feedback)
+            feedbacks.append(feedback)
+            insight.update_rating_aggregates(new_rating=feedback.rating)
+        db.session.commit()
+        return [
+            (item, feedback.id, None) if feedback else (item, None, "Insight deleted")
+            for item, feedback in zip(group, feedbacks)
+        ]
+
+
+def get_feedback_queue(app):
+    """
+    Return this process's feedback queue of the app, starting it on first
+    use. The writer thread of a queue inherited by fork is not running, so
+    such a queue is not reused.
+    """
+    with _lock:
+        feedback_queue = app.extensions.get("feedback_queue")
+        if feedback_queue is None or feedback_queue.pid != os.getpid():
+            feedback_queue = app.extensions["feedback_queue"] = FeedbackQueue(app)
+    return feedback_queue
@@ -0,0 +1,119 @@
+"""
+This module hashes passwords in a process pool.
+
+Password hashing is deliberately CPU bound. Hashing inline would hold the
+GIL of the request's worker for the whole hash, stalling every other request
+thread of that worker. Hashes are computed by a pool of
+PASSWORD_HASH_WORKERS processes instead, created lazily in every server
+process, and the request thread waits for its hash without holding the GIL.
+The pool processes are started by a fork server (or spawned where there is
+none), never forked from the threaded server process.
+
+At most PASSWORD_HASH_QUEUE_SIZE hashes may be waiting for or running in the
+pool. Beyond that hash_password raises HashQueueFull, which the resources
+answer with 503, instead of letting a burst of signups queue up without
+bound. PASSWORD_HASH_METHOD sets the werkzeug hash method and its cost
+parameters, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000". With no
+workers, or outside an app context, passwords are hashed inline.
+"""
+
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app, has_app_context
+import werkzeug.security
+
+# Hashing counters, kept per process: hashes waiting for or running in the
+# pool, finished hashes and their total and maximum latency in seconds
+hash_stats = {"pending": 0, "hashed": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+class HashQueueFull(Exception):
+    """
+    Raised when PASSWORD_HASH_QUEUE_SIZE hashes are already pending.
+    """
+
+
+def _generate(password, method):
+    if method:
+        return werkzeug.security.generate_password_hash(password, method=method)
+    return werkzeug.security.generate_password_hash(password)
+
+
+def _get_executor(workers):
+    """
+    Return this process's pool, creating it on first use. A pool inherited
+    from a parent process by fork is not reused.
+    """
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def shutdown():
+    """
+    Shut down this process's pool, if it has one.
+    """
+    global _executor
+    with _lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
+
+
+atexit.register(shutdown)
+
+
+def hash_password(password):
+    """
+    Hash a password with the configured method, in the pool if it has
+    workers, and record the latency. Raises HashQueueFull if the pool's
+    queue is full.
+    """
+    method = None
+    workers = 0
+    if has_app_context():
+        method = current_app.config.get("PASSWORD_HASH_METHOD")
+        workers = current_app.config.get("PASSWORD_HASH_WORKERS", 0)
+
+    if not workers:
+        start = time.perf_counter()
+        try:
+            return _generate(password, method)
+        finally:
+            _record(time.perf_counter() - start)
+
+    queue_size = current_app.config.get("PASSWORD_HASH_QUEUE_SIZE")
+    with _lock:
+        if queue_size is not None and hash_stats["pending"] >= queue_size:
+            raise HashQueueFull
+        hash_stats["pending"] += 1
+    start = time.perf_counter()
+    try:
+        future = _get_executor(workers).submit(_generate, password, method)
+        return future.result()
+    finally:
+        with _lock:
+            hash_stats["pending"] -= 1
+        _record(time.perf_counter() - start)
+
+
+def _record(elapsed):
+    with _lock:
+        hash_stats["hashed"] += 1
+        hash_stats["total_seconds"] += elapsed
+        hash_stats["max_seconds"] = max(hash_stats["max_seconds"], elapsed)
@@ -0,0 +1,156 @@
+"""
+This module imports insights in bulk from NDJSON, one insight per line.
+
+Lines are validated one at a time against the insight schema and inserted in
+batches, each batch with one executemany INSERT in its own transaction. The
+spatial triggers keep the R-tree and the cluster grid up to date, and the
+cached tiles of all imported insights are invalidated once at the end.
+"""
+
+import json
+import click
+from flask.cli import with_appcontext
+from jsonschema import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from geodata import db
+from geodata.models import Insight, User
+from geodata.schemas import validate_body
+from geodata.tiles import invalidate_points
+
+IMPORT_BATCH_SIZE = 1000
+
+# Insight fields that can be given on an import line
+IMPORT_FIELDS = (
+    "title",
+    "description",
+    "longitude",
+    "latitude",
+    "image",
+    "address",
+    "category",
+    "subcategory",
+    "external_link",
+)
+
+
+class ImportReport:
+    """
+    Outcome of an import: the number of imported insights and the errors of
+    the rejected lines as (line number, message) pairs.
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.errors = []
+
+    def serialize(self):
+        return {
+            "imported": self.imported,
+            "rejected": len(self.errors),
+            "errors": [
+                {"line": line, "message": message} for line, message in self.errors
+            ],
+        }
+
+
+def parse_line(line):
+    """
+    Parse and validate one NDJSON line. Returns the insight row to insert, or
+    raises ValueError with a message for the report.
+    """
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}") from e
+    try:
+        validate_body(Insight, data)
+    except ValidationError as e:
+        raise ValueError(f"Invalid input: {e.message}") from e
+
+    # The table's check constraints, checked here so that a batch never fails
+    if not -180 <= data["longitude"] <= 180 or not -90 <= data["latitude"] <= 90:
+        raise ValueError("Invalid input: coordinates out of range")
+    if data.get("category") is not None and data.get("subcategory") is None:
+        raise ValueError("Invalid input: a category requires a subcategory")
+    return {field: data.get(field) for field in IMPORT_FIELDS}
+
+
+def _insert_batch(rows, report):
+    """
+    Insert a batch of (line number, row) pairs in one transaction. If the
+    batch fails, its rows are inserted one by one to find the bad lines.
+    Returns the points of the inserted insights.
+    """
+    try:
+        db.session.execute(insert(Insight), [row for _, row in rows])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    else:
+        report.imported += len(rows)
+        return [(row["longitude"], row["latitude"]) for _, row in rows]
+
+    points = []
+    for line_number, row in rows:
+        try:
+            db.session.execute(insert(Insight), [row])
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            report.errors.append((line_number, f"Database conflict: {e.orig}"))
+        else:
+            report.imported += 1
+            points.append((row["longitude"], row["latitude"]))
+    return points
+
+
+def import_insights(lines, creator_id=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import insights from an iterable of NDJSON lines (str or bytes), created
+    by the user with id creator_id. Blank lines are skipped. Returns an
+    ImportReport.
+    """
+    report = ImportReport()
+    points = []
+    batch = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = parse_line(line)
+        except ValueError as e:
+            report.errors.append((line_number, str(e)))
+            continue
+        row["creator"] = creator_id
+        batch.append((line_number, row))
+        if len(batch) >= batch_size:
+            points += _insert_batch(batch, report)
+            batch = []
+    if batch:
+        points += _insert_batch(batch, report)
+
+    invalidate_points(points)
+    return report
+
+
+@click.command("import-insights")
+@click.argument("source", type=click.File("rb"))
+@click.option("--user", "username", help="Username of the insights' creator.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def import_insights_command(source, username, batch_size):
+    """Import insights from an NDJSON file, or - for stdin."""
+    creator_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f"No user {username}.", param_hint="--user")
+        creator_id = user.id
+
+    report = import_insights(source, creator_id, batch_size)
+    for line_number, message in report.errors:
+        click.echo(f"line {line_number}: {message}", err=True)
+    click.echo(
+        f"Imported {report.imported} insights, rejected {len(report.errors)} lines."
+    )
@@ -0,0 +1,373 @@
+"""
+This module instruments requests and SQL statements and exports the
+measurements in the Prometheus text format at /metrics.
+
+Every request records its latency, the SQL statements it ran, the time they
+took, the rows SQLite returned and the time spent encoding JSON, labelled
+with the request's endpoint and method. The counters of background work,
+such as the tile cache, password hashing and the feedback queue, are added
+when the metrics are exported.
+
+Measurements are kept per server process. With METRICS_DIR set, every
+process writes its measurements to its own file in that directory at most
+every METRICS_FLUSH_INTERVAL seconds and when it exits, and /metrics sums
+the files of all processes, so any gunicorn worker can answer a scrape for
+all of them. The counters of processes that have exited still count, but
+their gauges are left out. The directory should be emptied before the server
+starts.
+"""
+
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from flask import Response, request
+from sqlalchemy import event
+
+PROMETHEUS_TEXT = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# name -> (type, help) of every exported metric family
+FAMILIES = {
+    "geodata_http_requests_total": ("counter", "Requests by endpoint and status."),
+    "geodata_http_request_duration_seconds": (
+        "histogram",
+        "Request latency in seconds.",
+    ),
+    "geodata_db_queries_per_request": (
+        "histogram",
+        "SQL statements run by a request.",
+    ),
+    "geodata_db_query_seconds_total": (
+        "counter",
+        "Time spent running SQL statements.",
+    ),
+    "geodata_db_rows_fetched_total": ("counter", "Rows returned by SQLite."),
+    "geodata_serialization_seconds_total": (
+        "counter",
+        "Time spent encoding JSON responses.",
+    ),
+    "geodata_tile_cache_requests_total": (
+        "counter",
+        "Tile cache lookups by result.",
+    ),
+    "geodata_password_hashes_total": ("counter", "Passwords hashed."),
+    "geodata_password_hash_seconds_total": (
+        "counter",
+        "Time spent hashing passwords.",
+    ),
+    "geodata_password_hashes_pending": (
+        "gauge",
+        "Passwords waiting for or being hashed in the pool.",
+    ),
+    "geodata_feedback_queue_depth": ("gauge", "Feedback waiting to be committed."),
+    "geodata_feedback_groups_total": ("counter", "Feedback groups committed."),
+    "geodata_feedback_total": ("counter", "Queued feedback by outcome."),
+}
+
+_BUCKETS = {
+    "geodata_http_request_duration_seconds": LATENCY_BUCKETS,
+    "geodata_db_queries_per_request": QUERY_BUCKETS,
+}
+
+# Measurements of the current request of each thread
+_local = threading.local()
+
+
+def _count_row(cursor, row):
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats["rows"] += 1
+    return row
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats["queries"] += 1
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_local, "stats", None)
+    starts = conn.info.get("query_start")
+    if stats is not None and starts:
+        stats["query_seconds"] += time.perf_counter() - starts.pop()
+
+
+def record_serialization(seconds):
+    """
+    Add JSON encoding time to the current request's measurements.
+    """
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats["serialization"] += seconds
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metrics:
+    """
+    Measurements of one app in this process.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.directory = app.config.get("METRICS_DIR")
+        self.flush_interval = app.config.get("METRICS_FLUSH_INTERVAL", 1.0)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._path = None
+        self._pid = None
+        self._flushed = 0.0
+
+    def inc(self, name, labels, value=1):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = _BUCKETS[name]
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def _process_samples(self):
+        """
+        Return (name, labels, value) samples of the process-wide counters
+        kept by other modules.
+        """
+        from geodata.hashing import hash_stats
+        from geodata.tiles import tile_stats
+
+        hits = sum(stats["hits"] for stats in list(tile_stats.values()))
+        misses = sum(stats["misses"] for stats in list(tile_stats.values()))
+        samples = [
+            ("geodata_tile_cache_requests_total", {"result": "hit"}, hits),
+            ("geodata_tile_cache_requests_total", {"result": "miss"}, misses),
+            ("geodata_password_hashes_total", {}, hash_stats["hashed"]),
+            ("geodata_password_hash_seconds_total", {}, hash_stats["total_seconds"]),
+            ("geodata_password_hashes_pending", {}, hash_stats["pending"]),
+        ]
+        feedback_queue = self.app.extensions.get("feedback_queue")
+        if feedback_queue is not None and feedback_queue.pid == os.getpid():
+            stats = feedback_queue.stats
+            samples += [
+                ("geodata_feedback_queue_depth", {}, feedback_queue.depth),
+                ("geodata_feedback_groups_total", {}, stats["groups"]),
+                (
+                    "geodata_feedback_total",
+                    {"outcome": "committed"},
+                    stats["committed"],
+                ),
+                ("geodata_feedback_total", {"outcome": "failed"}, stats["failed"]),
+            ]
+        return samples
+
+    def snapshot(self):
+        """
+        Return this process's measurements as a JSON-serializable dict.
+        """
+        with self._lock:
+            counters = [
+                [name, list(labels), value]
+                for (name, labels), value in self.counters.items()
+            ]
+            histograms = [
+                [name, list(labels), [list(buckets), total, count]]
+                for (name, labels), (buckets, total, count) in self.histograms.items()
+            ]
+        counters += [
+            [name, list(_labels_key(labels)), value]
+            for name, labels, value in self._process_samples()
+        ]
+        return {"counters": counters, "histograms": histograms}
+
+    def flush(self, force=False):
+        """
+        Write this process's measurements to its file in METRICS_DIR, if the
+        last write is older than METRICS_FLUSH_INTERVAL or force is set.
+        """
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed < self.flush_interval:
+            return
+        self._flushed = now
+        if self._pid != os.getpid():
+            # A new process, e.g. a forked worker, gets a file of its own
+            self._pid = os.getpid()
+            self._path = os.path.join(
+                self.directory, f"metrics-{self._pid}-{uuid.uuid4().hex}.json"
+            )
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp:
+            json.dump(self.snapshot(), tmp)
+        os.replace(tmp_path, self._path)
+
+    def collect(self):
+        """
+        Return the summed counters and histograms of every process, or of
+        this one without METRICS_DIR.
+        """
+        if self.directory:
+            self.flush(force=True)
+            snapshots = []
+            for name in os.listdir(self.directory):
+                if not name.startswith("metrics-") or not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name)) as source:
+                        snapshot = json.load(source)
+                except (OSError, ValueError):
+                    # Removed or being replaced while listing
+                    continue
+                pid = int(name.split("-")[1])
+                snapshots.append((snapshot, pid == os.getpid() or _pid_alive(pid)))
+        else:
+            snapshots = [(self.snapshot(), True)]
+
+        counters = {}
+        histograms = {}
+        for snapshot, alive in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                # Totals of exited processes stay, their gauges are stale
+                if not alive and FAMILIES[name][0] == "gauge":
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, (buckets, total, count) in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+        return counters, histograms
+
+    def render(self):
+        """
+        Return the measurements of every process in the Prometheus text
+        format.
+        """
+        counters, histograms = self.collect()
+        lines = []
+        for family, (kind, description) in FAMILIES.items():
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            for (name, labels), value in sorted(counters.items()):
+                if name == family:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if name != family:
+                    continue
+                cumulative = 0
+                bounds = [*map(str, _BUCKETS[name]), "+Inf"]
+                for bound, bucket in zip(bounds, buckets):
+                    cumulative += bucket
+                    bucket_labels = _format_labels(labels + (("le", bound),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def start_request(self):
+        _local.stats = {
+            "start": time.perf_counter(),
+            "queries": 0,
+            "query_seconds": 0.0,
+            "rows": 0,
+            "serialization": 0.0,
+            "status": 500,
+        }
+
+    def record_status(self, response):
+        stats = getattr(_local, "stats", None)
+        if stats is not None:
+            stats["status"] = response.status_code
+        return response
+
+    def finish_request(self, exc=None):
+        stats = getattr(_local, "stats", None)
+        if stats is None:
+            return
+        _local.stats = None
+        elapsed = time.perf_counter() - stats["start"]
+        endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+        labels = {"endpoint": endpoint, "method": request.method}
+        status = 500 if exc is not None else stats["status"]
+
+        self.inc("geodata_http_requests_total", dict(labels, status=str(status)))
+        self.observe("geodata_http_request_duration_seconds", labels, elapsed)
+        self.observe("geodata_db_queries_per_request", labels, stats["queries"])
+        self.inc("geodata_db_query_seconds_total", labels, stats["query_seconds"])
+        self.inc("geodata_db_rows_fetched_total", labels, stats["rows"])
+        self.inc("geodata_serialization_seconds_total", labels, stats["serialization"])
+        self.flush()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _set_row_factory(dbapi_connection, *args):
+    # Every fetched row passes through the row factory, which counts it
+    if hasattr(dbapi_connection, "row_factory"):
+        dbapi_connection.row_factory = _count_row
+
+
+def init_app(app, db):
+    """
+    Instrument the app's requests and SQL statements and add the /metrics
+    endpoint, unless METRICS_ENABLED is off.
+    """
+    if not app.config.get("METRICS_ENABLED"):
+        return
+    metrics = app.extensions["metrics"] = Metrics(app)
+
+    with app.app_context():
+        engine = db.engine
+    # Also on checkout, for connections pooled before the metrics were set up
+    event.listen(engine, "connect", _set_row_factory)
+    event.listen(engine, "checkout", _set_row_factory)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.record_status)
+    app.teardown_request(metrics.finish_request)
+    atexit.register(metrics.flush, force=True)
+
+    @app.route("/metrics")
+    def export_metrics():
+        return Response(metrics.render(), content_type=PROMETHEUS_TEXT)
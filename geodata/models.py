@@ -8,12 +8,12 @@ import secrets
 import click
 from flask.cli import with_appcontext
 from flask import url_for
+from sqlalchemy import func, inspect, select, text, update
+from sqlalchemy.schema import CreateColumn
 import werkzeug.security
 from geodata import db
-from PIL import Image
-import io
-import base64
 import geodata.constants
+import geodata.hashing
 
 
 # Enum classes for status and role (ChatGPT used for implementing this ENUM functionality)
@@ -36,6 +36,9 @@ class RoleEnum(enum.Enum):
     ADMIN = "ADMIN"
 
 
+RATING_RANGE = (1, 2, 3, 4, 5)
+
+
 class User(db.Model):
     """
     User model class.
@@ -45,16 +48,25 @@ class User(db.Model):
     username = db.Column(db.String(32), unique=True, nullable=False)
     email = db.Column(db.String(64), unique=True, nullable=False)
     phone = db.Column(db.Integer, unique=True, nullable=True)
-    password = db.Column(db.String(128), nullable=False)
+    # Only loaded when accessed, list queries never need it
+    password = db.deferred(db.Column(db.String(128), nullable=False))
     first_name = db.Column(db.String(32), nullable=False)
     last_name = db.Column(db.String(32), nullable=True)
     created_date = db.Column(db.DateTime, default=db.func.now(), nullable=False)
     modified_date = db.Column(
         db.DateTime, default=db.func.now(), onupdate=db.func.now(), nullable=False
     )
+    # Row version, bumped by every UPDATE, used for ETags
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+        onupdate=db.literal_column("version + 1"),
+    )
     status = db.Column(db.String, nullable=False, default="ACTIVE")  # Stored as string
     role = db.Column(db.String, nullable=False, default="USER")  # Stored as string
-    profile_picture = db.Column(db.String, nullable=True)
+    profile_picture = db.deferred(db.Column(db.String, nullable=True))
     profile_picture_thumb = db.Column(db.String, nullable=True)
 
     # Relationship with Insight and Feedback
@@ -64,14 +76,7 @@ class User(db.Model):
     api_key = db.relationship("ApiKey", back_populates="user", uselist=False)
 
     def serialize(self, short_form=False):
-        data = {
-            "username": self.username,
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "status": self.status,
-            "role": self.role,
-            "profile_picture_thumb": self.profile_picture_thumb,
-        }
+        data = User.serialize_short_form(self)
 
         if short_form:
             return data
@@ -81,25 +86,53 @@ class User(db.Model):
             {
                 "email": self.email,
                 "phone": self.phone,
-                "created_date": (
-                    self.created_date.isoformat() if self.created_date else None
-                ),
-                "modified_date": (
-                    self.modified_date.isoformat() if self.modified_date else None
-                ),
-                "profile_picture": self.profile_picture,
+                "created_date": self.created_date,
+                "modified_date": self.modified_date,
+                "profile_picture": picture_url(self.profile_picture),
             }
         )
 
         return data
 
+    @staticmethod
+    def short_form_columns():
+        """
+        Return the columns of the short form, for list queries that select
+        only them instead of whole users.
+        """
+        return (
+            User.id,
+            User.username,
+            User.first_name,
+            User.last_name,
+            User.status,
+            User.role,
+            User.profile_picture_thumb,
+        )
+
+    @staticmethod
+    def serialize_short_form(row):
+        """
+        Serialize the short form of a user or of a row of
+        short_form_columns().
+        """
+        return {
+            "username": row.username,
+            "first_name": row.first_name,
+            "last_name": row.last_name,
+            "status": row.status,
+            "role": row.role,
+            "profile_picture_thumb": picture_url(row.profile_picture_thumb),
+        }
+
     @staticmethod
     def hash_password(password):
         """
-        Hash the password using werkzeug.security.
+        Hash the password using werkzeug.security in the hashing pool, see
+        geodata.hashing. Raises HashQueueFull if the pool's queue is full.
         """
 
-        return werkzeug.security.generate_password_hash(password)
+        return geodata.hashing.hash_password(password)
 
     def verify_password(self, password):
         """
@@ -167,16 +200,12 @@ class User(db.Model):
         props["profile_picture"] = {"type": "string"}
         return schema
 
-    @staticmethod
-    def generate_thumbnail(image_data_base64, size=(64, 64)):
-        image_data = base64.b64decode(image_data_base64)
-        image = Image.open(io.BytesIO(image_data))
-        image.thumbnail(size)
 
-        buffer = io.BytesIO()
-        image.save(buffer, format="WEBP")  # tai PNG
-        thumb_b64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return thumb_b64
+def picture_url(name):
+    """
+    Return the URL of a picture in the blob store, or None.
+    """
+    return url_for("api.picture", name=name) if name else None
 
 
 class Insight(db.Model):
@@ -186,7 +215,8 @@ class Insight(db.Model):
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, nullable=False)
     title = db.Column(db.String(128), nullable=False)
-    description = db.Column(db.String(1024))
+    # The detail columns are only in the full form and loaded together on access
+    description = db.deferred(db.Column(db.String(1024)), group="detail")
     longitude = db.Column(
         db.Float,
         db.CheckConstraint(
@@ -201,11 +231,19 @@ class Insight(db.Model):
         ),
         nullable=False,
     )
-    image = db.Column(db.String(128))
+    image = db.deferred(db.Column(db.String(128)), group="detail")
     created_date = db.Column(db.DateTime, default=db.func.now(), nullable=False)
     modified_date = db.Column(
         db.DateTime, default=db.func.now(), onupdate=db.func.now(), nullable=False
     )
+    # Row version, bumped by every UPDATE, used for ETags
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+        onupdate=db.literal_column("version + 1"),
+    )
     creator = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"))
     category = db.Column(db.String(64))
     # Restriction - subcategory should be empty when there's no category
@@ -216,15 +254,23 @@ class Insight(db.Model):
             name="subcategory_check",
         ),
     )
-    external_link = db.Column(db.String(512))
-    address = db.Column(db.String(128))
+    external_link = db.deferred(db.Column(db.String(512)), group="detail")
+    address = db.deferred(db.Column(db.String(128)), group="detail")
+    # Materialized rating aggregates, maintained by the feedback resources
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     user = db.relationship("User", back_populates="insight", uselist=False)
     feedback = db.relationship("Feedback", back_populates="insight")
 
     def serialize(self, short_form=False):
-        # Calculates average of ratings
-        ratings = [fb.rating for fb in self.feedback if fb.rating is not None]
-        average_rating = round(sum(ratings) / len(ratings), 1) if ratings else None
+        average_rating = (
+            round(self.rating_sum / self.rating_count, 1) if self.rating_count else None
+        )
 
         data = {
             "id": self.id,
@@ -232,7 +278,7 @@ class Insight(db.Model):
             "longitude": self.longitude,
             "latitude": self.latitude,
             "category": self.category,
-            "created_date": self.created_date.isoformat(),
+            "created_date": self.created_date,
             "user": self.user.username if self.user else None,
         }
 
@@ -242,17 +288,74 @@ class Insight(db.Model):
                     "description": self.description,
                     "subcategory": self.subcategory,
                     "image": self.image,
-                    "modified_date": (
-                        self.modified_date.isoformat() if self.modified_date else None
-                    ),
+                    "modified_date": self.modified_date,
                     "external_link": self.external_link,
                     "address": self.address,
                     "average_rating": average_rating,
+                    "rating_count": self.rating_count,
+                    "rating_histogram": {
+                        str(star): getattr(self, f"rating_{star}")
+                        for star in RATING_RANGE
+                    },
                 }
             )
 
         return data
 
+    @staticmethod
+    def short_form_columns(fields=None):
+        """
+        Return the columns of the short form, named after the keys of
+        serialize(short_form=True), so that a row's _asdict() is the short
+        form. With fields, only the columns named in it are returned, in the
+        short form's order. The author's username needs an outer join with
+        User.
+        """
+        columns = (
+            Insight.id,
+            Insight.title,
+            Insight.longitude,
+            Insight.latitude,
+            Insight.category,
+            Insight.created_date,
+            User.username.label("user"),
+        )
+        if fields is None:
+            return columns
+        return tuple(column for column in columns if column.key in fields)
+
+    def update_rating_aggregates(self, old_rating=None, new_rating=None):
+        """
+        Adjust the materialized rating aggregates when a feedback rating is
+        added (old_rating is None), changed, or removed (new_rating is None).
+        The change is issued as a relative UPDATE inside the caller's
+        transaction, so it commits or rolls back together with the feedback
+        and concurrent writers do not overwrite each other.
+        """
+
+        if old_rating == new_rating:
+            return
+
+        # Ratings are not edits of the insight itself
+        values = {"modified_date": Insight.modified_date}
+        count_delta = sum_delta = 0
+        if old_rating is not None:
+            count_delta -= 1
+            sum_delta -= old_rating
+            column = f"rating_{old_rating}"
+            values[column] = getattr(Insight, column) - 1
+        if new_rating is not None:
+            count_delta += 1
+            sum_delta += new_rating
+            column = f"rating_{new_rating}"
+            values[column] = getattr(Insight, column) + 1
+        values["rating_count"] = Insight.rating_count + count_delta
+        values["rating_sum"] = Insight.rating_sum + sum_delta
+
+        db.session.execute(
+            update(Insight).where(Insight.id == self.id).values(**values)
+        )
+
     @staticmethod
     def get_schema():
         """
@@ -293,6 +396,14 @@ class Feedback(db.Model):
     modified_date = db.Column(
         db.DateTime, default=db.func.now(), onupdate=db.func.now(), nullable=False
     )
+    # Row version, bumped by every UPDATE, used for ETags
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default="1",
+        onupdate=db.literal_column("version + 1"),
+    )
 
     user = db.relationship("User", back_populates="feedback", uselist=False)
     insight = db.relationship("Insight", back_populates="feedback")
@@ -304,13 +415,9 @@ class Feedback(db.Model):
             "rating": self.rating,
             "comment": self.comment,
             "user": self.user.username if self.user else None,
-            "insight": self.insight.id if self.insight else None,
-            "created_date": (
-                self.created_date.isoformat() if self.created_date else None
-            ),
-            "modified_date": (
-                self.modified_date.isoformat() if self.modified_date else None
-            ),
+            "insight": self.insight_id,
+            "created_date": self.created_date,
+            "modified_date": self.modified_date,
         }
 
     @staticmethod
@@ -322,7 +429,11 @@ class Feedback(db.Model):
             "type": "object",
         }
         props = schema["properties"] = {}
-        props["rating"] = {"type": "number"}
+        props["rating"] = {
+            "type": "integer",
+            "minimum": RATING_RANGE[0],
+            "maximum": RATING_RANGE[-1],
+        }
         props["comment"] = {"type": "string"}
         return schema
 
@@ -350,6 +461,90 @@ def init_db_command():
     click.echo("Database initialized successfully!")
 
 
+def add_missing_columns():
+    """
+    Add the model columns missing from the tables of a database created by
+    an older version. Existing rows get the columns' server defaults.
+    Returns the added columns as "table.column".
+    """
+    connection = db.session.connection()
+    inspector = inspect(connection)
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = CreateColumn(column).compile(dialect=connection.dialect)
+            db.session.execute(
+                text(f'ALTER TABLE "{table.name}" ADD COLUMN {definition}')
+            )
+            added.append(f"{table.name}.{column.name}")
+    db.session.commit()
+    return added
+
+
+def recompute_rating_aggregates():
+    """
+    Recompute the materialized rating aggregates of every insight from the
+    feedback table.
+    """
+
+    def feedback_aggregate(expression, *criteria):
+        return (
+            select(expression)
+            .where(Feedback.insight_id == Insight.id, *criteria)
+            .scalar_subquery()
+        )
+
+    values = {
+        "modified_date": Insight.modified_date,
+        "rating_count": feedback_aggregate(func.count(Feedback.rating)),
+        "rating_sum": feedback_aggregate(func.coalesce(func.sum(Feedback.rating), 0)),
+    }
+    for star in RATING_RANGE:
+        values[f"rating_{star}"] = feedback_aggregate(
+            func.count(Feedback.id), Feedback.rating == star
+        )
+
+    db.session.execute(
+        update(Insight).values(**values).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+@click.command("recompute-ratings")
+@with_appcontext
+def recompute_ratings_command():
+    """Recompute insight rating aggregates from scratch."""
+    # Databases from before the aggregates lack their columns
+    for column in add_missing_columns():
+        click.echo(f"Added column {column}.")
+    click.echo("Recomputing rating aggregates...")
+    recompute_rating_aggregates()
+    click.echo("Rating aggregates recomputed successfully!")
+
+
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Bring a database created by an older version up to date."""
+    # Imported here, as these modules build on the models
+    from geodata.search import rebuild_search_index
+    from geodata.spatial import rebuild_clusters, rebuild_spatial_index
+
+    for column in add_missing_columns():
+        click.echo(f"Added column {column}.")
+    recompute_rating_aggregates()
+    click.echo("Rating aggregates recomputed.")
+    click.echo(f"Spatial index rebuilt with {rebuild_spatial_index()} insights.")
+    click.echo(f"Cluster grid rebuilt with {rebuild_clusters()} clusters.")
+    click.echo(f"Search index rebuilt with {rebuild_search_index()} insights.")
+    click.echo("Database migrated successfully!")
+
+
 @click.command("populate-db")
 @with_appcontext
 def populate_db_command():
@@ -416,6 +611,7 @@ def populate_db_command():
 
     db.session.add(feedback)
     db.session.commit()
+    recompute_rating_aggregates()
 
     # Create API key for admin
     api_key_str = secrets.token_urlsafe(32)
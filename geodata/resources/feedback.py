@@ -3,17 +3,73 @@ This module define resource for feedback.
 """
 
 import json
+import queue
 from flask_restful import Resource
-from flask import url_for, Response, request
-from jsonschema import validate, ValidationError, Draft7Validator
+from flask import current_app, url_for, request
+from jsonschema import ValidationError
+from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, UnsupportedMediaType
 from geodata.models import Feedback, db
-from geodata.utils import GeodataBuilder
+from geodata.schemas import validate_body
+from geodata.utils import (
+    GeodataBuilder,
+    MasonItemTemplate,
+    cached_item_body,
+    collection_response,
+    conditional_get,
+    invalidate_items,
+    item_template,
+    mason_response,
+    page_version,
+    paginate,
+    parse_page_params,
+    stream_collections,
+    url_template,
+)
 from geodata.auth import get_authenticated_user
+from geodata.feedback_queue import get_feedback_queue, get_status
 from geodata.constants import *
 
-draft7_format_checker = Draft7Validator.FORMAT_CHECKER
-from geodata import cache
+
+def _parse_rating(data):
+    """
+    Return the validated rating of a feedback request body as an int, or None
+    if the body has no rating.
+    """
+    rating = data.get("rating")
+    return int(rating) if rating is not None else None
+
+
+@item_template
+def insight_feedback_item_template():
+    """
+    Template for the feedback items of an insight's feedback collection.
+    """
+    template = MasonItemTemplate("feedback")
+    template.add_control(
+        "self",
+        url_template(
+            "api.feedback_by_insight",
+            user="username",
+            insight="insight_id",
+            feedback="id",
+        ),
+    )
+    template.add_control("profile", href=FEEDBACK_PROFILE_URL)
+    return template
+
+
+@item_template
+def user_feedback_item_template():
+    """
+    Template for the feedback items of a user's feedback collection.
+    """
+    template = MasonItemTemplate("feedback")
+    template.add_control(
+        "self", url_template("api.feedback_by_user", user="username", feedback="id")
+    )
+    template.add_control("profile", href=FEEDBACK_PROFILE_URL)
+    return template
 
 
 class FeedbackCollection(Resource):
@@ -25,7 +81,16 @@ class FeedbackCollection(Resource):
         """
         Return feedback(s) submitted by a user if only user is provided.
         If insight is provided, filter feedback by insight.
+        The collection is paged with the 'limit' and 'cursor' query parameters.
         """
+        page_params, error_response = parse_page_params()
+        if error_response:
+            return error_response
+
+        if insight:
+            feedbacks = Feedback.query.filter_by(insight_id=insight.id)
+        else:
+            feedbacks = Feedback.query.filter_by(user_id=user.id)
         body = GeodataBuilder()
         body["@type"] = "feedbacks"
         body.add_namespace("geometa", LINK_RELATIONS_URL)
@@ -34,43 +99,55 @@ class FeedbackCollection(Resource):
             body.add_control_add_feedback(user, insight)
 
         if insight:
-            feedbacks = Feedback.query.filter_by(insight_id=insight.id).all()
             body.add_control(
                 "self", url_for("api.feedbacks_by_insight", user=user, insight=insight)
             )
             body.add_control("up", url_for("api.insight", user=user, insight=insight))
         else:
-            feedbacks = Feedback.query.filter_by(user_id=user.id).all()
             body.add_control("self", url_for("api.feedbacks_by_user", user=user))
             body.add_control("up", url_for("api.user", user=user))
 
-        body["items"] = []
-        for feedback in feedbacks:
-            item = GeodataBuilder(feedback.serialize())
-            item["@type"] = "feedback"
-            if insight:
-                item.add_control(
-                    "self",
-                    url_for(
-                        "api.feedback_by_insight",
-                        user=user,
-                        insight=insight,
-                        feedback=feedback,
-                    ),
-                )
-            else:
-                item.add_control(
-                    "self",
-                    url_for("api.feedback_by_user", user=user, feedback=feedback),
-                )
-            item.add_control("profile", href=FEEDBACK_PROFILE_URL)
-            body["items"].append(item)
+        # Items show their author's username, loaded in the same query
+        page = paginate(
+            feedbacks.options(joinedload(Feedback.user)),
+            Feedback.id,
+            *page_params,
+            stream=stream_collections(),
+        )
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        # Items show their author's username, so its version counts too
+        headers, not_modified = conditional_get(
+            page_version(
+                page,
+                lambda feedback: (
+                    feedback.id,
+                    feedback.version,
+                    feedback.user.version if feedback.user else None,
+                ),
+            )
+        )
+        if not_modified:
+            return not_modified
+
+        if insight:
+            template = insight_feedback_item_template()
+            ids = {"username": user.username, "insight_id": insight.id}
+        else:
+            template = user_feedback_item_template()
+            ids = {"username": user.username}
+
+        def build_item(feedback):
+            return template.render(feedback.serialize(), id=feedback.id, **ids)
+
+        response = collection_response(body, page, build_item)
+        response.headers.update(headers)
+        return response
 
     def post(self, user, insight):
         """
         Create a new feedback for an insight and if logged in it will be added under user also.
+        With FEEDBACK_WRITE_BEHIND the feedback is queued and committed in a
+        group, and the response is 202 with the location of its status.
         """
 
         if request.content_type != "application/json":
@@ -80,15 +157,36 @@ class FeedbackCollection(Resource):
 
         try:
             data = request.get_json()
-            validate(data, Feedback.get_schema(), format_checker=draft7_format_checker)
+            validate_body(Feedback, data)
         except ValidationError as e:
             return GeodataBuilder.create_error_response(400, f"Invalid input: {str(e)}")
 
         current_user = get_authenticated_user()
 
+        if current_app.config.get("FEEDBACK_WRITE_BEHIND"):
+            try:
+                ticket = get_feedback_queue(current_app._get_current_object()).put(
+                    {
+                        "insight_id": insight.id,
+                        "user_id": current_user.id if current_user else None,
+                        "rating": _parse_rating(data),
+                        "comment": data.get("comment"),
+                        "username": user.username,
+                    }
+                )
+            except queue.Full:
+                response = GeodataBuilder.create_error_response(
+                    503, "Feedback queue is full, try again later."
+                )
+                response.headers["Retry-After"] = "1"
+                return response
+            response = mason_response(status=202)
+            response.headers["Location"] = url_for("api.feedback_status", ticket=ticket)
+            return response
+
         new_feedback = Feedback(
             insight_id=insight.id,
-            rating=data.get("rating"),
+            rating=_parse_rating(data),
             comment=data.get("comment"),
         )
 
@@ -96,9 +194,11 @@ class FeedbackCollection(Resource):
             new_feedback.user_id = current_user.id
 
         db.session.add(new_feedback)
+        insight.update_rating_aggregates(new_rating=new_feedback.rating)
         db.session.commit()
+        invalidate_items("insight", insight.id)
 
-        response = Response(status=201)
+        response = mason_response(status=201)
         response.headers["Location"] = url_for(
             "api.feedback_by_insight", user=user, insight=insight, feedback=new_feedback
         )
@@ -110,7 +210,6 @@ class FeedbackItem(Resource):
     Resource for handling feedback item by user and insight.
     """
 
-    @cache.cached()
     def get(self, user, feedback, insight=None):
         """
         Return a single feedback item in Mason format.
@@ -126,7 +225,7 @@ class FeedbackItem(Resource):
 
         body = self.prepare_feedback_response(user, feedback, current_user, insight)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
     def put(self, user, feedback, insight=None):
         """
@@ -148,20 +247,24 @@ class FeedbackItem(Resource):
 
         try:
             data = request.get_json()
-            validate(data, Feedback.get_schema(), format_checker=draft7_format_checker)
+            validate_body(Feedback, data)
         except ValidationError as e:
             return GeodataBuilder.create_error_response(400, f"Invalid input: {str(e)}")
 
-        feedback.rating = data.get("rating")
+        old_rating = feedback.rating
+        feedback.rating = _parse_rating(data)
         feedback.comment = data.get("comment")
+        if feedback.insight:
+            feedback.insight.update_rating_aggregates(old_rating, feedback.rating)
 
         db.session.commit()
-        cache.delete(request.path)
+        invalidate_items("feedback", feedback.id)
+        invalidate_items("insight", feedback.insight_id)
 
         # Build Mason response
         body = self.prepare_feedback_response(user, feedback, current_user, insight)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
     def delete(self, user, feedback, insight=None):
         """
@@ -177,13 +280,16 @@ class FeedbackItem(Resource):
             )
 
         # remoced the try except block for error 500
+        if feedback.insight:
+            feedback.insight.update_rating_aggregates(old_rating=feedback.rating)
         db.session.delete(feedback)
         db.session.commit()
-        cache.delete(request.path)
+        invalidate_items("feedback", feedback.id)
+        invalidate_items("insight", feedback.insight_id)
 
         db.session.rollback()
 
-        return Response(status=204)
+        return mason_response(status=204)
 
     def prepare_feedback_response(self, user, feedback, current_user, insight=None):
         body = GeodataBuilder()
@@ -193,7 +299,7 @@ class FeedbackItem(Resource):
                 self_url = url_for(
                     "api.feedback_by_insight",
                     user=user,
-                    insight=feedback,
+                    insight=feedback.insight,
                     feedback=feedback,
                 )
                 # self refers to insight's feedbackcollection
@@ -216,14 +322,58 @@ class FeedbackItem(Resource):
                 "api.feedbacks_by_insight", user=user, insight=insight
             )
 
-        body.update(feedback.serialize())
+        # The serialized feedback and the controls that are the same for every
+        # route and caller are cached per feedback
+        public = cached_item_body(
+            "feedback", feedback.id, lambda: self._build_public_body(feedback)
+        )
+        public.add_control("self", self_url)
+        public.add_control("collection", collection_url, title="Collection")
+        public["@controls"].update(body.get("@controls", {}))
+
+        return public
+
+    def _build_public_body(self, feedback):
+        body = GeodataBuilder(feedback.serialize())
         body["@type"] = "feedback"
         body.add_namespace("geometa", LINK_RELATIONS_URL)
-        body.add_control("self", self_url)
-        body.add_control("collection", collection_url, title="Collection")
         body.add_control("profile", href=FEEDBACK_PROFILE_URL)
         body.add_control("up", url_for("api.insight", insight=feedback.insight))
         if feedback.user:
             body.add_control("author", url_for("api.user", user=feedback.user))
-
         return body
+
+
+class FeedbackStatus(Resource):
+    """
+    Resource for the state of feedback posted with FEEDBACK_WRITE_BEHIND.
+    """
+
+    def get(self, ticket):
+        """
+        Return whether queued feedback is still queued, has been committed or
+        has failed. Committed feedback has a control to the feedback item.
+        """
+        status = get_status(ticket)
+        if status is None:
+            return GeodataBuilder.create_error_response(
+                404, "Not found", "No queued feedback with this ticket."
+            )
+
+        body = GeodataBuilder({"state": status["state"]})
+        body["@type"] = "feedback-status"
+        body.add_namespace("geometa", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.feedback_status", ticket=ticket))
+        if status["state"] == "committed":
+            body.add_control(
+                "geometa:feedback",
+                url_template(
+                    "api.feedback_by_insight",
+                    user="username",
+                    insight="insight",
+                    feedback="feedback",
+                ).format(**status),
+            )
+        elif status["state"] == "failed":
+            body["error"] = status["error"]
+        return mason_response(body, 200)
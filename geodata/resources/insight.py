@@ -2,21 +2,59 @@
 This module defines insight resource.
 """
 
-import json
 from datetime import datetime
-from flask import request, Response, url_for
+from flask import current_app, request, url_for
 from flask_restful import Resource
-from sqlalchemy.orm import joinedload
-from jsonschema import validate, ValidationError, Draft7Validator
+from jsonschema import ValidationError
 from geodata.constants import *
 from geodata import db
 from geodata.auth import get_authenticated_user
 from geodata.constants import MASON
 from geodata.models import Insight, User
-from geodata.utils import GeodataBuilder
-from geodata import cache
-
-draft7_format_checker = Draft7Validator.FORMAT_CHECKER
+from geodata.spatial import (
+    MAX_CLUSTER_ZOOM,
+    bbox_candidates,
+    cell_bbox,
+    fetch_clusters,
+    nearby_insights,
+)
+from geodata.importer import import_insights
+from geodata.search import match_expression, search_insights
+from geodata.tiles import cached_bbox_items, invalidate_point
+from geodata.schemas import validate_body
+from geodata.utils import (
+    GeodataBuilder,
+    MasonItemTemplate,
+    Page,
+    StreamingPage,
+    cached_item_body,
+    collection_response,
+    conditional_get,
+    invalidate_items,
+    item_template,
+    mason_response,
+    paginate,
+    paginate_items,
+    page_version,
+    parse_fieldset_params,
+    parse_page_params,
+    stream_collections,
+    url_template,
+)
+
+# Item attributes that can be picked with the fields parameter
+INSIGHT_FIELDS = (*(column.key for column in Insight.short_form_columns()), "distance")
+
+
+@item_template
+def insight_item_template():
+    """
+    Template for the short-form insight items of insight collections.
+    """
+    template = MasonItemTemplate("insight")
+    template.add_control("self", url_template("api.insight", insight="id"))
+    template.add_control("profile", href=INSIGHT_PROFILE_URL)
+    return template
 
 
 class InsightCollection(Resource):
@@ -32,11 +70,27 @@ class InsightCollection(Resource):
         At least one of the following query parameters must be provided:
         - 'bbox': bounding box of the search area (format: minLon,minLat,maxLon,maxLat)
         - 'usr': creator's username
+        - 'near': search around a point (format: lon,lat), combined with
+          'radius' (meters) and/or 'k' (number of nearest insights). Results
+          are sorted by distance and carry a 'distance' in meters.
+        - 'q': words to search in the title, description, address and
+          category. Without 'near', results are sorted by relevance.
 
         Optional filters:
         - 'ic': insight category
         - 'isc': insight subcategory
 
+        Paging:
+        - 'limit': page size (default 100)
+        - 'cursor': opaque cursor taken from a 'next' or 'prev' control
+
+        Response shape:
+        - 'fields': comma separated item attributes to include, e.g.
+          fields=longitude,latitude,category. The id is always included;
+          distance is only available with near.
+        - 'controls': 'full' (default), 'minimal' for only the self and
+          paging controls, or 'none' for only the paging controls
+
         Returns a MASON-formatted collection of insights with basic information
         and hypermedia controls for navigation and interaction.
         """
@@ -46,17 +100,111 @@ class InsightCollection(Resource):
         if error_response:
             return error_response
 
+        page_params, error_response = parse_page_params()
+        if error_response:
+            return error_response
+
+        fieldset, error_response = parse_fieldset_params(INSIGHT_FIELDS)
+        if error_response:
+            return error_response
+        fields, controls = fieldset
+        if fields and "distance" in fields and not params["near"]:
+            return GeodataBuilder.create_error_response(
+                400,
+                "Invalid fields",
+                "distance is only available in near searches, add near",
+            )
+
         if user:
             params["username"] = user.username
 
-        insights = self._fetch_insights(params)
+        columns = fields
+        if fields is not None:
+            fields = ("id", *(field for field in fields if field != "id"))
+            # Distances are computed from the coordinates
+            columns = (*fields, "longitude", "latitude") if params["near"] else fields
+
+        query = self._fetch_insights(params, columns)
+
+        # Each branch sets the page and how to read (data, distance) from
+        # its items
+        page = tile_cache = None
+        if (
+            params["bbox"]
+            and not params["username"]
+            and not params["near"]
+            and not params["q"]
+        ):
+            cached = self._get_cached_tiles(params, page_params)
+            if cached is not None:
+                page, tile_cache = cached
+                to_data = lambda data: (data, None)
+
+        if page is None and params["q"] and not params["near"]:
+            # Relevance ordered results are bounded by limit, not paged
+            page = Page(query.limit(page_params[0]).all())
+            to_data = lambda row: (row._asdict(), None)
+        elif page is None and params["near"]:
+            # Distance ordered results are bounded by k/limit, not paged
+            limit = page_params[0]
+            k = min(params["k"], limit) if params["k"] else limit
+            page = Page(nearby_insights(query, *params["near"], params["radius"], k))
+            to_data = lambda pair: (pair[0]._asdict(), pair[1])
+        elif page is None:
+            page = paginate(
+                query, Insight.id, *page_params, stream=stream_collections()
+            )
+            to_data = lambda row: (row._asdict(), None)
 
-        body = self._build_insight_collection_response(insights, user)
+        # Read each row once, for both its version and its item
+        if isinstance(page, StreamingPage):
+            page.items = map(to_data, page.items)
+        else:
+            page.items = [to_data(item) for item in page.items]
+
+        def row_version(item):
+            # Items show their author's username, so its version counts too
+            data = item[0]
+            return data["id"], data["version"], data.get("user_version")
+
+        headers, not_modified = conditional_get(page_version(page, row_version))
+        if not_modified:
+            return not_modified
+
+        body = self._build_insight_collection_response(user, controls)
+        build_item = self._item_builder(fields, controls)
+        response = collection_response(body, page, lambda item: build_item(*item))
+        response.headers.update(headers)
+        if tile_cache:
+            response.headers["X-Tile-Cache"] = tile_cache
+        return response
 
-        if user:
-            body.add_control("up", url_for("api.user", user=user))
+    def _get_cached_tiles(self, params, page_params):
+        """
+        Answer a plain bbox query from the per-tile cache. Returns the page
+        of short forms and the X-Tile-Cache header, or None if the bbox is
+        too large or too dense to be cached. Tiles hold whole short forms, as they are
+        shared by every fieldset.
+        """
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        def load_tile(tile_bbox, limit):
+            tile_params = dict(params, bbox=tile_bbox)
+            query = self._fetch_insights(tile_params).limit(limit)
+            return [row._asdict() for row in query]
+
+        cached = cached_bbox_items(
+            params["bbox"],
+            params["category"],
+            params["subcategory"],
+            load_tile,
+            timeout=current_app.config["TILE_CACHE_TIMEOUT"],
+        )
+        if cached is None:
+            return None
+
+        items, hits, misses = cached
+        page = paginate_items(items, "id", *page_params)
+        return page, f"hits={hits}, misses={misses}"
 
     def post(self, user=None):
         """
@@ -97,7 +245,7 @@ class InsightCollection(Resource):
         # Validate request body against schema
         try:
             data = request.get_json()
-            validate(data, Insight.get_schema(), format_checker=draft7_format_checker)
+            validate_body(Insight, data)
         except ValidationError as e:
             return GeodataBuilder.create_error_response(
                 400, "Invalid request data", str(e)
@@ -121,8 +269,9 @@ class InsightCollection(Resource):
 
         db.session.add(new_insight)
         db.session.commit()
+        invalidate_point(new_insight.longitude, new_insight.latitude)
 
-        response = Response(status=201)
+        response = mason_response(status=201)
         if user:
             # Use user-specific endpoint for user insights
             response.headers["Location"] = url_for(
@@ -139,13 +288,24 @@ class InsightCollection(Resource):
         username = request.args.get("usr")
         category = request.args.get("ic")
         subcategory = request.args.get("isc")
+        near = request.args.get("near")
+        q = request.args.get("q")
 
-        # At least bbox or username is required
-        if not user_path and not bbox and not username:
+        # At least bbox, username, a search point or search words are required
+        if not user_path and not bbox and not username and not near and not q:
             return None, GeodataBuilder.create_error_response(
-                400, "Missing bbox or username", "Provide at least one of: bbox or usr"
+                400,
+                "Missing bbox or username",
+                "Provide at least one of: bbox, usr, near or q",
             )
 
+        if q is not None:
+            q = match_expression(q)
+            if q is None:
+                return None, GeodataBuilder.create_error_response(
+                    400, "Invalid search", "q must contain at least one word"
+                )
+
         # Try parsing the bbox if provided
         try:
             if bbox:
@@ -157,28 +317,76 @@ class InsightCollection(Resource):
                 400, "Invalid bbox format", "Expected format: bbox=25.4,65.0,25.6,65.1"
             )
 
+        # Try parsing the nearest-neighbour search if provided
+        radius = k = None
+        try:
+            if near:
+                near_lon, near_lat = map(float, near.split(","))
+                if not (-180 <= near_lon <= 180 and -90 <= near_lat <= 90):
+                    raise ValueError
+                near = (near_lon, near_lat)
+                if request.args.get("radius"):
+                    radius = float(request.args["radius"])
+                    if not radius > 0:
+                        raise ValueError
+                if request.args.get("k"):
+                    k = int(request.args["k"])
+                    if not 1 <= k <= MAX_PAGE_SIZE:
+                        raise ValueError
+        except ValueError:
+            return None, GeodataBuilder.create_error_response(
+                400,
+                "Invalid near search",
+                "Expected format: near=25.47,65.01 with radius=500 (meters) "
+                f"and/or k=10 (1-{MAX_PAGE_SIZE})",
+            )
+
+        # Distance and relevance ordered results are not paged
+        if near and request.args.get("cursor"):
+            return None, GeodataBuilder.create_error_response(
+                400, "Invalid cursor", "near searches are not paged, remove cursor"
+            )
+        if q and request.args.get("cursor"):
+            return None, GeodataBuilder.create_error_response(
+                400, "Invalid cursor", "q searches are not paged, remove cursor"
+            )
+
         # Removed conversion to lower
         return {
             "bbox": (min_lon, min_lat, max_lon, max_lat) if bbox else None,
             "username": username if username else None,
             "category": category if category else None,
             "subcategory": subcategory if subcategory else None,
+            "near": near if near else None,
+            "radius": radius,
+            "k": k,
+            "q": q,
         }, None
 
-    def _fetch_insights(self, params):
-        query = Insight.query
-
-        # Filter by bounding box
+    def _fetch_insights(self, params, fields=None):
+        # Only the short-form columns, or those in fields, are selected and
+        # the items are read as rows, so ORM identities are never loaded.
+        # The row versions of the insight and of the shown author come along
+        # for the ETag.
+        columns = [*Insight.short_form_columns(fields), Insight.version]
+        if fields is None or "user" in fields:
+            columns.append(User.version.label("user_version"))
+        query = db.session.query(*columns).select_from(Insight)
+        if fields is None or "user" in fields or params["username"]:
+            query = query.outerjoin(Insight.user)
+
+        # Filter by bounding box, pruning candidates through the R-tree
         if params["bbox"]:
             min_lon, min_lat, max_lon, max_lat = params["bbox"]
             query = query.filter(
+                Insight.id.in_(bbox_candidates(min_lon, min_lat, max_lon, max_lat)),
                 Insight.longitude.between(min_lon, max_lon),
                 Insight.latitude.between(min_lat, max_lat),
             )
 
         # Filter by creator's username
         if params["username"]:
-            query = query.join(User).filter(User.username == params["username"])
+            query = query.filter(User.username == params["username"])
 
         # Filter by category
         if params["category"]:
@@ -188,30 +396,146 @@ class InsightCollection(Resource):
         if params["subcategory"]:
             query = query.filter(Insight.subcategory == params["subcategory"])
 
-        # Eager load the user relationship to avoid N+1 problem
-        query = query.options(joinedload(Insight.user))
+        # Filter by search words through the full-text index, best match first
+        if params["q"]:
+            query = search_insights(query, params["q"])
 
-        return query.all()
+        return query
 
-    def _build_insight_collection_response(self, insights, user=None):
+    def _build_insight_collection_response(self, user=None, controls="full"):
+        # Leaner levels skip building the controls rather than dropping them
         body = GeodataBuilder()
         body["@type"] = "insights"
+        if controls == "none":
+            return body
         body.add_control("self", url_for("api.insights"))
+        if controls == "minimal":
+            return body
         body.add_control_add_insight()
         body.add_control_user_collection()
+        if user:
+            body.add_control("up", url_for("api.user", user=user))
         auth_user = get_authenticated_user()
         if user and auth_user and auth_user.username == user.username:
-            body.add_control("up", url_for("api.user", user=user))
+            body.add_control_import_insights(user)
+
+        return body
+
+    def _item_builder(self, fields, controls):
+        """
+        Return a function rendering an item from the short form of an insight
+        and its optional distance, keeping only the requested fields and
+        controls.
+        """
+        template = insight_item_template().with_controls(controls)
+
+        def build_item(data, distance=None):
+            if distance is not None:
+                data["distance"] = round(distance, 1)
+            # Also drops the row versions
+            data = {key: data[key] for key in fields or INSIGHT_FIELDS if key in data}
+            return template.render(data, id=data["id"])
+
+        return build_item
+
+
+class InsightClusterCollection(Resource):
+    """
+    Resource for insight clusters, precomputed counts per grid cell used for
+    zoomed-out map views
+    """
+
+    def get(self):
+        """
+        Retrieve the insight clusters overlapping a bounding box.
+
+        Required query parameters:
+        - 'bbox': bounding box of the map view (format: minLon,minLat,maxLon,maxLat)
+        - 'zoom': cluster grid level from 0 to 16, cells are 360 / 2^zoom degrees
+
+        Each cluster has its insight count, centroid and a breakdown by
+        category, and links to the insights inside its cell.
+        """
+        try:
+            min_lon, min_lat, max_lon, max_lat = map(
+                float, request.args["bbox"].split(",")
+            )
+        except (KeyError, ValueError):
+            return GeodataBuilder.create_error_response(
+                400, "Invalid bbox format", "Expected format: bbox=25.4,65.0,25.6,65.1"
+            )
+        try:
+            zoom = int(request.args["zoom"])
+            if not 0 <= zoom <= MAX_CLUSTER_ZOOM:
+                raise ValueError
+        except (KeyError, ValueError):
+            return GeodataBuilder.create_error_response(
+                400,
+                "Invalid zoom",
+                f"zoom must be an integer from 0 to {MAX_CLUSTER_ZOOM}",
+            )
+
+        body = GeodataBuilder()
+        body["@type"] = "clusters"
+        body.add_namespace("geometa", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.insight_clusters"))
+        body.add_control_insights_all()
+        body["zoom"] = zoom
         body["items"] = []
 
-        for i in insights:
-            item = GeodataBuilder(i.serialize(short_form=True))
-            item["@type"] = "insight"
-            item.add_control("self", url_for("api.insight", insight=i))
-            item.add_control("profile", href=INSIGHT_PROFILE_URL)
+        for cluster in fetch_clusters(zoom, min_lon, min_lat, max_lon, max_lat):
+            item = GeodataBuilder(cluster)
+            item["@type"] = "cluster"
+            cell = ",".join(str(v) for v in cell_bbox(zoom, *cluster["cell"]))
+            item.add_control(
+                "collection",
+                url_for("api.insights", bbox=cell),
+                method="GET",
+                title="Insights in this cluster",
+            )
             body["items"].append(item)
 
-        return body
+        return mason_response(body, 200)
+
+
+class InsightImport(Resource):
+    """
+    Resource for importing a user's insights in bulk
+    """
+
+    def post(self, user):
+        """
+        Import insights from an NDJSON body, one insight per line, created by
+        the user. The request must be authenticated as that user.
+
+        The body is read line by line and every line is validated on its own.
+        Valid lines are inserted in batches, and the response reports the
+        number of imported insights and the errors of rejected lines.
+        """
+        if request.mimetype != NDJSON:
+            return GeodataBuilder.create_error_response(
+                415, "Unsupported Media Type", f"Content-Type must be {NDJSON}"
+            )
+
+        auth_user = get_authenticated_user()
+        if not auth_user:
+            return GeodataBuilder.create_error_response(
+                401,
+                "Authentication required",
+                "You must authenticate to import insights.",
+            )
+        if auth_user != user:
+            return GeodataBuilder.create_error_response(
+                403, "Forbidden", "You are not allowed to import as another user."
+            )
+
+        report = import_insights(request.stream, creator_id=user.id)
+
+        body = GeodataBuilder(report.serialize())
+        body["@type"] = "import"
+        body.add_namespace("geometa", LINK_RELATIONS_URL)
+        body.add_control("up", url_for("api.insights_by", user=user))
+        return mason_response(body, 200)
 
 
 class InsightItem(Resource):
@@ -219,20 +543,29 @@ class InsightItem(Resource):
     Resource for single insight with all the details
     """
 
-    @cache.cached()
     def get(self, insight, user=None):
         """
         Retrieve a single insight by its ID.
         No authentication required. Returns full details.
+
+        The public part of the body is cached per insight, the controls that
+        depend on the route and the caller are added per request.
         """
+        # No Last-Modified, as rating changes keep modified_date but change
+        # the body. The row versions cover them.
+        author = insight.user
+        headers, not_modified = conditional_get(
+            (insight.id, insight.version, author.version if author else None)
+        )
+        if not_modified:
+            return not_modified
+
         # Determine authenticated user via API key
         auth_user = get_authenticated_user()
 
-        body = GeodataBuilder(insight.serialize(short_form=False))
-        body["@type"] = "insight"
-        body.add_namespace("geometa", LINK_RELATIONS_URL)
-        body.add_control("self", url_for("api.insight", insight=insight))
-        body.add_control("profile", href=INSIGHT_PROFILE_URL)
+        body = cached_item_body(
+            "insight", insight.id, lambda: self._build_public_body(insight)
+        )
         body.add_control_insight_collection(user)
         body.add_control_feedback_collection(user, authuser=None, insight=insight)
         body.add_control_edit_insight(auth_user, insight)
@@ -240,7 +573,15 @@ class InsightItem(Resource):
         if user:
             body.add_control("author", url_for("api.user", user=insight.user))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200, headers)
+
+    def _build_public_body(self, insight):
+        body = GeodataBuilder(insight.serialize(short_form=False))
+        body["@type"] = "insight"
+        body.add_namespace("geometa", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.insight", insight=insight))
+        body.add_control("profile", href=INSIGHT_PROFILE_URL)
+        return body
 
     def put(self, insight, user=None):
         """
@@ -274,13 +615,14 @@ class InsightItem(Resource):
         # 3. Validate request body
         try:
             data = request.get_json()
-            validate(data, Insight.get_schema(), format_checker=draft7_format_checker)
+            validate_body(Insight, data)
         except ValidationError as e:
             return GeodataBuilder.create_error_response(
                 400, "Invalid request body", str(e)
             )
 
         # 4. Perform update
+        old_point = (insight.longitude, insight.latitude)
         insight.title = data["title"]
         insight.description = data["description"]
         insight.longitude = data["longitude"]
@@ -294,7 +636,9 @@ class InsightItem(Resource):
         db.session.commit()
 
         # 5. Invalidate cache
-        cache.delete(request.path)
+        invalidate_items("insight", insight.id)
+        invalidate_point(*old_point)
+        invalidate_point(insight.longitude, insight.latitude)
 
         # 6. Return updated resource with MASON format (or just 204 if preferred)
         body = GeodataBuilder(insight.serialize(short_form=False))
@@ -307,7 +651,7 @@ class InsightItem(Resource):
         body.add_control_edit_insight(auth_user, insight)
         body.add_control_delete_insight(auth_user, insight)
 
-        response = Response(json.dumps(body), 200, mimetype=MASON)
+        response = mason_response(body, 200)
         response.headers["Location"] = url_for("api.insight", insight=insight)
         return response
 
@@ -335,11 +679,15 @@ class InsightItem(Resource):
             )
 
         # 2. Delete the resource
+        old_point = (insight.longitude, insight.latitude)
+        feedback_ids = [feedback.id for feedback in insight.feedback]
         db.session.delete(insight)
         db.session.commit()
 
         # 3. Clear cache
-        cache.delete(request.path)
+        invalidate_items("insight", insight.id)
+        invalidate_items("feedback", *feedback_ids)
+        invalidate_point(*old_point)
 
         # 4. Return empty success response
-        return Response(status=204)
+        return mason_response(status=204)
@@ -0,0 +1,40 @@
+"""
+This module define resource for pictures.
+"""
+
+import os
+from flask import current_app, send_file
+from flask_restful import Resource
+from geodata.blobs import blob_path
+from geodata.utils import GeodataBuilder
+
+
+class Picture(Resource):
+    """
+    Resource for the pictures of the blob store, such as profile pictures and
+    their thumbnails
+    """
+
+    def get(self, name):
+        """
+        Return a picture by its blob name.
+
+        Blob names are content hashes, so the response can be cached for good
+        and is sent with the server's file wrapper (e.g. sendfile) without
+        being read into memory.
+        """
+        path = blob_path(name)
+        if path is None or not os.path.exists(path):
+            return GeodataBuilder.create_error_response(
+                404, "Not found", "No picture with this name."
+            )
+
+        response = send_file(
+            path,
+            etag=name.split(".")[0],
+            max_age=current_app.config["PICTURE_MAX_AGE"],
+            conditional=True,
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
@@ -3,20 +3,57 @@ This module define resource for user.
 """
 
 import json
-from flask import Response, request
+from flask import request
 from flask import url_for
 import flask_restful
 from sqlalchemy.exc import IntegrityError
-from jsonschema import validate, ValidationError, Draft7Validator
+from jsonschema import ValidationError
 from werkzeug.exceptions import Conflict, BadRequest, UnsupportedMediaType
+from geodata import db
 from geodata.models import *
+from geodata.blobs import schedule_thumbnail, set_profile_picture
+from geodata.hashing import HashQueueFull
 from geodata.auth import require_admin, require_user_auth, get_authenticated_user
-from geodata.utils import GeodataBuilder
+from geodata.schemas import validate_body
+from geodata.utils import (
+    GeodataBuilder,
+    MasonItemTemplate,
+    collection_response,
+    conditional_get,
+    invalidate_user_items,
+    item_template,
+    mason_response,
+    page_version,
+    paginate,
+    parse_page_params,
+    stream_collections,
+    url_template,
+)
 from geodata.constants import *
 import secrets
 from geodata.models import ApiKey
 
-draft7_format_checker = Draft7Validator.FORMAT_CHECKER
+
+@item_template
+def user_item_template():
+    """
+    Template for the short-form user items of the user collection.
+    """
+    template = MasonItemTemplate("user")
+    template.add_control("self", url_template("api.user", user="username"))
+    template.add_control("profile", href=USER_PROFILE_URL)
+    return template
+
+
+def _hash_queue_full_response():
+    """
+    Answer a request whose password could not be queued for hashing.
+    """
+    response = GeodataBuilder.create_error_response(
+        503, "Password hashing queue is full, try again later."
+    )
+    response.headers["Retry-After"] = "1"
+    return response
 
 
 class UserCollection(flask_restful.Resource):
@@ -28,23 +65,41 @@ class UserCollection(flask_restful.Resource):
 
         Returns a list of users with limited public information (short form).
         Adds Mason controls for self, user creation, and individual user access.
+        The collection is paged with the 'limit' and 'cursor' query parameters.
         """
 
+        page_params, error_response = parse_page_params()
+        if error_response:
+            return error_response
+
+        # Only the short-form columns are selected and read as rows, along
+        # with the row version for the ETag
+        query = db.session.query(*User.short_form_columns(), User.version)
+        page = paginate(query, User.id, *page_params, stream=stream_collections())
+
+        headers, not_modified = conditional_get(
+            page_version(page, lambda row: (row.id, row.version))
+        )
+        if not_modified:
+            return not_modified
+
         body = GeodataBuilder()
 
         body["@type"] = "users"
         body.add_control("self", url_for("api.users"))
         body.add_control_add_user()
         body.add_control_insight_collection()
-        body["items"] = []
-        for user in User.query.all():
-            item = GeodataBuilder(user.serialize(short_form=True))
-            item["@type"] = "user"
-            item.add_control("self", url_for("api.user", user=user))
-            item.add_control("profile", href=USER_PROFILE_URL)
-            body["items"].append(item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        template = user_item_template()
+
+        def build_item(row):
+            return template.render(
+                User.serialize_short_form(row), username=row.username
+            )
+
+        response = collection_response(body, page, build_item)
+        response.headers.update(headers)
+        return response
 
     def post(self):
         """
@@ -58,7 +113,7 @@ class UserCollection(flask_restful.Resource):
 
         try:
             data = request.get_json()
-            validate(data, User.get_schema(), format_checker=draft7_format_checker)
+            validate_body(User, data)
         except ValidationError as e:
             raise BadRequest(description=str(e)) from e
 
@@ -68,11 +123,16 @@ class UserCollection(flask_restful.Resource):
         ):
             raise Conflict("Username or email already exists.")
 
+        try:
+            password = User.hash_password(data["password"])
+        except HashQueueFull:
+            return _hash_queue_full_response()
+
         # Create new User
         new_user = User(
             username=data["username"],
             email=data["email"],
-            password=User.hash_password(data["password"]),
+            password=password,
             # phone=data["phone"],
             first_name=data["first_name"],
             last_name=data.get("last_name", ""),
@@ -108,7 +168,7 @@ class UserCollection(flask_restful.Resource):
         body["api_key"] = api_key_str
         body.add_control("self", url_for("api.user", user=new_user))
         body.add_control_user_collection()
-        response = Response(json.dumps(body), 201, mimetype=MASON)
+        response = mason_response(body, 201)
         response.headers["Location"] = url_for("api.user", user=new_user)
         return response
 
@@ -123,6 +183,12 @@ class UserItem(flask_restful.Resource):
         If the requester is the owner or an admin, returns full data.
         """
 
+        headers, not_modified = conditional_get(
+            (user.id, user.version), user.modified_date
+        )
+        if not_modified:
+            return not_modified
+
         # Get current authenticated user (may be None)
         current_user = get_authenticated_user()
 
@@ -145,7 +211,7 @@ class UserItem(flask_restful.Resource):
             body.add_control_edit_user(user)
             body.add_control_feedback_collection(user, authuser=current_user)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200, headers)
 
     def put(self, user):
         """
@@ -171,7 +237,7 @@ class UserItem(flask_restful.Resource):
         # Parse and validate JSON payload
         try:
             data = request.get_json()
-            validate(data, User.get_schema(), format_checker=draft7_format_checker)
+            validate_body(User, data)
         except ValidationError as e:
             return GeodataBuilder.create_error_response(400, f"Invalid input: {str(e)}")
         except Exception:
@@ -196,7 +262,10 @@ class UserItem(flask_restful.Resource):
         for field in allowed_fields:
             if field in data:
                 if field == "password":
-                    user.password = User().hash_password(data["password"])
+                    try:
+                        user.password = User.hash_password(data["password"])
+                    except HashQueueFull:
+                        return _hash_queue_full_response()
                 elif field == "status":
                     user.set_status(StatusEnum[data["status"].upper()])
                 elif field == "role":
@@ -209,6 +278,11 @@ class UserItem(flask_restful.Resource):
                             400, "You cannot remove your own admin rights."
                         )
                     user.set_role(RoleEnum[data["role"].upper()])
+                elif field == "profile_picture":
+                    try:
+                        set_profile_picture(user, data["profile_picture"])
+                    except ValueError as e:
+                        return GeodataBuilder.create_error_response(400, str(e))
                 else:
                     setattr(user, field, data[field])
 
@@ -219,6 +293,10 @@ class UserItem(flask_restful.Resource):
             return GeodataBuilder.create_error_response(
                 409, f"Database conflict: {str(e.orig)}"
             )
+        # Cached insights and feedback show the username
+        invalidate_user_items(user)
+        if user.profile_picture and not user.profile_picture_thumb:
+            schedule_thumbnail(user.id, user.profile_picture)
 
         # Build Mason-formatted response with updated user data
         body = GeodataBuilder(user.serialize())
@@ -228,7 +306,7 @@ class UserItem(flask_restful.Resource):
         body.add_control_edit_user(user)
         body.add_control_delete_user(user)
 
-        return Response(json.dumps(body), 204, mimetype=MASON)
+        return mason_response(body, 204)
 
     def delete(self, user):
         """
@@ -243,6 +321,7 @@ class UserItem(flask_restful.Resource):
                 403, "You are not authorized to deactivate this user."
             )
 
+        invalidate_user_items(user)
         db.session.delete(user)
         db.session.commit()
         # the exeption was not called throught tests
@@ -253,4 +332,4 @@ class UserItem(flask_restful.Resource):
         #         "Failed to delete user."
         #     )
 
-        return Response(status=204)
+        return mason_response(status=204)
@@ -0,0 +1,78 @@
+"""
+This module keeps one frozen JSON schema and one compiled validator per model,
+shared by request validation and the Mason schema controls.
+"""
+
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from .models import User, Insight, Feedback
+
+
+class FrozenDict(dict):
+    """
+    A dict that cannot be changed after it has been created.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("frozen schema cannot be modified")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+class FrozenList(list):
+    """
+    A list that cannot be changed after it has been created.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("frozen schema cannot be modified")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+def freeze(value):
+    """
+    Return a deep, immutable copy of a JSON value.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+
+def _compile(model):
+    schema = freeze(model.get_schema())
+    Draft7Validator.check_schema(schema)
+    return schema, Draft7Validator(
+        schema, format_checker=Draft7Validator.FORMAT_CHECKER
+    )
+
+
+_REGISTRY = {model: _compile(model) for model in (User, Insight, Feedback)}
+
+
+def get_schema(model):
+    """
+    Return the frozen schema of a model.
+    """
+    return _REGISTRY[model][0]
+
+
+def validate_body(model, data):
+    """
+    Validate a request body against the schema of a model. Raises the same
+    ValidationError jsonschema.validate would.
+    """
+    error = best_match(_REGISTRY[model][1].iter_errors(data))
+    if error is not None:
+        raise error
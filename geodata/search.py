@@ -0,0 +1,109 @@
+"""
+This module maintains the full-text index used by insight searches.
+
+The title, description, address and category of every insight are indexed
+in an SQLite FTS5 table that reads the text from the insight table itself,
+so the index stores no second copy of it. Triggers on the insight table keep
+the index in sync with every insert, delete and update of the indexed
+columns, so writes done through the ORM or plain SQL are covered alike.
+Matches are ranked with bm25, weighting titles above the other columns.
+"""
+
+import re
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, column, event, func, literal_column, table, text
+from geodata import db
+from geodata.models import Insight
+
+INSIGHT_FTS = table("insight_fts", column("rowid"), column("insight_fts"))
+
+# bm25 weights of the title, description, address and category columns
+RANK_WEIGHTS = (10.0, 1.0, 2.0, 4.0)
+
+_COLUMNS = "title, description, address, category"
+_NEW = "NEW.id, NEW.title, NEW.description, NEW.address, NEW.category"
+_OLD = "OLD.id, OLD.title, OLD.description, OLD.address, OLD.category"
+_ADD = f"INSERT INTO insight_fts(rowid, {_COLUMNS}) VALUES ({_NEW}); "
+_REMOVE = (
+    f"INSERT INTO insight_fts(insight_fts, rowid, {_COLUMNS}) "
+    f"VALUES ('delete', {_OLD}); "
+)
+
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS insight_fts "
+    f"USING fts5({_COLUMNS}, content='insight', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS insight_fts_insert AFTER INSERT ON insight "
+    f"BEGIN {_ADD}END",
+    "CREATE TRIGGER IF NOT EXISTS insight_fts_update "
+    f"AFTER UPDATE OF {_COLUMNS} ON insight "
+    f"BEGIN {_REMOVE}{_ADD}END",
+    "CREATE TRIGGER IF NOT EXISTS insight_fts_delete AFTER DELETE ON insight "
+    f"BEGIN {_REMOVE}END",
+]
+
+for statement in SEARCH_DDL:
+    event.listen(
+        Insight.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite"),
+    )
+event.listen(
+    Insight.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS insight_fts").execute_if(dialect="sqlite"),
+)
+
+
+def match_expression(q):
+    """
+    Turn free text into an FTS5 query in which every word must match, the
+    last one as a prefix so that results follow the user's typing. Returns
+    None if the text has no words.
+    """
+
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def search_insights(query, expression):
+    """
+    Restrict an insight query to the matches of an FTS5 query, best match
+    first.
+
+    Matches are scored with bm25() in the ORDER BY rather than with the
+    rank column, which FTS5 would compute for every match before the other
+    filters apply. This way a bbox or user filter cuts the scoring down to
+    the insights that pass it.
+    """
+
+    return (
+        query.join(INSIGHT_FTS, INSIGHT_FTS.c.rowid == Insight.id)
+        .filter(INSIGHT_FTS.c.insight_fts.match(expression))
+        .order_by(func.bm25(literal_column("insight_fts"), *RANK_WEIGHTS), Insight.id)
+    )
+
+
+def rebuild_search_index():
+    """
+    Create the full-text index and its triggers if missing and reindex every
+    insight. Returns the number of indexed insights.
+    """
+
+    for statement in SEARCH_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(text("INSERT INTO insight_fts(insight_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    return db.session.execute(text("SELECT count(*) FROM insight_fts")).scalar()
+
+
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the insight full-text index from the insight table."""
+    click.echo("Rebuilding the search index...")
+    count = rebuild_search_index()
+    click.echo(f"Search index rebuilt with {count} insights.")
@@ -0,0 +1,368 @@
+"""
+This module maintains the spatial structures used by insight bbox,
+nearest-neighbour and cluster queries.
+
+Insights are mirrored into an SQLite R-tree virtual table and counted into a
+grid of clusters per zoom level. Triggers on the insight table keep both in
+sync with every insert, update and delete, so writes done through the ORM or
+plain SQL are covered alike.
+"""
+
+import math
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import DDL, column, event, func, or_, select, table, text
+from geodata import db
+from geodata.models import Insight
+
+EARTH_RADIUS = 6371008.8  # mean radius in meters
+MAX_DISTANCE = math.pi * EARTH_RADIUS  # half the circumference
+FIRST_KNN_RADIUS = 1000.0
+
+INSIGHT_RTREE = table(
+    "insight_rtree",
+    column("id"),
+    column("min_lon"),
+    column("max_lon"),
+    column("min_lat"),
+    column("max_lat"),
+)
+
+RTREE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS insight_rtree "
+    "USING rtree(id, min_lon, max_lon, min_lat, max_lat)",
+    "CREATE TRIGGER IF NOT EXISTS insight_rtree_insert AFTER INSERT ON insight "
+    "BEGIN "
+    "INSERT OR REPLACE INTO insight_rtree VALUES "
+    "(NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS insight_rtree_update "
+    "AFTER UPDATE OF longitude, latitude ON insight "
+    "BEGIN "
+    "INSERT OR REPLACE INTO insight_rtree VALUES "
+    "(NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS insight_rtree_delete AFTER DELETE ON insight "
+    "BEGIN "
+    "DELETE FROM insight_rtree WHERE id = OLD.id; "
+    "END",
+]
+
+for statement in RTREE_DDL:
+    event.listen(
+        Insight.__table__,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite"),
+    )
+event.listen(
+    Insight.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS insight_rtree").execute_if(dialect="sqlite"),
+)
+
+
+# Cluster grid: at zoom z the world is cut into square cells of
+# 360 / 2**z degrees, so zoom 0 is one cell and zoom 16 cells are ~0.0055 deg.
+MAX_CLUSTER_ZOOM = 16
+
+INSIGHT_CLUSTER = db.Table(
+    "insight_cluster",
+    db.Column("zoom", db.Integer, primary_key=True),
+    db.Column("cell_x", db.Integer, primary_key=True),
+    db.Column("cell_y", db.Integer, primary_key=True),
+    # Empty string stands for insights without a category
+    db.Column("category", db.String(64), primary_key=True),
+    db.Column("count", db.Integer, nullable=False),
+    db.Column("sum_lon", db.Float, nullable=False),
+    db.Column("sum_lat", db.Float, nullable=False),
+)
+
+_ZOOMS = " UNION ALL ".join(
+    f"SELECT {zoom} AS zoom" for zoom in range(MAX_CLUSTER_ZOOM + 1)
+)
+
+
+def _cell_sql(row):
+    """
+    Return SQL selecting (zoom, cell_x, cell_y, category) of the trigger row
+    alias ("NEW" or "OLD") at every cluster zoom level.
+    """
+
+    return (
+        "SELECT zoom, "
+        f"CAST(({row}.longitude + 180.0) * (1 << zoom) / 360.0 AS INTEGER), "
+        f"CAST(({row}.latitude + 90.0) * (1 << zoom) / 360.0 AS INTEGER), "
+        f"COALESCE({row}.category, '') FROM ({_ZOOMS})"
+    )
+
+
+_CLUSTER_ADD = (
+    "INSERT INTO insight_cluster "
+    "(zoom, cell_x, cell_y, category, count, sum_lon, sum_lat) "
+    f"SELECT cells.*, 1, NEW.longitude, NEW.latitude FROM ({_cell_sql('NEW')}) AS cells "
+    "WHERE true "
+    "ON CONFLICT (zoom, cell_x, cell_y, category) DO UPDATE SET "
+    "count = count + 1, "
+    "sum_lon = sum_lon + excluded.sum_lon, "
+    "sum_lat = sum_lat + excluded.sum_lat; "
+)
+
+_CLUSTER_REMOVE = (
+    "UPDATE insight_cluster SET "
+    "count = count - 1, "
+    "sum_lon = sum_lon - OLD.longitude, "
+    "sum_lat = sum_lat - OLD.latitude "
+    f"WHERE (zoom, cell_x, cell_y, category) IN ({_cell_sql('OLD')}); "
+    "DELETE FROM insight_cluster WHERE count <= 0 "
+    f"AND (zoom, cell_x, cell_y, category) IN ({_cell_sql('OLD')}); "
+)
+
+CLUSTER_DDL = [
+    "CREATE TRIGGER IF NOT EXISTS insight_cluster_insert AFTER INSERT ON insight "
+    f"BEGIN {_CLUSTER_ADD}END",
+    "CREATE TRIGGER IF NOT EXISTS insight_cluster_update "
+    "AFTER UPDATE OF longitude, latitude, category ON insight "
+    f"BEGIN {_CLUSTER_REMOVE}{_CLUSTER_ADD}END",
+    "CREATE TRIGGER IF NOT EXISTS insight_cluster_delete AFTER DELETE ON insight "
+    f"BEGIN {_CLUSTER_REMOVE}END",
+]
+
+# The cluster triggers need both tables, so they run once all tables exist
+for statement in CLUSTER_DDL:
+    event.listen(
+        db.metadata,
+        "after_create",
+        DDL(statement).execute_if(dialect="sqlite"),
+    )
+
+
+def cell_of(zoom, lon, lat):
+    """
+    Return the (cell_x, cell_y) grid cell of a point at a cluster zoom level,
+    matching the cells computed by the triggers.
+    """
+
+    cells = 1 << zoom
+    return int((lon + 180.0) * cells / 360.0), int((lat + 90.0) * cells / 360.0)
+
+
+def cell_bbox(zoom, cell_x, cell_y):
+    """
+    Return the (min_lon, min_lat, max_lon, max_lat) bounds of a grid cell.
+    """
+
+    size = 360.0 / (1 << zoom)
+    min_lon = cell_x * size - 180.0
+    min_lat = cell_y * size - 90.0
+    return min_lon, min_lat, min_lon + size, min(90.0, min_lat + size)
+
+
+def fetch_clusters(zoom, min_lon, min_lat, max_lon, max_lat):
+    """
+    Return the precomputed clusters of the grid cells overlapping the
+    bounding box at the given zoom level. Each cluster is a dict with the
+    cell, total count, centroid and a per-category breakdown.
+    """
+
+    min_x, min_y = cell_of(zoom, min_lon, min_lat)
+    max_x, max_y = cell_of(zoom, max_lon, max_lat)
+    rows = db.session.execute(
+        select(INSIGHT_CLUSTER)
+        .where(
+            INSIGHT_CLUSTER.c.zoom == zoom,
+            INSIGHT_CLUSTER.c.cell_x.between(min_x, max_x),
+            INSIGHT_CLUSTER.c.cell_y.between(min_y, max_y),
+        )
+        .order_by(INSIGHT_CLUSTER.c.cell_x, INSIGHT_CLUSTER.c.cell_y)
+    )
+
+    clusters = {}
+    for row in rows:
+        cluster = clusters.setdefault(
+            (row.cell_x, row.cell_y),
+            {
+                "cell": [row.cell_x, row.cell_y],
+                "count": 0,
+                "sum": [0.0, 0.0],
+                "categories": [],
+            },
+        )
+        cluster["count"] += row.count
+        cluster["sum"][0] += row.sum_lon
+        cluster["sum"][1] += row.sum_lat
+        cluster["categories"].append(
+            {"category": row.category or None, "count": row.count}
+        )
+
+    for cluster in clusters.values():
+        sum_lon, sum_lat = cluster.pop("sum")
+        cluster["longitude"] = round(sum_lon / cluster["count"], 6)
+        cluster["latitude"] = round(sum_lat / cluster["count"], 6)
+        cluster["categories"].sort(key=lambda entry: -entry["count"])
+    return list(clusters.values())
+
+
+def bbox_candidates(min_lon, min_lat, max_lon, max_lat):
+    """
+    Return a subquery selecting the ids of insights whose coordinates fall
+    inside the bounding box according to the R-tree.
+
+    The R-tree stores 32-bit floats rounded outwards, so callers should keep
+    the exact coordinate filter to drop the occasional edge candidate.
+    """
+
+    return select(INSIGHT_RTREE.c.id).where(
+        INSIGHT_RTREE.c.min_lon <= max_lon,
+        INSIGHT_RTREE.c.max_lon >= min_lon,
+        INSIGHT_RTREE.c.min_lat <= max_lat,
+        INSIGHT_RTREE.c.max_lat >= min_lat,
+    )
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Return the great-circle distance in meters between two points given in
+    decimal degrees.
+    """
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bboxes(lon, lat, radius):
+    """
+    Return the bounding boxes (min_lon, min_lat, max_lon, max_lat) that
+    together cover every point within radius meters of (lon, lat). Circles
+    crossing the antimeridian are split in two, and circles reaching a pole
+    cover every longitude.
+    """
+
+    d_lat = math.degrees(radius / EARTH_RADIUS)
+    min_lat, max_lat = max(-90.0, lat - d_lat), min(90.0, lat + d_lat)
+    if min_lat == -90.0 or max_lat == 90.0:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+
+    # Widest longitude span of the circle, reached off the center latitude
+    ratio = math.sin(radius / EARTH_RADIUS) / math.cos(math.radians(lat))
+    if ratio >= 1.0:
+        return [(-180.0, min_lat, 180.0, max_lat)]
+    d_lon = math.degrees(math.asin(ratio))
+
+    min_lon, max_lon = lon - d_lon, lon + d_lon
+    if min_lon < -180.0:
+        return [
+            (min_lon + 360.0, min_lat, 180.0, max_lat),
+            (-180.0, min_lat, max_lon, max_lat),
+        ]
+    if max_lon > 180.0:
+        return [
+            (min_lon, min_lat, 180.0, max_lat),
+            (-180.0, min_lat, max_lon - 360.0, max_lat),
+        ]
+    return [(min_lon, min_lat, max_lon, max_lat)]
+
+
+def _within_radius(query, lon, lat, radius):
+    """
+    Return (insight, distance) pairs of the query within radius meters of
+    (lon, lat). Only the R-tree candidates of the covering boxes are loaded.
+    """
+
+    candidates = [
+        Insight.id.in_(bbox_candidates(*bbox))
+        for bbox in radius_bboxes(lon, lat, radius)
+    ]
+    found = []
+    for insight in query.filter(or_(*candidates)):
+        distance = haversine(lon, lat, insight.longitude, insight.latitude)
+        if distance <= radius:
+            found.append((insight, distance))
+    return found
+
+
+def nearby_insights(query, lon, lat, radius=None, k=None):
+    """
+    Return (insight, distance) pairs from the query sorted by great-circle
+    distance from (lon, lat), limited to radius meters and/or the k nearest.
+
+    For a plain k-nearest search the radius starts small and quadruples until
+    k insights are found, so each round only loads the insights of a few
+    R-tree cells around the point.
+    """
+
+    if k is None:
+        found = _within_radius(query, lon, lat, radius)
+    else:
+        limit = min(radius, MAX_DISTANCE) if radius is not None else MAX_DISTANCE
+        search = min(FIRST_KNN_RADIUS, limit)
+        while True:
+            found = _within_radius(query, lon, lat, search)
+            if len(found) >= k or search >= limit:
+                break
+            search = min(search * 4, limit)
+
+    found.sort(key=lambda pair: pair[1])
+    return found[:k] if k is not None else found
+
+
+def rebuild_spatial_index():
+    """
+    Create the R-tree and its triggers if missing and repopulate it from the
+    insight table. Returns the number of indexed insights.
+    """
+
+    for statement in RTREE_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(text("DELETE FROM insight_rtree"))
+    db.session.execute(
+        text(
+            "INSERT INTO insight_rtree "
+            "SELECT id, longitude, longitude, latitude, latitude FROM insight"
+        )
+    )
+    db.session.commit()
+    return db.session.execute(text("SELECT count(*) FROM insight_rtree")).scalar()
+
+
+def rebuild_clusters():
+    """
+    Create the cluster table and its triggers if missing and recount every
+    zoom level from the insight table. Returns the number of clusters.
+    """
+
+    INSIGHT_CLUSTER.create(db.session.connection(), checkfirst=True)
+    for statement in CLUSTER_DDL:
+        db.session.execute(text(statement))
+    db.session.execute(INSIGHT_CLUSTER.delete())
+    db.session.execute(
+        text(
+            "INSERT INTO insight_cluster "
+            "SELECT zoom, "
+            "CAST((longitude + 180.0) * (1 << zoom) / 360.0 AS INTEGER) AS x, "
+            "CAST((latitude + 90.0) * (1 << zoom) / 360.0 AS INTEGER) AS y, "
+            "COALESCE(category, '') AS c, "
+            "count(*), sum(longitude), sum(latitude) "
+            f"FROM insight, ({_ZOOMS}) GROUP BY zoom, x, y, c"
+        )
+    )
+    db.session.commit()
+    return db.session.execute(
+        select(func.count()).select_from(INSIGHT_CLUSTER)
+    ).scalar()
+
+
+@click.command("rebuild-spatial-index")
+@with_appcontext
+def rebuild_spatial_index_command():
+    """Rebuild the insight R-tree and clusters from the insight table."""
+    click.echo("Rebuilding the spatial index...")
+    count = rebuild_spatial_index()
+    click.echo(f"Spatial index rebuilt with {count} insights.")
+    count = rebuild_clusters()
+    click.echo(f"Cluster grid rebuilt with {count} clusters.")
@@ -0,0 +1,77 @@
+"""
+This module tunes SQLite for several server processes writing to one
+database file.
+
+With the default rollback journal a writer locks out every reader, and a
+busy database fails at once with "database is locked". The production
+profile switches the database to WAL, so that readers and the writer do not
+block each other, and makes connections wait for the write lock instead of
+failing. The pragmas are applied to every new connection.
+"""
+
+import os
+import weakref
+from sqlalchemy import event
+
+# Pragmas of the production profile, applied in this order on connect
+PRODUCTION_PRAGMAS = {
+    # Readers don't block the writer and the writer doesn't block readers
+    "journal_mode": "WAL",
+    # Wait up to 5 s for the write lock instead of failing right away
+    "busy_timeout": 5000,
+    # Safe with WAL, syncs at checkpoints rather than every commit
+    "synchronous": "NORMAL",
+    # Read the first 256 MiB of the file through mmap
+    "mmap_size": 268435456,
+    # 64 MiB page cache per connection (negative values are KiB)
+    "cache_size": -65536,
+    "temp_store": "MEMORY",
+}
+
+# Connection pool of each server process: a sync worker needs one
+# connection, the rest is for the thumbnail and background threads
+PRODUCTION_ENGINE_OPTIONS = {
+    "pool_size": 5,
+    "max_overflow": 5,
+    "pool_recycle": 3600,
+}
+
+
+# Engines whose pooled connections are dropped in forked children. The set
+# does not keep engines alive, so apps created again and again, e.g. by
+# tests, do not pile up.
+_fork_engines = weakref.WeakSet()
+
+
+def _dispose_after_fork():
+    for engine in list(_fork_engines):
+        engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_after_fork)
+
+
+def _apply_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return on_connect
+
+
+def configure_engine(app, db):
+    """
+    Apply the SQLITE_PRAGMAS config option to every new connection of the
+    app's SQLite engine. Connections inherited through fork, e.g. when
+    gunicorn preloads the app, are dropped in the child.
+    """
+    pragmas = app.config.get("SQLITE_PRAGMAS")
+    with app.app_context():
+        engine = db.engine
+    if not pragmas or engine.dialect.name != "sqlite":
+        return
+    event.listen(engine, "connect", _apply_pragmas(pragmas))
+    _fork_engines.add(engine)
@@ -0,0 +1,337 @@
+"""
+This module generates synthetic users, insights and feedback for running the
+API at production scale locally.
+
+Insights are clustered around cities weighted by population, spread with a
+normal distribution of the city's radius, and follow a skewed category mix.
+Users create insights and rate them with a power-law activity, and feedback
+counts per insight follow a Pareto popularity, so a few insights collect
+most of the ratings. The same seed always generates the same data.
+
+Rows are inserted in batches with executemany, one transaction per batch.
+Rating aggregates are computed while the feedback is generated, and the
+spatial and search triggers are dropped during the load and replaced by one
+rebuild of the R-tree, the cluster grid and the full-text index at the end.
+"""
+
+import math
+import random
+import time
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, text
+from geodata import db
+from geodata.models import RATING_RANGE, Feedback, Insight, User
+from geodata.search import rebuild_search_index
+from geodata.spatial import rebuild_clusters, rebuild_spatial_index
+from geodata.tiles import invalidate_points
+from geodata.utils import invalidate_items
+
+GENERATE_BATCH_SIZE = 10000
+
+# Generated dates fall in the two years before this date
+END_DATE = datetime(2025, 1, 1)
+DATE_SPAN = timedelta(days=730).total_seconds()
+
+# (name, longitude, latitude, population in thousands, radius in km)
+CITIES = (
+    ("Helsinki", 24.9384, 60.1699, 1300, 15),
+    ("Tampere", 23.7610, 61.4978, 400, 10),
+    ("Turku", 22.2666, 60.4518, 330, 9),
+    ("Oulu", 25.4651, 65.0121, 260, 8),
+    ("Jyväskylä", 25.7473, 62.2426, 180, 7),
+    ("Kuopio", 27.6782, 62.8924, 150, 6),
+    ("Rovaniemi", 25.7294, 66.5039, 65, 6),
+    ("Stockholm", 18.0686, 59.3293, 2400, 18),
+    ("Oslo", 10.7522, 59.9139, 1500, 14),
+    ("Copenhagen", 12.5683, 55.6761, 2000, 15),
+    ("Tallinn", 24.7536, 59.4370, 450, 9),
+    ("Berlin", 13.4050, 52.5200, 3700, 22),
+    ("London", -0.1276, 51.5072, 9500, 30),
+    ("Paris", 2.3522, 48.8566, 11000, 25),
+    ("New York", -74.0060, 40.7128, 8300, 30),
+    ("Tokyo", 139.6917, 35.6895, 14000, 35),
+)
+
+# (category, weight, subcategories); None stands for uncategorized insights
+CATEGORIES = (
+    ("Food & Drink", 30, ("Cafe", "Restaurant", "Bar", "Bakery", "Food truck")),
+    ("Outdoor", 18, ("Park", "Trail", "Beach", "Playground", "Viewpoint")),
+    ("Infrastructure", 14, ("Parking", "Charging station", "Toilet", "Bike rack")),
+    ("Shopping", 12, ("Grocery", "Market", "Second hand", "Bookstore")),
+    ("Culture", 8, ("Museum", "Gallery", "Library", "Theatre")),
+    ("Services", 6, ("Pharmacy", "Repair", "Post office")),
+    ("Safety", 2, ("Hazard", "Construction", "Flooding")),
+    (None, 10, (None,)),
+)
+
+STREETS = (
+    "Main Street",
+    "Station Road",
+    "Harbour Lane",
+    "Park Avenue",
+    "Market Square",
+    "Church Street",
+    "Mill Road",
+    "River Walk",
+)
+
+COMMENTS = {
+    1: ("Not worth it.", "Closed when I went.", "Wrong location."),
+    2: ("Could be better.", "Hard to find.", "Crowded and noisy."),
+    3: ("Okay.", "Does the job.", "Nothing special."),
+    4: ("Nice place.", "Useful tip, thanks!", "Would come again."),
+    5: ("Great insight!", "Hidden gem.", "Exactly as described."),
+}
+
+FIRST_NAMES = ("Aino", "Eetu", "Emma", "Leo", "Olivia", "Noah", "Sofia", "Elias")
+LAST_NAMES = ("Korhonen", "Virtanen", "Smith", "Nguyen", "Müller", "Tanaka")
+
+# Shares of feedback that is anonymous, has no rating and has a comment
+ANONYMOUS_SHARE = 0.15
+UNRATED_SHARE = 0.05
+COMMENT_SHARE = 0.3
+
+# Pareto shape of insight popularity, 1.16 gives the 80/20 rule
+POPULARITY_SHAPE = 1.16
+
+
+def _cumulative(weights):
+    total = 0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+class SyntheticData:
+    """
+    Deterministic generator of synthetic rows. Users get ids from
+    first_user_id on and insights from first_insight_id on, so that the
+    generated rows can reference each other without reading ids back.
+    """
+
+    def __init__(
+        self, seed, users, insights, feedback, first_user_id=1, first_insight_id=1
+    ):
+        self.seed = seed
+        self.users = users
+        self.insights = insights
+        self.feedback = feedback
+        self.first_user_id = first_user_id
+        self.first_insight_id = first_insight_id
+        self._city_weights = _cumulative(city[3] for city in CITIES)
+        self._category_weights = _cumulative(category[1] for category in CATEGORIES)
+
+    def _date(self, rng, after=None):
+        start = (after - END_DATE).total_seconds() if after else -DATE_SPAN
+        return END_DATE + timedelta(seconds=rng.uniform(start, 0))
+
+    def _skewed_user(self, rng, exponent):
+        """
+        Return a user id, low ids being picked more often the higher the
+        exponent.
+        """
+        return self.first_user_id + int(self.users * rng.random() ** exponent)
+
+    def user_rows(self, prefix, password):
+        """
+        Yield the user rows. All users share one password hash, as hashing
+        a password per user would take hours, and which is the only part of
+        the data that differs between runs.
+        """
+        rng = random.Random(f"{self.seed}-users")
+        for user_id in range(self.first_user_id, self.first_user_id + self.users):
+            created = self._date(rng)
+            yield {
+                "id": user_id,
+                "username": f"{prefix}{user_id}",
+                "email": f"{prefix}{user_id}@example.com",
+                "password": password,
+                "first_name": rng.choice(FIRST_NAMES),
+                "last_name": rng.choice(LAST_NAMES),
+                "created_date": created,
+                "modified_date": created,
+            }
+
+    def _feedback_counts(self):
+        """
+        Yield the number of feedback of every insight. Counts follow the
+        insights' Pareto popularity and add up to exactly self.feedback.
+        """
+        rng = random.Random(f"{self.seed}-popularity")
+        total = sum(rng.paretovariate(POPULARITY_SHAPE) for _ in range(self.insights))
+        rng = random.Random(f"{self.seed}-popularity")
+        offset = rng.random()
+        expected = 0.0
+        previous = 0
+        for _ in range(self.insights - 1):
+            expected += self.feedback * rng.paretovariate(POPULARITY_SHAPE) / total
+            current = min(self.feedback, math.floor(expected + offset))
+            yield current - previous
+            previous = current
+        # The last insight takes what float rounding has left over
+        yield self.feedback - previous
+
+    def _insight_row(self, rng, insight_id):
+        city = rng.choices(CITIES, cum_weights=self._city_weights)[0]
+        name, lon, lat, _, radius = city
+        category = rng.choices(CATEGORIES, cum_weights=self._category_weights)[0]
+        category, _, subcategories = category
+        subcategory = rng.choice(subcategories)
+        # Most insights are in the centre, a few in the surroundings
+        spread = radius if rng.random() < 0.9 else radius * 4
+        latitude = lat + rng.gauss(0, spread / 111.32)
+        longitude = lon + rng.gauss(0, spread / (111.32 * math.cos(math.radians(lat))))
+        created = self._date(rng)
+        return {
+            "id": insight_id,
+            "title": f"{subcategory or 'Spot'} in {name}",
+            "description": f"A {(subcategory or 'place').lower()} worth knowing "
+            f"about in {name}.",
+            "longitude": round(max(-180.0, min(180.0, longitude)), 6),
+            "latitude": round(max(-90.0, min(90.0, latitude)), 6),
+            "created_date": created,
+            "modified_date": created,
+            "creator": self._skewed_user(rng, 3) if self.users else None,
+            "category": category,
+            "subcategory": subcategory,
+            "address": f"{rng.randint(1, 200)} {rng.choice(STREETS)}, {name}",
+            "rating_count": 0,
+            "rating_sum": 0,
+            **{f"rating_{star}": 0 for star in RATING_RANGE},
+        }
+
+    def _feedback_rows(self, rng, insight, count):
+        """
+        Return the feedback rows of an insight and add their ratings to its
+        aggregates. Ratings scatter around the insight's own quality.
+        """
+        quality = rng.gauss(3.8, 0.7)
+        rows = []
+        for _ in range(count):
+            rating = None
+            if rng.random() >= UNRATED_SHARE:
+                rating = max(1, min(5, round(rng.gauss(quality, 1.0))))
+                insight["rating_count"] += 1
+                insight["rating_sum"] += rating
+                insight[f"rating_{rating}"] += 1
+            comment = None
+            if rating is None or rng.random() < COMMENT_SHARE:
+                comment = rng.choice(COMMENTS[rating or 3])
+            user_id = None
+            if self.users and rng.random() >= ANONYMOUS_SHARE:
+                user_id = self._skewed_user(rng, 2)
+            created = self._date(rng, after=insight["created_date"])
+            rows.append(
+                {
+                    "insight_id": insight["id"],
+                    "user_id": user_id,
+                    "rating": rating,
+                    "comment": comment,
+                    "created_date": created,
+                    "modified_date": created,
+                }
+            )
+        return rows
+
+    def insight_batches(self, batch_size):
+        """
+        Yield (insight rows, feedback rows) batches of at most batch_size
+        insights, with the insights' rating aggregates filled in.
+        """
+        rng = random.Random(f"{self.seed}-insights")
+        insights = []
+        feedback = []
+        counts = self._feedback_counts()
+        for offset in range(self.insights):
+            insight = self._insight_row(rng, self.first_insight_id + offset)
+            feedback += self._feedback_rows(rng, insight, next(counts))
+            insights.append(insight)
+            if len(insights) >= batch_size:
+                yield insights, feedback
+                insights, feedback = [], []
+        if insights:
+            yield insights, feedback
+
+
+def _next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def generate_data(
+    seed, users, insights, feedback, prefix="synth", batch_size=GENERATE_BATCH_SIZE
+):
+    """
+    Generate and insert synthetic data after the existing rows. Returns the
+    SyntheticData that was inserted.
+    """
+    data = SyntheticData(
+        seed, users, insights, feedback, _next_id(User), _next_id(Insight)
+    )
+
+    password = User.hash_password("password")
+    batch = []
+    for row in data.user_rows(prefix, password):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(insert(User.__table__), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(insert(User.__table__), batch)
+        db.session.commit()
+
+    # The spatial and search indexes are rebuilt once at the end, which is
+    # much faster than updating them row by row
+    db.session.execute(text("DROP TRIGGER IF EXISTS insight_rtree_insert"))
+    db.session.execute(text("DROP TRIGGER IF EXISTS insight_cluster_insert"))
+    db.session.execute(text("DROP TRIGGER IF EXISTS insight_fts_insert"))
+    first_feedback_id = _next_id(Feedback)
+    points = []
+    try:
+        for insight_rows, feedback_rows in data.insight_batches(batch_size):
+            db.session.execute(insert(Insight.__table__), insight_rows)
+            if feedback_rows:
+                db.session.execute(insert(Feedback.__table__), feedback_rows)
+            db.session.commit()
+            points += ((row["longitude"], row["latitude"]) for row in insight_rows)
+    finally:
+        db.session.rollback()
+        rebuild_spatial_index()
+        rebuild_clusters()
+        rebuild_search_index()
+
+    # Only the tiles and items of the new rows changed; the rest of the
+    # cache, e.g. feedback statuses, stays
+    invalidate_points(points)
+    invalidate_items(
+        "insight", *range(data.first_insight_id, data.first_insight_id + len(points))
+    )
+    invalidate_items("feedback", *range(first_feedback_id, _next_id(Feedback)))
+    return data
+
+
+@click.command("generate-data")
+@click.option("--users", default=10000, show_default=True)
+@click.option("--insights", default=100000, show_default=True)
+@click.option("--feedback", default=500000, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--prefix", default="synth", show_default=True, help="Prefix of usernames."
+)
+@click.option("--batch-size", default=GENERATE_BATCH_SIZE, show_default=True)
+@with_appcontext
+def generate_data_command(users, insights, feedback, seed, prefix, batch_size):
+    """Add synthetic users, insights and feedback for benchmarking."""
+    if feedback and not insights:
+        raise click.BadParameter("Feedback needs insights.", param_hint="--feedback")
+    start = time.perf_counter()
+    data = generate_data(seed, users, insights, feedback, prefix, batch_size)
+    click.echo(
+        f"Generated {data.users} users, {data.insights} insights and "
+        f"{data.feedback} feedback in {time.perf_counter() - start:.1f} s. "
+        f"Users log in with the password 'password'."
+    )
@@ -0,0 +1,163 @@
+"""
+This module caches insight bbox queries per map tile.
+
+A bbox request is snapped to the tiles of the cluster grid (see
+geodata.spatial) and every tile's short-form insights are cached on their
+own, keyed by tile and category filters. Overlapping and panned map views
+then share most of their tiles. Each tile has a version token in the cache,
+and insight writes replace the tokens of the tiles containing the insight's
+old and new coordinates, which invalidates exactly those tiles for every
+filter combination.
+
+Tiles holding more than MAX_TILE_ITEMS insights are not cached. They are
+marked dense instead, and bboxes touching a dense tile are answered by the
+keyset paginated query, so that the cost of a page never grows with the
+number of insights in the bbox.
+"""
+
+import uuid
+from collections import defaultdict
+from geodata import cache
+from geodata.spatial import cell_bbox, cell_of
+
+# Bboxes spanning more than MAX_TILES tiles at MIN_TILE_ZOOM bypass the cache
+MIN_TILE_ZOOM = 8
+MAX_TILE_ZOOM = 16
+MAX_TILES = 16
+# Tiles with more insights are marked dense and bypass the cache
+MAX_TILE_ITEMS = 256
+DENSE = "dense"
+
+# Hit and miss counters per (zoom, x, y) tile, kept per process
+tile_stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+
+def tiles_for_bbox(min_lon, min_lat, max_lon, max_lat):
+    """
+    Return (zoom, tiles) for the finest zoom level at which the bbox is
+    covered by at most MAX_TILES tiles, where tiles is a list of (x, y).
+    Returns None if the bbox is empty or too large to be cached.
+    """
+
+    min_lon, max_lon = max(-180.0, min_lon), min(180.0, max_lon)
+    min_lat, max_lat = max(-90.0, min_lat), min(90.0, max_lat)
+    if min_lon > max_lon or min_lat > max_lat:
+        return None
+
+    for zoom in range(MAX_TILE_ZOOM, MIN_TILE_ZOOM - 1, -1):
+        min_x, min_y = cell_of(zoom, min_lon, min_lat)
+        max_x, max_y = cell_of(zoom, max_lon, max_lat)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) <= MAX_TILES:
+            return zoom, [
+                (x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)
+            ]
+    return None
+
+
+def _version_key(zoom, x, y):
+    return f"tiles/{zoom}/{x}/{y}"
+
+
+def cached_bbox_items(bbox, category, subcategory, load_tile, timeout=None):
+    """
+    Return the short-form insight data inside the bbox sorted by id, along
+    with the number of tile cache hits and misses, or None if the bbox is
+    not cacheable because it spans too many tiles or a dense one.
+
+    : param tuple bbox: (min_lon, min_lat, max_lon, max_lat)
+    : param str category: category filter or None
+    : param str subcategory: subcategory filter or None
+    : param load_tile: function returning the short-form data of at most
+        the given number of insights inside a tile bbox, called on cache
+        misses
+    : param int timeout: cache timeout of tile entries in seconds
+    """
+
+    tiles = tiles_for_bbox(*bbox)
+    if tiles is None:
+        return None
+    zoom, cells = tiles
+
+    version_keys = [_version_key(zoom, x, y) for x, y in cells]
+    versions = cache.get_many(*version_keys)
+    new_versions = {}
+    for index, version in enumerate(versions):
+        if version is None:
+            # A missing token must never match entries cached under an
+            # evicted one, so start from a fresh random token
+            version = versions[index] = uuid.uuid4().hex
+            new_versions[version_keys[index]] = version
+    if new_versions:
+        cache.set_many(new_versions, timeout=0)
+
+    entry_keys = [
+        f"{version_key}/{version}/{category or ''}/{subcategory or ''}"
+        for version_key, version in zip(version_keys, versions)
+    ]
+    entries = cache.get_many(*entry_keys)
+
+    hits = misses = 0
+    missing = {}
+    by_id = {}
+    dense = False
+    for (x, y), entry_key, entry in zip(cells, entry_keys, entries):
+        if entry is None:
+            loaded = load_tile(cell_bbox(zoom, x, y), MAX_TILE_ITEMS + 1)
+            # Tile bboxes share their edges, keep only the points that
+            # cell_of puts in this tile so invalidation finds every copy
+            entry = [
+                data
+                for data in loaded
+                if cell_of(zoom, data["longitude"], data["latitude"]) == (x, y)
+            ]
+            if len(loaded) > MAX_TILE_ITEMS:
+                entry = DENSE
+            missing[entry_key] = entry
+            tile_stats[(zoom, x, y)]["misses"] += 1
+            misses += 1
+        else:
+            tile_stats[(zoom, x, y)]["hits"] += 1
+            hits += 1
+        if entry == DENSE:
+            dense = True
+        elif not dense:
+            for data in entry:
+                by_id[data["id"]] = data
+    if missing:
+        cache.set_many(missing, timeout=timeout)
+    if dense:
+        return None
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    items = [
+        data
+        for data in by_id.values()
+        if min_lon <= data["longitude"] <= max_lon
+        and min_lat <= data["latitude"] <= max_lat
+    ]
+    items.sort(key=lambda data: data["id"])
+    return items, hits, misses
+
+
+def invalidate_point(lon, lat):
+    """
+    Invalidate the cached tiles containing a point at every tile zoom level.
+    Call with both the old and the new coordinates of a written insight.
+    """
+
+    invalidate_points([(lon, lat)])
+
+
+def invalidate_points(points):
+    """
+    Invalidate the cached tiles containing any of the (lon, lat) points, each
+    tile once however many of the points it contains.
+    """
+
+    keys = {
+        _version_key(zoom, *cell_of(zoom, lon, lat))
+        for lon, lat in points
+        for zoom in range(MIN_TILE_ZOOM, MAX_TILE_ZOOM + 1)
+    }
+    if keys:
+        cache.set_many({key: uuid.uuid4().hex for key in keys}, timeout=0)
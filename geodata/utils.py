@@ -2,14 +2,146 @@
 This module define shared utilities in app
 """
 
+import base64
+import binascii
+import bisect
+import hashlib
 import json
+import time
+from datetime import date, datetime, timezone
+from functools import wraps
+from urllib.parse import urlencode
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date, quote_etag
 from werkzeug.routing import BaseConverter
-from flask import request, Response, url_for
+from flask import current_app, request, Response, stream_with_context, url_for
 from geodata.constants import *
+from geodata import cache
 
+from geodata.auth import authenticate
+from geodata.metrics import record_serialization
 from geodata.models import User, Insight, Feedback
+from geodata.schemas import get_schema
+from geodata.tiles import invalidate_points
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _encode_json(value):
+    return json.dumps(value, default=_json_default).encode()
+
+
+def _encode_orjson(value):
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+
+# Encoders usable as the JSON_ENCODER config option, all returning bytes and
+# writing datetimes in ISO 8601
+ENCODERS = {"json": _encode_json}
+if orjson is not None:
+    ENCODERS["orjson"] = _encode_orjson
+
+
+def encode(value):
+    """
+    Encode a value to JSON bytes with the encoder selected by the JSON_ENCODER
+    config option, falling back to the standard library encoder.
+    """
+    name = current_app.config.get("JSON_ENCODER", "orjson")
+    start = time.perf_counter()
+    data = ENCODERS.get(name, _encode_json)(value)
+    record_serialization(time.perf_counter() - start)
+    return data
+
+
+def mason_response(body=None, status=200, headers=None):
+    """
+    Create a Mason response, encoding body if one is given.
+
+    : param dict body: the Mason document, or None for an empty response
+    : param int status: HTTP status code
+    : param dict headers: extra response headers
+    """
+    if body is None:
+        return Response(status=status, headers=headers)
+    return Response(encode(body), status, headers=headers, mimetype=MASON)
+
+
+def conditional_get(version, last_modified=None):
+    """
+    Check the conditional headers of a GET request against the current
+    version of the representation, before anything is serialized.
+
+    The strong ETag covers the version, the request URL, the caller (whose
+    rights decide the controls) and the encoding options. If-None-Match
+    takes precedence over If-Modified-Since.
+
+    Returns (headers, response): headers are the ETag, Last-Modified and
+    Vary headers to send with the representation, and response is a 304
+    response if the client's copy is current, else None.
+
+    : param version: hashable value that changes whenever the representation
+        does, or None if it is not known up front, in which case no
+        validators are sent
+    : param datetime last_modified: naive UTC time of the last change
+    """
+    if version is None:
+        return {}, None
+    auth_user, admin = authenticate()
+    caller = (auth_user.id, auth_user.role, admin) if auth_user else None
+    config = current_app.config
+    key = (
+        request.full_path,
+        caller,
+        config.get("JSON_ENCODER"),
+        config.get("STREAM_COLLECTIONS"),
+        version,
+    )
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+    headers = {"ETag": quote_etag(etag), "Vary": "Authorization"}
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        headers["Last-Modified"] = http_date(last_modified)
+
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        current = last_modified <= request.if_modified_since
+    else:
+        current = False
+    return headers, mason_response(status=304, headers=headers) if current else None
+
+
+def page_version(page, row_version):
+    """
+    Return the version of a page of a collection: the row_version of each of
+    its items and its cursors. It is read off the rows already fetched for
+    the page, so validating a collection costs nothing beyond the page
+    itself, however large the collection. Returns None for a streamed page,
+    whose rows are only read while the body is sent.
+
+    : param Page page: the page of the collection
+    : param row_version: function returning a hashable version of an item,
+        e.g. its id and row version
+    """
+    if isinstance(page, StreamingPage):
+        return None
+    return (
+        tuple(row_version(item) for item in page.items),
+        page.next_cursor,
+        page.prev_cursor,
+    )
 
 
 # NOTE: This class called MasonBuilder is copied from sensorhub example,
@@ -164,15 +296,17 @@ class GeodataBuilder(MasonBuilder):
     def add_control_insights_all(self):
         """
         Add a control to get all insights with optional
-        filters (bbox, category, subcategory).
+        filters (bbox, category, subcategory), around a point (near) or
+        matching search words (q).
         """
         self.add_control(
             "geometa:insights-all",
-            url_for("api.insights") + "{?bbox,usr,ic,isc}",
+            url_for("api.insights")
+            + "{?bbox,usr,ic,isc,near,radius,k,q,limit,cursor,fields,controls}",
             isHrefTemplate=True,
             method="GET",
             title="Get all insights with optional filters",
-            description="Query parameters: bbox=25.4,65.0,25.6,65.1 | usr=username | ic=category | isc=subcategory",
+            description="Query parameters: bbox=25.4,65.0,25.6,65.1 | usr=username | ic=category | isc=subcategory | near=25.47,65.01 with radius=500 (meters) and/or k=10, sorted by distance and not paged | q=search words, sorted by relevance and not paged | limit=100 | cursor=<from next/prev> | fields=longitude,latitude (id is always included) | controls=full, minimal or none",
         )
 
     def add_control_insights_by(self, user):
@@ -197,7 +331,7 @@ class GeodataBuilder(MasonBuilder):
             "geometa:add-user",
             "Add a new user",
             url_for("api.users"),
-            schema=User.get_schema(),
+            schema=get_schema(User),
         )
 
     def add_control_add_insight(self, user=None):
@@ -213,7 +347,22 @@ class GeodataBuilder(MasonBuilder):
             "geometa:add-insight",
             "Add a new insight",
             href,
-            schema=Insight.get_schema(),
+            schema=get_schema(Insight),
+        )
+
+    def add_control_import_insights(self, user):
+        """
+        Add a control to import insights in bulk as NDJSON, one insight per
+        line
+        """
+        self.add_control(
+            "geometa:import-insights",
+            url_for("api.insight_import", user=user),
+            method="POST",
+            encoding="raw",
+            title="Import insights",
+            description=f"Send {NDJSON}, each line an insight in this schema",
+            schema=get_schema(Insight),
         )
 
     def add_control_add_feedback(self, user, insight):
@@ -224,7 +373,7 @@ class GeodataBuilder(MasonBuilder):
             "geometa:add-feedback",
             "Add a new feedback",
             url_for("api.feedbacks_by_insight", user=user, insight=insight),
-            schema=Feedback.get_schema(),
+            schema=get_schema(Feedback),
         )
 
     def add_control_delete_user(self, user):
@@ -254,7 +403,7 @@ class GeodataBuilder(MasonBuilder):
         Add a control to edit user
         """
         self.add_control_put(
-            "Edit this user", url_for("api.user", user=user), schema=User.get_schema()
+            "Edit this user", url_for("api.user", user=user), schema=get_schema(User)
         )
 
     def add_control_edit_insight(self, user, insight):
@@ -265,14 +414,14 @@ class GeodataBuilder(MasonBuilder):
             self.add_control_put(
                 "Edit this insight",
                 url_for("api.insight_by", user=user, insight=insight),
-                schema=Insight.get_schema(),
+                schema=get_schema(Insight),
             )
 
     def add_control_edit_feedback(self, fb_url):
         """
         Add a control to edit feedback
         """
-        self.add_control_put("Edit this feedback", fb_url, schema=Feedback.get_schema())
+        self.add_control_put("Edit this feedback", fb_url, schema=get_schema(Feedback))
 
     def add_control_insight_collection(self, user=None):
         """
@@ -323,6 +472,27 @@ class GeodataBuilder(MasonBuilder):
                 description="Fetches all feedbacks related to this specific insight.",
             )
 
+    def add_control_pagination(self, page):
+        """
+        Add "next" and "prev" controls for a keyset paginated collection.
+        The controls repeat the current request with its cursor replaced, so
+        any filters given in the query string are preserved.
+        """
+        for ctrl_name, cursor in (
+            ("prev", page.prev_cursor),
+            ("next", page.next_cursor),
+        ):
+            if cursor is None:
+                continue
+            args = request.args.to_dict(flat=False)
+            args["cursor"] = [cursor]
+            self.add_control(
+                ctrl_name,
+                request.path + "?" + urlencode(args, doseq=True),
+                method="GET",
+                title=f"{ctrl_name.capitalize()} page",
+            )
+
     def add_control_user_collection(self):
         """
         Add control to retrieve user collection (admin only)
@@ -370,7 +540,391 @@ class GeodataBuilder(MasonBuilder):
             # Suggest retrying the current action
             builder.add_control("retry", href=request.path, method="POST")
 
-        return Response(json.dumps(builder), status=status_code, mimetype=MASON)
+        return mason_response(builder, status_code)
+
+
+class MasonItemTemplate:
+    """
+    A precompiled collection item. The item type and controls are resolved
+    and validated once, with the parts of the control hrefs that differ
+    between items left as str.format placeholders. Rendering an item then
+    only fills in its ids, instead of building a new GeodataBuilder and
+    calling url_for for every control.
+
+    The rendered items are identical to those built with GeodataBuilder.
+    """
+
+    def __init__(self, item_type):
+        self.item_type = item_type
+        self._controls = []
+
+    def add_control(self, ctrl_name, href, **kwargs):
+        """
+        Adds a control to the template. Takes the same arguments as
+        MasonBuilder.add_control; href may contain {placeholders}, e.g. from
+        url_template.
+        """
+
+        prototype = MasonBuilder()
+        prototype.add_control(ctrl_name, href, **kwargs)
+        control = prototype["@controls"][ctrl_name]
+        self._controls.append((ctrl_name, control, "{" in href))
+        return self
+
+    def with_controls(self, level):
+        """
+        Return a template for a level of CONTROL_LEVELS: "full" keeps every
+        control, "minimal" only "self" and "none" renders items without
+        @controls.
+        """
+
+        if level == "full":
+            return self
+        template = MasonItemTemplate(self.item_type)
+        if level == "minimal":
+            template._controls = [c for c in self._controls if c[0] == "self"]
+        else:
+            template._controls = None
+        return template
+
+    def render(self, data, **values):
+        """
+        Render an item from its serialized data, filling the href
+        placeholders from values.
+        """
+
+        item = GeodataBuilder(data)
+        item["@type"] = self.item_type
+        if self._controls is None:
+            return item
+        controls = item["@controls"] = {}
+        for ctrl_name, control, templated in self._controls:
+            control = dict(control)
+            if templated:
+                control["href"] = control["href"].format_map(values)
+            controls[ctrl_name] = control
+        return item
+
+
+class _UrlField:
+    """
+    Stands in for a model in url_for, so that the URL converters emit a
+    {name} placeholder instead of the model's id or username.
+    """
+
+    def __init__(self, name):
+        self.id = self.username = "{" + name + "}"
+
+
+def url_template(endpoint, **fields):
+    """
+    Build a URL for an endpoint with str.format placeholders in place of its
+    model arguments, e.g. url_template("api.insight", insight="id") returns
+    "/api/insights/{id}/".
+    """
+    return url_for(endpoint, **{arg: _UrlField(name) for arg, name in fields.items()})
+
+
+def item_template(factory):
+    """
+    Decorator for functions building a MasonItemTemplate. The template is
+    built on first use and then reused for the lifetime of the process. It
+    is kept per script root, as that is the only part of the request that
+    the generated URLs depend on.
+    """
+
+    compiled = {}
+
+    @wraps(factory)
+    def wrapper():
+        script_root = request.script_root
+        template = compiled.get(script_root)
+        if template is None:
+            template = compiled[script_root] = factory()
+        return template
+
+    return wrapper
+
+
+class Page:
+    """
+    One page of a keyset paginated query. The cursors are opaque strings
+    pointing just past the last item (next) or just before the first item
+    (prev), or None when there is nothing in that direction.
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+class StreamingPage(Page):
+    """
+    A page whose items are read lazily from a server-side cursor. The cursors
+    are only known once the items have been consumed, which is why streamed
+    collections emit their controls after the items.
+    """
+
+    def __init__(self, rows, key_name, limit, has_before):
+        super().__init__(self._iterate(rows, key_name, limit, has_before))
+
+    def _iterate(self, rows, key_name, limit, has_before):
+        first_key = last_key = None
+        count = 0
+        for row in rows:
+            if count == limit:
+                self.next_cursor = encode_cursor("next", last_key)
+                break
+            last_key = getattr(row, key_name)
+            if first_key is None:
+                first_key = last_key
+            count += 1
+            yield row
+        if has_before and first_key is not None:
+            self.prev_cursor = encode_cursor("prev", first_key)
+
+
+def encode_cursor(direction, key):
+    """
+    Encode a paging direction ("next" or "prev") and a key value into an
+    opaque URL safe cursor.
+    """
+    raw = json.dumps([direction, key]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor. Raises ValueError if the cursor
+    is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, key = json.loads(raw)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError("Malformed cursor") from e
+    if direction not in ("next", "prev") or not isinstance(key, int):
+        raise ValueError("Malformed cursor")
+    return direction, key
+
+
+def parse_page_params():
+    """
+    Parse the 'limit' and 'cursor' query parameters. Returns a tuple of
+    ((limit, cursor), None) on success and (None, error response) if either
+    parameter is invalid.
+    """
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError
+    except ValueError:
+        return None, GeodataBuilder.create_error_response(
+            400, "Invalid limit", f"limit must be an integer from 1 to {MAX_PAGE_SIZE}"
+        )
+
+    cursor = request.args.get("cursor")
+    try:
+        cursor = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return None, GeodataBuilder.create_error_response(
+            400, "Invalid cursor", "Use the cursor from a next or prev control"
+        )
+
+    return (limit, cursor), None
+
+
+def parse_fieldset_params(available):
+    """
+    Parse the 'fields' and 'controls' query parameters. 'fields' is a comma
+    separated list of item attributes out of available, 'controls' one of
+    CONTROL_LEVELS. Returns ((fields, controls), None) on success, fields
+    being None when all attributes are wanted, and (None, error response) if
+    either parameter is invalid.
+    """
+    fields = request.args.get("fields")
+    if fields is not None:
+        fields = tuple(dict.fromkeys(field.strip() for field in fields.split(",")))
+        unknown = [field for field in fields if field not in available]
+        if unknown:
+            return None, GeodataBuilder.create_error_response(
+                400,
+                "Invalid fields",
+                f"Unknown fields {', '.join(unknown)}, "
+                f"choose from {', '.join(available)}",
+            )
+
+    controls = request.args.get("controls", "full")
+    if controls not in CONTROL_LEVELS:
+        return None, GeodataBuilder.create_error_response(
+            400,
+            "Invalid controls",
+            f"controls must be one of {', '.join(CONTROL_LEVELS)}",
+        )
+
+    return (fields, controls), None
+
+
+def paginate(query, key, limit, cursor=None, stream=False):
+    """
+    Fetch one page of the query using keyset pagination on a unique, ordered
+    column. Each page is a single indexed range scan of at most limit + 1
+    rows, so the cost does not depend on how deep the client has paged.
+
+    : param query: SQLAlchemy query to paginate
+    : param key: unique column to order and page by, e.g. Insight.id
+    : param int limit: maximum number of items on the page
+    : param tuple cursor: decoded (direction, key value) cursor or None
+    : param bool stream: read forward pages lazily with yield_per instead
+        of loading them up front (see StreamingPage)
+    """
+
+    if stream and not (cursor and cursor[0] == "prev"):
+        if cursor:
+            query = query.filter(key > cursor[1])
+        rows = query.order_by(key).limit(limit + 1).yield_per(STREAM_CHUNK_SIZE)
+        return StreamingPage(rows, key.key, limit, has_before=cursor is not None)
+
+    if cursor and cursor[0] == "prev":
+        rows = query.filter(key < cursor[1]).order_by(key.desc()).limit(limit + 1).all()
+        has_before = len(rows) > limit
+        items = rows[:limit][::-1]
+        has_after = True
+    else:
+        if cursor:
+            query = query.filter(key > cursor[1])
+        rows = query.order_by(key).limit(limit + 1).all()
+        has_after = len(rows) > limit
+        items = rows[:limit]
+        has_before = cursor is not None
+
+    if not items:
+        return Page(items)
+
+    first_key = getattr(items[0], key.key)
+    last_key = getattr(items[-1], key.key)
+    return Page(
+        items,
+        next_cursor=encode_cursor("next", last_key) if has_after else None,
+        prev_cursor=encode_cursor("prev", first_key) if has_before else None,
+    )
+
+
+def paginate_items(items, key_name, limit, cursor=None):
+    """
+    Keyset paginate a list of dicts already sorted by a unique key, with the
+    same cursors as paginate. Used for results assembled outside the
+    database, e.g. from cached tiles.
+    """
+
+    keys = [item[key_name] for item in items]
+    if cursor and cursor[0] == "prev":
+        end = bisect.bisect_left(keys, cursor[1])
+        start = max(0, end - limit)
+        has_before, has_after = start > 0, True
+    else:
+        start = bisect.bisect_right(keys, cursor[1]) if cursor else 0
+        end = start + limit
+        has_before, has_after = cursor is not None, end < len(items)
+
+    page_items = items[start:end]
+    if not page_items:
+        return Page(page_items)
+    return Page(
+        page_items,
+        next_cursor=(
+            encode_cursor("next", page_items[-1][key_name]) if has_after else None
+        ),
+        prev_cursor=(
+            encode_cursor("prev", page_items[0][key_name]) if has_before else None
+        ),
+    )
+
+
+def stream_collections():
+    """
+    Return True if collection responses should be streamed, as set by the
+    STREAM_COLLECTIONS config option.
+    """
+    return current_app.config.get("STREAM_COLLECTIONS", False)
+
+
+def collection_response(body, page, build_item):
+    """
+    Create the response for a collection whose items are the rows of page,
+    each turned into a Mason item by build_item.
+
+    With STREAM_COLLECTIONS enabled the body is a generator: items are
+    encoded one at a time as rows arrive from the database, followed by the
+    rest of the body including the paging controls. Only one row and its
+    encoded item are alive at any time, so memory does not grow with the
+    size of the collection. Otherwise the whole body is built and encoded
+    at once.
+
+    : param GeodataBuilder body: the collection without its items
+    : param Page page: the page of rows to include
+    : param build_item: function turning a row into a Mason item
+    """
+
+    if not stream_collections():
+        body["items"] = [build_item(row) for row in page.items]
+        body.add_control_pagination(page)
+        return mason_response(body)
+
+    def generate():
+        yield b'{"items":['
+        for index, row in enumerate(page.items):
+            if index:
+                yield b","
+            yield encode(build_item(row))
+        body.add_control_pagination(page)
+        rest = encode(body)
+        yield b"]," + rest[1:] if body else b"]}"
+
+    return Response(stream_with_context(generate()), 200, mimetype=MASON)
+
+
+def cached_item_body(kind, item_id, build):
+    """
+    Return the public part of an item body, shared by every caller and every
+    route alias of the item. The part is cached under kind/item_id and built
+    with build() on a miss. The returned body is a private copy, so the
+    caller can overlay the controls that depend on the route and on who is
+    asking.
+
+    : param str kind: item kind, e.g. "insight"
+    : param item_id: id of the item
+    : param build: function returning the public GeodataBuilder body
+    """
+
+    key = f"items/{kind}/{item_id}"
+    body = cache.get(key)
+    if body is None:
+        body = build()
+        cache.set(key, body)
+    body = GeodataBuilder(body)
+    if "@controls" in body:
+        body["@controls"] = dict(body["@controls"])
+    return body
+
+
+def invalidate_items(kind, *item_ids):
+    """
+    Drop the cached public bodies of items, covering all of their routes.
+    """
+    if item_ids:
+        cache.delete_many(*(f"items/{kind}/{item_id}" for item_id in item_ids))
+
+
+def invalidate_user_items(user):
+    """
+    Drop the cached bodies of every insight and feedback, and the cached
+    tiles of every insight, showing the user's username.
+    """
+    invalidate_items("insight", *(insight.id for insight in user.insight))
+    invalidate_points((insight.longitude, insight.latitude) for insight in user.insight)
+    invalidate_items("feedback", *(feedback.id for feedback in user.feedback))
 
 
 class UserConverter(BaseConverter):
@@ -420,7 +974,14 @@ class FeedbackConverter(BaseConverter):
     """
 
     def to_python(self, value):
-        db_feedback = Feedback.query.filter_by(id=value).first()
+        # Feedback responses show the author and link to the insight
+        db_feedback = (
+            Feedback.query.options(
+                joinedload(Feedback.user), joinedload(Feedback.insight)
+            )
+            .filter_by(id=value)
+            .first()
+        )
         if db_feedback is None:
             raise NotFound
         return db_feedback
@@ -21,4 +21,7 @@ setup(
         "rfc3339-validator",
         "flask-caching",
     ],
+    extras_require={
+        "fast": ["orjson"],
+    },
 )